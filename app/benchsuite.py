@@ -0,0 +1,276 @@
+"""
+Bộ benchmark các đường nóng (kho + báo cáo) trên dữ liệu tổng hợp, kết quả ra JSON để so với baseline.
+Chạy trên DB riêng (không chạy trên DB thật):
+    DATABASE_URL=sqlite:///bench.db python -m app.cli bench-suite --ledger-rows 1000000 --out bench.json
+    DATABASE_URL=sqlite:///bench.db python -m app.cli bench-suite --out new.json --baseline bench.json [--threshold 0.2]
+Dữ liệu (cửa hàng BENCHxx, sản phẩm BPxxxxx) sinh 1 lần theo --seed; lần sau dùng lại.
+Đo:
+- nhap/xuat/kiemke: mỗi thao tác 1 commit như endpoint (ops/s, p50/p95);
+- get_latest_state: tra snapshot theo khoá (p50/p95, identity map được xoá mỗi lần);
+- trang /dashboard, /baocao/ton, /baocao/candoi, /doanhthu và /kho/export (CSV) qua TestClient,
+  cache bảng báo cáo xoá trước mỗi request để đo đúng truy vấn.
+So baseline: chỉ số *_ms tăng quá threshold, hoặc *_s (ops/s, rows/s) giảm quá threshold -> hồi quy.
+"""
+from __future__ import annotations
+import json
+import platform
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, func
+from . import models
+from .db import SessionLocal, SQLALCHEMY_DATABASE_URL
+from .services import fragments, summary, masterdata as md
+from .services.inventory import (nhap, xuat, kiemke, get_latest_state, _calc_in, _calc_out,
+                                 rebuild_stock_balance)
+
+STORE_PREFIX = "BENCH"
+PRODUCT_PREFIX = "BP"
+CHUNK_ROWS = 10_000
+PAGES = ["/dashboard", "/baocao/ton", "/baocao/candoi", "/doanhthu"]
+
+def _store_codes(n: int) -> list[str]:
+    return [f"{STORE_PREFIX}{i:02d}" for i in range(1, n + 1)]
+
+# --------- Sinh dữ liệu ---------
+def generate(
+    db,
+    stores: int = 3,
+    products: int = 200,
+    ledger_rows: int = 200_000,
+    days: int = 365,
+    productions: int = 2_000,
+    assets: int = 200,
+    seed: int = 1,
+) -> dict:
+    """
+    Ghi dữ liệu tổng hợp (chuỗi tồn/ BQ hợp lệ theo từng mã), dựng stock_balance + daily_summary.
+    Từ chối nếu DB đã có ledger của cửa hàng khác (không phải DB benchmark).
+    """
+    L, S = models.Ledger, models.Store
+    if db.execute(select(L.id).join(S, S.id == L.store_id).where(~S.code.startswith(STORE_PREFIX)).limit(1)).first():
+        raise RuntimeError("DB có dữ liệu thật: đặt DATABASE_URL trỏ tới DB riêng cho benchmark")
+    rnd = random.Random(seed)
+    store_codes = _store_codes(stores)
+    store_objs = [models.Store(code=sc, name=f"Bench {sc}") for sc in store_codes]
+    prod_objs = [models.Product(code=f"{PRODUCT_PREFIX}{i:05d}", name=f"Sản phẩm bench {i}", uom="kg",
+                                category_code="TRÁI_CÂY") for i in range(products)]
+    db.add_all(store_objs + prod_objs)
+    for i in range(assets):
+        db.add(models.FixedAsset(code=f"BTS{i:04d}", name=f"TS bench {i}", cost=rnd.uniform(1e6, 1e8),
+                                 life_months=rnd.choice([24, 36, 60, 120]),
+                                 start_date=datetime(2020, 1, 1) + timedelta(days=rnd.randrange(days * 3))))
+    db.flush()
+
+    start = datetime.utcnow() - timedelta(days=days)
+    pairs = [(s.id, p.id) for s in store_objs for p in prod_objs]
+    per_pair = max(1, ledger_rows // len(pairs))
+    step = timedelta(seconds=days * 86400 / per_pair)
+    buf = []
+    for sid, pid in pairs:
+        state = (0.0, 0.0, 0.0, 0.0)
+        for j in range(per_pair):
+            if state[0] < 20 or rnd.random() < 0.45:
+                qty, price = rnd.uniform(5, 100), rnd.uniform(10_000, 60_000)
+                state = _calc_in(state, qty, price)
+                q_in, p_in, q_out = qty, price, 0.0
+            else:
+                q_out = rnd.uniform(0.5, state[0] / 2)
+                state = _calc_out(state, q_out)
+                q_in = p_in = 0.0
+            buf.append(dict(date=start + step * j, store_id=sid, product_id=pid,
+                            qty_in=q_in, price_in=p_in, qty_out=q_out,
+                            reason=int(models.Reason.NHAP if q_in else models.Reason.XUAT), created_by_id=None,
+                            stock_after=state[0], avg_price=state[1], onhand_value=state[2], cups=state[3],
+                            production_id=None))
+            if len(buf) >= CHUNK_ROWS:
+                db.execute(insert(L.__table__), buf); buf.clear()
+    if buf:
+        db.execute(insert(L.__table__), buf); buf.clear()
+
+    revs = []
+    for sc in store_codes:
+        for d in range(days):
+            for _ in range(rnd.randint(1, 3)):
+                revs.append(dict(date=start + timedelta(days=d, hours=rnd.randint(8, 21)), store_code=sc,
+                                 cash=rnd.uniform(1e5, 5e6), bank=rnd.uniform(1e5, 5e6), note="", created_by="bench"))
+    db.execute(insert(models.Revenue.__table__), revs)
+    db.execute(insert(models.ProductionLog.__table__), [
+        dict(date=start + timedelta(seconds=rnd.randrange(days * 86400)), store_code=rnd.choice(store_codes),
+             kind="CỐT", formula_code="BENCH", formula_name="Bench", fruits_json="{}", kg_sau=rnd.uniform(5, 50),
+             additives_json="{}", kg_tp=rnd.uniform(5, 50), cups=rnd.uniform(20, 200), status="HOÀN THÀNH",
+             created_by="bench", note="", batch_id=None)
+        for _ in range(productions)
+    ])
+    rebuild_stock_balance(db)
+    summary.rebuild_daily_summary(db)
+    db.commit()
+    md.invalidate("stores"); md.invalidate("products")
+    return dataset(db)
+
+def dataset(db) -> dict:
+    def count(model, *where):
+        return db.execute(select(func.count()).select_from(model).where(*where)).scalar() or 0
+    L, S = models.Ledger, models.Store
+    bench_ids = select(S.id).where(S.code.startswith(STORE_PREFIX))
+    return dict(
+        stores=count(S, S.code.startswith(STORE_PREFIX)),
+        products=count(models.Product, models.Product.code.startswith(PRODUCT_PREFIX)),
+        ledger_rows=count(L, L.store_id.in_(bench_ids)),
+        revenues=count(models.Revenue),
+        productions=count(models.ProductionLog),
+        fixed_assets=count(models.FixedAsset),
+    )
+
+# --------- Đo ---------
+def _stats(samples_ms: list[float], prefix: str, out: dict) -> None:
+    s = sorted(samples_ms)
+    out[f"{prefix}.p50_ms"] = statistics.median(s)
+    out[f"{prefix}.p95_ms"] = s[min(len(s) - 1, int(len(s) * 0.95))]
+
+def bench_writes(store_codes: list[str], product_codes: list[str], ops: int, seed: int) -> dict:
+    rnd = random.Random(seed)
+    out = {}
+    db = SessionLocal()
+    try:
+        for name in ("nhap", "xuat", "kiemke"):
+            samples = []
+            for _ in range(ops):
+                sc, pc = rnd.choice(store_codes), rnd.choice(product_codes)
+                t0 = time.perf_counter()
+                if name == "nhap":
+                    nhap(db, store_code=sc, product_code=pc, qty=10.0, price=20_000.0, note="Bench")
+                elif name == "xuat":
+                    stock = get_latest_state(db, sc, pc)[0]
+                    if stock > 0.01:
+                        xuat(db, store_code=sc, product_code=pc, qty=min(1.0, stock), note="Bench")
+                else:
+                    kiemke(db, store_code=sc, product_code=pc, actual=get_latest_state(db, sc, pc)[0] + 1.0)
+                db.commit()
+                samples.append((time.perf_counter() - t0) * 1000)
+            out[f"{name}.ops_s"] = len(samples) / (sum(samples) / 1000)
+            _stats(samples, name, out)
+    finally:
+        db.close()
+    return out
+
+def bench_latest_state(store_codes: list[str], product_codes: list[str], lookups: int, seed: int) -> dict:
+    rnd = random.Random(seed)
+    samples = []
+    db = SessionLocal()
+    try:
+        for _ in range(lookups):
+            sc, pc = rnd.choice(store_codes), rnd.choice(product_codes)
+            db.expunge_all()
+            t0 = time.perf_counter()
+            get_latest_state(db, sc, pc)
+            samples.append((time.perf_counter() - t0) * 1000)
+        db.rollback()
+    finally:
+        db.close()
+    out = {}
+    _stats(samples, "get_latest_state", out)
+    return out
+
+def bench_pages(c, store_code: str, requests: int, email: str, password: str) -> dict:
+    """
+    c: TestClient đã chạy startup của app.
+    """
+    out = {}
+    r = c.post("/login", data={"email": email, "password": password}, follow_redirects=False)
+    if r.status_code != 302:
+        raise RuntimeError("Đăng nhập thất bại")
+    c.post("/switch-store", data={"store_code": store_code}, follow_redirects=False)
+    for path in PAGES:
+        c.get(path)  # làm nóng template/ cache danh mục
+        samples = []
+        for _ in range(requests):
+            fragments.clear()
+            t0 = time.perf_counter()
+            r = c.get(path)
+            samples.append((time.perf_counter() - t0) * 1000)
+            if r.status_code != 200:
+                raise RuntimeError(f"{path}: HTTP {r.status_code}")
+        _stats(samples, f"page{path}", out)
+    # Xuất CSV ledger cả kỳ của 1 cửa hàng
+    t0 = time.perf_counter()
+    r = c.get("/kho/export", params={"from": "2000-01-01", "to": datetime.utcnow().date().isoformat(),
+                                     "store": store_code})
+    elapsed = time.perf_counter() - t0
+    out["export_csv.ms"] = elapsed * 1000
+    out["export_csv.rows_s"] = (r.text.count("\n") - 1) / elapsed if elapsed else 0.0
+    return out
+
+def run_suite(
+    stores: int = 3,
+    products: int = 200,
+    ledger_rows: int = 200_000,
+    days: int = 365,
+    productions: int = 2_000,
+    ops: int = 200,
+    lookups: int = 2_000,
+    requests: int = 20,
+    seed: int = 1,
+    email: str = "superadmin@example.com",
+    password: str = "123456",
+) -> dict:
+    from fastapi.testclient import TestClient
+    from .main import app
+
+    with TestClient(app) as c:  # startup: migration + seed (user đăng nhập)
+        db = SessionLocal()
+        try:
+            if db.execute(select(models.Store.id).where(models.Store.code == _store_codes(1)[0])).first():
+                ds = dataset(db)
+            else:
+                t0 = time.perf_counter()
+                ds = generate(db, stores, products, ledger_rows, days, productions, seed=seed)
+                ds["generate_s"] = round(time.perf_counter() - t0, 1)
+            store_codes = list(db.execute(select(models.Store.code).where(
+                models.Store.code.startswith(STORE_PREFIX))).scalars())
+            product_codes = list(db.execute(select(models.Product.code).where(
+                models.Product.code.startswith(PRODUCT_PREFIX))).scalars())
+        finally:
+            db.close()
+
+        metrics = {}
+        metrics.update(bench_latest_state(store_codes, product_codes, lookups, seed))
+        metrics.update(bench_pages(c, store_codes[0], requests, email, password))
+        metrics.update(bench_writes(store_codes, product_codes, ops, seed))
+    return dict(
+        meta=dict(
+            ts=datetime.utcnow().isoformat(timespec="seconds"),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            database=SQLALCHEMY_DATABASE_URL.split("://", 1)[0],
+            dataset=ds,
+            params=dict(ops=ops, lookups=lookups, requests=requests, seed=seed),
+        ),
+        metrics={k: round(v, 3) for k, v in metrics.items()},
+    )
+
+# --------- So với baseline ---------
+def _lower_is_better(name: str) -> bool:
+    return name.endswith("_ms") or name.endswith(".ms")
+
+def compare(current: dict, baseline: dict, threshold: float = 0.2) -> list[dict]:
+    """
+    Mỗi chỉ số có ở cả 2 lần chạy: change = tỷ lệ thay đổi theo chiều "tệ hơn" (> 0 là chậm đi).
+    """
+    out = []
+    for name, new in current["metrics"].items():
+        old = baseline.get("metrics", {}).get(name)
+        if not old:
+            continue
+        change = (new - old) / old if _lower_is_better(name) else (old - new) / old
+        out.append(dict(metric=name, baseline=old, current=new, change=change, regressed=change > threshold))
+    return out
+
+def save(result: dict, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
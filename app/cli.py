@@ -0,0 +1,300 @@
+"""
+Lệnh quản trị chạy ngoài web:
+    python -m app.cli migrate
+    python -m app.cli check-plans
+    DATABASE_URL=postgresql://... python -m app.cli check-db
+    python -m app.cli rebuild-balance
+    python -m app.cli backfill-daily
+    python -m app.cli stress-xuat [--threads 8] [--qty 200] [--keep]
+    python -m app.cli bench-reports --url http://127.0.0.1:8000 [--url ...]
+    python -m app.cli bench-templates [--rows 300] [--renders 500]
+    python -m app.cli replay-ledger --store 216HS --product XOAI [--since 2025-01-01]
+    python -m app.cli verify-ledger [--workers 4] [--fix]
+    python -m app.cli import-ledger FILE.csv --store 216HS [--kind nhap] [--by email] [--dry-run]
+    python -m app.cli close-period --before 2025-01-01 [--dir archive]
+    DATABASE_URL=sqlite:///bench.db python -m app.cli bench-suite [--ledger-rows 1000000] --out bench.json \
+        [--baseline base.json --threshold 0.2]
+"""
+import argparse
+import sys
+import time
+from datetime import datetime
+from .db import engine, SessionLocal
+from .migrations import run_migrations
+from .queryplan import check_query_plans
+from .dbcheck import check_db
+from .services.inventory import rebuild_stock_balance
+from .services.summary import rebuild_daily_summary
+from .loadtest import bench_reports, bench_templates
+from .stress import stress_xuat
+from . import benchsuite
+from .services.replay import replay_product, verify_all, repair
+from .services.importer import import_ledger
+from .services.archive import ARCHIVE_DIR, close_period
+
+def cmd_migrate(args) -> int:
+    # run_migrations đã chạy trong main(); chỉ báo cáo kết quả
+    print(f"Schema đã cập nhật, phiên bản mới áp dụng: {args.applied or 'không có'}")
+    return 0
+
+def cmd_check_plans(args) -> int:
+    failed = 0
+    for name, plan, ok in check_query_plans(engine):
+        print(f"[{'OK ' if ok else 'FAIL'}] {name}")
+        for d in plan:
+            print(f"        {d}")
+        failed += 0 if ok else 1
+    if failed:
+        print(f"{failed} truy vấn quét toàn bảng")
+    return 1 if failed else 0
+
+def cmd_check_db(args) -> int:
+    print(f"Backend: {engine.dialect.name} ({engine.url.render_as_string()})")
+    try:
+        results = check_db()
+    except ValueError as e:
+        print(f"LỖI: {e}", file=sys.stderr)
+        return 1
+    for name, err in results:
+        print(f"[{'OK ' if err is None else 'FAIL'}] {name}" + (f": {err}" if err else ""))
+    return 1 if any(err for _, err in results) else 0
+
+def cmd_rebuild_balance(args) -> int:
+    db = SessionLocal()
+    try:
+        n = rebuild_stock_balance(db)
+        db.commit()
+    finally:
+        db.close()
+    print(f"Đã dựng lại stock_balance: {n} dòng")
+    return 0
+
+def cmd_backfill_daily(args) -> int:
+    db = SessionLocal()
+    try:
+        n = rebuild_daily_summary(db)
+        db.commit()
+    finally:
+        db.close()
+    print(f"Đã dựng lại daily_summary: {n} dòng")
+    return 0
+
+def cmd_stress_xuat(args) -> int:
+    res = stress_xuat(threads=args.threads, qty=args.qty, keep=args.keep)
+    print(f"Tồn ban đầu {res.initial:g}: xuất thành công {res.ok}, bị chặn âm kho {res.rejected}, "
+          f"database is locked {res.locked}")
+    for e in res.errors:
+        print(f"  LỖI: {e}")
+    print("OK" if res.passed else "FAIL")
+    return 0 if res.passed else 1
+
+def cmd_bench_reports(args) -> int:
+    results = bench_reports(args.url, args.email, args.password, args.path or None, args.requests, args.concurrency)
+    first = next(iter(results.values()))
+    for base, stats in results.items():
+        print(base)
+        for st, ref in zip(stats, first):
+            ratio = f"  x{st.rps / ref.rps:.2f}" if base != args.url[0] and ref.rps else ""
+            print(f"  {st.path:<16} {st.rps:8.1f} req/s  p50 {st.p50_ms:7.1f} ms  p95 {st.p95_ms:7.1f} ms"
+                  f"  lỗi {st.errors}{ratio}")
+    return 1 if any(st.errors for stats in results.values() for st in stats) else 0
+
+def cmd_bench_templates(args) -> int:
+    for k, v in bench_templates(args.rows, args.renders).items():
+        print(f"  {k:<26} {v:9.2f}")
+    return 0
+
+def _print_violations(violations, limit: int = 50) -> None:
+    for v in violations[:limit]:
+        print(f"  ÂM KHO {v.store_code}/{v.product_code} ledger #{v.ledger_id} {v.date:%Y-%m-%d %H:%M}: "
+              f"tồn {v.stock_before:g}, xuất {v.qty_out:g}")
+    if len(violations) > limit:
+        print(f"  ... và {len(violations) - limit} lần khác")
+
+def cmd_replay_ledger(args) -> int:
+    since = datetime.fromisoformat(args.since) if args.since else None
+    db = SessionLocal()
+    try:
+        t0 = time.perf_counter()
+        res = replay_product(db, args.store, args.product, since=since)
+        db.commit()
+    finally:
+        db.close()
+    print(f"{args.store}/{args.product}: {res.rows} dòng, sửa {len(res.changed)} dòng "
+          f"({time.perf_counter() - t0:.2f}s); tồn cuối {res.state[0]:g}, BQ {res.state[1]:,.2f}")
+    _print_violations(res.violations)
+    return 1 if res.violations else 0
+
+def cmd_verify_ledger(args) -> int:
+    t0 = time.perf_counter()
+    rep = verify_all(args.workers)
+    print(f"Đã replay {rep.pairs} mã / {rep.rows} dòng ({time.perf_counter() - t0:.2f}s)")
+    for sc, pc, n, first_id in rep.mismatched:
+        print(f"  LỆCH {sc}/{pc}: {n} dòng, từ ledger #{first_id}")
+    for sc, pc in rep.balance_mismatched:
+        print(f"  LỆCH stock_balance {sc}/{pc}")
+    _print_violations(rep.violations)
+    bad = sorted({(sc, pc) for sc, pc, *_ in rep.mismatched} | set(rep.balance_mismatched))
+    if args.fix and bad:
+        db = SessionLocal()
+        try:
+            n = repair(db, bad)
+            db.commit()
+        finally:
+            db.close()
+        print(f"Đã sửa {n} dòng ledger của {len(bad)} mã")
+        return 1 if rep.violations else 0
+    return 1 if (bad or rep.violations) else 0
+
+def cmd_import_ledger(args) -> int:
+    def progress(st):
+        print(f"\r  {st.lines} dòng đọc, {st.written} dòng ghi, {len(st.errors)} lỗi "
+              f"({st.lines / max(st.seconds, 1e-9):,.0f} dòng/s)", end="", file=sys.stderr, flush=True)
+
+    db = SessionLocal()
+    try:
+        with open(args.file, encoding="utf-8-sig", newline="") as f:
+            st = import_ledger(db, f, default_store=args.store, default_kind=args.kind, created_by=args.by,
+                               dry_run=args.dry_run, chunk_rows=args.chunk, progress=progress)
+        if args.dry_run:
+            db.rollback()
+        else:
+            db.commit()
+    except ValueError as e:
+        db.rollback()
+        print(f"\nLỖI: {e} (không ghi dòng nào)", file=sys.stderr)
+        return 1
+    finally:
+        db.close()
+    print(file=sys.stderr)
+    for e in st.errors:
+        print(f"  {e}")
+    verb = "Kiểm tra" if args.dry_run else "Đã ghi"
+    print(f"{verb} {st.lines} dòng / {st.pairs} mã ({st.seconds:.1f}s): ghi {st.written}, "
+          f"lỗi {len(st.errors)}{'+' if len(st.errors) >= 100 else ''}, replay {st.replayed} mã")
+    return 1 if st.errors else 0
+
+def cmd_close_period(args) -> int:
+    db = SessionLocal()
+    try:
+        st = close_period(db, datetime.fromisoformat(args.before).date(), args.dir)
+        db.commit()
+    except ValueError as e:
+        db.rollback()
+        print(f"LỖI: {e}", file=sys.stderr)
+        return 1
+    finally:
+        db.close()
+    for year, n in sorted(st.years.items()):
+        print(f"  {year}: {n} dòng")
+    print(f"Đã khoá sổ trước {st.cutoff:%Y-%m-%d}: lưu trữ {st.rows} dòng, {st.pairs} dòng tồn đầu kỳ "
+          f"({st.seconds:.1f}s)")
+    return 0
+
+def cmd_bench_suite(args) -> int:
+    res = benchsuite.run_suite(stores=args.stores, products=args.products, ledger_rows=args.ledger_rows, days=args.days,
+                               productions=args.productions, ops=args.ops, lookups=args.lookups,
+                               requests=args.requests, seed=args.seed)
+    print(f"Dữ liệu: {res['meta']['dataset']}")
+    if args.out:
+        benchsuite.save(res, args.out)
+    if not args.baseline:
+        for k, v in res["metrics"].items():
+            print(f"  {k:<32} {v:12.3f}")
+        return 0
+    base = benchsuite.load(args.baseline)
+    if base["meta"].get("dataset", {}).get("ledger_rows") != res["meta"]["dataset"]["ledger_rows"]:
+        print("CHÚ Ý: baseline chạy trên bộ dữ liệu khác")
+    rows = benchsuite.compare(res, base, args.threshold)
+    for r in rows:
+        print(f"  {'HỒI QUY' if r['regressed'] else 'ok':<8} {r['metric']:<32} {r['baseline']:12.3f} -> "
+              f"{r['current']:12.3f}  ({r['change']:+.0%})")
+    bad = [r for r in rows if r["regressed"]]
+    print(f"{len(bad)} chỉ số chậm hơn quá {args.threshold:.0%}" if bad else "Không có hồi quy")
+    return 1 if bad else 0
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("migrate", help="Áp dụng migration schema còn thiếu")
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser("check-plans", help="EXPLAIN QUERY PLAN cho các truy vấn chính")
+    p.set_defaults(func=cmd_check_plans)
+
+    p = sub.add_parser("check-db", help="Chạy thử khoá ghi/ replay/ tìm kiếm/ khoá sổ trên backend đang cấu hình (DB trống)")
+    p.set_defaults(func=cmd_check_db)
+
+    p = sub.add_parser("rebuild-balance", help="Dựng lại bảng tồn hiện tại từ Ledger")
+    p.set_defaults(func=cmd_rebuild_balance)
+
+    p = sub.add_parser("backfill-daily", help="Dựng lại bảng tổng hợp theo ngày từ revenues + ledger")
+    p.set_defaults(func=cmd_backfill_daily)
+
+    p = sub.add_parser("stress-xuat", help="Xuất kho đồng thời nhiều thread, kiểm tra âm kho / mất cập nhật")
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--qty", type=float, default=200.0)
+    p.add_argument("--keep", action="store_true", help="Giữ lại dữ liệu thử")
+    p.set_defaults(func=cmd_stress_xuat)
+
+    p = sub.add_parser("bench-reports", help="Đo tải các trang báo cáo trên server đang chạy")
+    p.add_argument("--url", action="append", required=True, help="Base URL, lặp lại để so sánh (URL đầu là mốc)")
+    p.add_argument("--path", action="append", help="Trang cần đo (mặc định 5 trang báo cáo)")
+    p.add_argument("--email", default="superadmin@example.com")
+    p.add_argument("--password", default="123456")
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.set_defaults(func=cmd_bench_reports)
+
+    p = sub.add_parser("bench-templates", help="Thời gian compile template lúc khởi động và p99 render")
+    p.add_argument("--rows", type=int, default=300)
+    p.add_argument("--renders", type=int, default=500)
+    p.set_defaults(func=cmd_bench_templates)
+
+    p = sub.add_parser("replay-ledger", help="Tính lại tồn/ BQ/ cốc của 1 sản phẩm theo thứ tự ngày")
+    p.add_argument("--store", required=True)
+    p.add_argument("--product", required=True)
+    p.add_argument("--since", help="Ngày bắt đầu tính lại (YYYY-MM-DD[THH:MM]); mặc định từ đầu")
+    p.set_defaults(func=cmd_replay_ledger)
+
+    p = sub.add_parser("verify-ledger", help="Replay toàn bộ ledger song song, báo dòng lệch và âm kho")
+    p.add_argument("--workers", type=int, default=None, help="Số tiến trình (mặc định số CPU)")
+    p.add_argument("--fix", action="store_true", help="Ghi lại các mã bị lệch")
+    p.set_defaults(func=cmd_verify_ledger)
+
+    p = sub.add_parser("import-ledger", help="Import file CSV lớn vào ledger (stream, ghi theo khối)")
+    p.add_argument("file")
+    p.add_argument("--store", required=True, help="Cửa hàng mặc định khi file không có cột store_code")
+    p.add_argument("--kind", default="nhap", help="Loại mặc định khi file không có cột kind")
+    p.add_argument("--by", default="", help="Email người nhập (ghi vào reason)")
+    p.add_argument("--chunk", type=int, default=5000)
+    p.add_argument("--dry-run", action="store_true", help="Chỉ kiểm tra, không ghi")
+    p.set_defaults(func=cmd_import_ledger)
+
+    p = sub.add_parser("close-period", help="Khoá sổ: chuyển ledger trước ngày --before sang file lưu trữ theo năm")
+    p.add_argument("--before", required=True, help="Ngày khoá sổ (YYYY-MM-DD), dòng trước ngày này được lưu trữ")
+    p.add_argument("--dir", default=ARCHIVE_DIR, help="Thư mục file lưu trữ (mặc định LEDGER_ARCHIVE_DIR)")
+    p.set_defaults(func=cmd_close_period)
+
+    p = sub.add_parser("bench-suite", help="Benchmark kho + báo cáo trên dữ liệu tổng hợp, so với baseline JSON")
+    p.add_argument("--stores", type=int, default=3)
+    p.add_argument("--products", type=int, default=200)
+    p.add_argument("--ledger-rows", type=int, default=200_000)
+    p.add_argument("--days", type=int, default=365)
+    p.add_argument("--productions", type=int, default=2_000)
+    p.add_argument("--ops", type=int, default=200, help="Số lần nhap/xuat/kiemke mỗi loại")
+    p.add_argument("--lookups", type=int, default=2_000)
+    p.add_argument("--requests", type=int, default=20, help="Số request mỗi trang")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="Ghi kết quả JSON")
+    p.add_argument("--baseline", help="File JSON của lần chạy mốc")
+    p.add_argument("--threshold", type=float, default=0.2, help="Ngưỡng hồi quy (0.2 = chậm hơn 20%%)")
+    p.set_defaults(func=cmd_bench_suite)
+
+    args = parser.parse_args(argv)
+    args.applied = run_migrations(engine)
+    return args.func(args)
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,131 @@
+"""
+Chạy thử các đường ghi/ đọc phụ thuộc backend trên DB đang cấu hình (DATABASE_URL):
+khoá ghi (BEGIN IMMEDIATE / advisory lock), ghi lùi ngày + replay, kiểm kê lùi ngày,
+tìm sản phẩm (FTS5 / LIKE), upsert daily_summary, khoá sổ + đọc lưu trữ.
+Chạy trên DB trống (file SQLite mới hoặc database PostgreSQL mới), 1 lần cho mỗi backend:
+    DATABASE_URL=sqlite:///check.db python -m app.cli check-db
+    DATABASE_URL=postgresql://user@host/check_db python -m app.cli check-db
+Dữ liệu thử (cửa hàng/ sản phẩm ZZCHECK) để lại trong DB, kể cả mốc khoá sổ.
+"""
+from __future__ import annotations
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from . import models
+from .db import SessionLocal, engine
+from .services import archive, search, summary
+from .services import masterdata as md
+from .services.inventory import get_latest_state, kiemke, ledger_keys, nhap, xuat
+from .services.replay import replay_product
+from .stress import stress_xuat
+
+STORE = "ZZCHECK"
+PRODUCT = "ZZCHECK"
+PRODUCT_KK = "ZZCHECK_KK"  # riêng cho kiểm kê thừa + ghi lùi ngày (sau mốc khoá sổ của bước cuối)
+
+def _check_locks(db) -> str | None:
+    res = stress_xuat(threads=4, qty=40.0)
+    if not res.passed:
+        return f"xuất {res.ok}/40, locked {res.locked}, lỗi {res.errors[:3]}"
+
+def _check_backdated(db) -> str | None:
+    now = datetime.utcnow()
+    nhap(db, store_code=STORE, product_code=PRODUCT, qty=10, price=100, when=now - timedelta(days=10))
+    nhap(db, store_code=STORE, product_code=PRODUCT, qty=5, price=200)
+    xuat(db, store_code=STORE, product_code=PRODUCT, qty=3, when=now - timedelta(days=5))
+    db.commit()
+    res = replay_product(db, STORE, PRODUCT, strict=True)
+    db.rollback()
+    stock = get_latest_state(db, STORE, PRODUCT)[0]
+    if res.changed or abs(stock - 12) > 1e-9:
+        return f"tồn {stock:g} (kỳ vọng 12), {len(res.changed)} dòng lệch sau replay"
+
+def _check_kiemke_as_of(db) -> str | None:
+    # Tồn lúc now-7 ngày = 10 -> kiểm kê 4 = xuất 6 (tồn hiện tại 12 không dùng)
+    e = kiemke(db, store_code=STORE, product_code=PRODUCT, actual=4, when=datetime.utcnow() - timedelta(days=7))
+    db.commit()
+    if e is None or abs(e.qty_out - 6) > 1e-9:
+        return f"dòng kiểm kê {e and (e.qty_in, e.qty_out)} (kỳ vọng xuất 6)"
+
+def _check_backdated_before_kiemke(db) -> str | None:
+    # Kiểm kê thừa nhập theo BQ: nhập 10@100, kiểm kê lên 15, rồi ghi lùi 10@200 vào trước kiểm kê
+    # -> replay định giá lại 5 thừa theo BQ 150: tồn 25, BQ 150, giá trị 3750
+    now = datetime.utcnow()
+    nhap(db, store_code=STORE, product_code=PRODUCT_KK, qty=10, price=100, when=now - timedelta(days=3))
+    e = kiemke(db, store_code=STORE, product_code=PRODUCT_KK, actual=15, when=now - timedelta(days=1))
+    nhap(db, store_code=STORE, product_code=PRODUCT_KK, qty=10, price=200, when=now - timedelta(days=2))
+    db.commit()
+    db.refresh(e)
+    stock, avg, val, _ = get_latest_state(db, STORE, PRODUCT_KK)
+    if abs(stock - 25) > 1e-9 or abs(avg - 150) > 1e-6 or abs(val - 3750) > 1e-6 or abs(e.price_in - 150) > 1e-6:
+        return f"tồn {stock:g}, BQ {avg:g}, giá trị {val:g}, giá kiểm kê {e.price_in:g} (kỳ vọng 25/150/3750/150)"
+
+def _check_search(db) -> str | None:
+    hits = [p.code for p in search.search_products(db, "zzcheck hang thu")]
+    if hits != [PRODUCT]:
+        return f"kết quả {hits}"
+
+def _check_daily_summary(db) -> str | None:
+    today = datetime.utcnow().date()
+    for _ in range(2):
+        summary.add_daily(db, STORE, today, cash=1000.0)
+    db.commit()
+    total = summary.revenue_total(db, STORE, today, today)
+    if abs(total - 2000.0) > 1e-6:
+        return f"doanh thu {total:g} (kỳ vọng 2000)"
+
+def _check_close_period(db) -> str | None:
+    d = tempfile.mkdtemp(prefix="ledger_archive_")
+    try:
+        before = get_latest_state(db, STORE, PRODUCT)
+        cutoff = (datetime.utcnow() - timedelta(days=6)).date()
+        st = archive.close_period(db, cutoff, d)
+        db.commit()
+        if get_latest_state(db, STORE, PRODUCT) != before:
+            return "tồn đổi sau khoá sổ"
+        try:
+            nhap(db, store_code=STORE, product_code=PRODUCT, qty=1, price=1, when=datetime.utcnow() - timedelta(days=8))
+            return "ghi được vào kỳ đã khoá"
+        except ValueError:
+            db.rollback()
+        sid, _ = ledger_keys(db, STORE, PRODUCT)
+        rows = archive.balances_as_of(db, sid, cutoff - timedelta(days=1))
+        if st.rows != 2 or [(p.code, r.stock_after) for r, p in rows] != [(PRODUCT, 4.0)]:
+            return f"lưu trữ {st.rows} dòng, tồn đọc lại {[(p.code, r.stock_after) for r, p in rows]}"
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+CHECKS = [
+    ("khoá ghi đồng thời (stress-xuat)", _check_locks),
+    ("ghi lùi ngày + replay", _check_backdated),
+    ("kiểm kê lùi ngày (tồn tại thời điểm)", _check_kiemke_as_of),
+    ("ghi lùi ngày trước kiểm kê thừa (giá BQ)", _check_backdated_before_kiemke),
+    ("tìm sản phẩm không dấu", _check_search),
+    ("cộng dồn daily_summary", _check_daily_summary),
+    ("khoá sổ + đọc lưu trữ", _check_close_period),
+]
+
+def check_db() -> list[tuple[str, str | None]]:
+    """
+    [(tên, lỗi hoặc None)]. DB đã có ledger -> ValueError (khoá sổ đụng tới mọi cửa hàng).
+    """
+    db = SessionLocal()
+    try:
+        if db.execute(select(models.Ledger.id).limit(1)).first():
+            raise ValueError(f"DB {engine.url.render_as_string()} đã có ledger: chỉ chạy check-db trên DB trống")
+        db.add(models.Store(code=STORE, name="Kiểm tra backend"))
+        db.add(models.Product(code=PRODUCT, name="Hàng thử", uom="kg", category_code=""))
+        db.add(models.Product(code=PRODUCT_KK, name="Kiểm kê thử", uom="kg", category_code=""))
+        db.commit()
+        md.invalidate()
+        out = []
+        for name, fn in CHECKS:
+            try:
+                out.append((name, fn(db)))
+            except Exception as e:
+                db.rollback()
+                out.append((name, repr(e)))
+        return out
+    finally:
+        db.close()
@@ -0,0 +1,130 @@
+"""
+Đo tải các trang báo cáo trên server đang chạy (uvicorn), so sánh nhiều server.
+Ví dụ so bản sync (revision cũ, cổng 8001) với bản async (cổng 8000), cùng 1 DB:
+    python -m app.cli bench-reports --url http://127.0.0.1:8001 --url http://127.0.0.1:8000 \
+        --concurrency 32 --requests 400
+Mỗi server: đăng nhập 1 lần, rồi mỗi trang gửi --requests request với --concurrency luồng.
+
+Đo template (trong tiến trình, không cần server):
+    python -m app.cli bench-templates [--rows 300] [--renders 500]
+"""
+from __future__ import annotations
+import http.cookiejar
+import statistics
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+REPORT_PATHS = ["/dashboard", "/baocao/ton", "/baocao/candoi", "/doanhthu", "/nhatky"]
+
+@dataclass
+class PathStats:
+    path: str
+    requests: int
+    errors: int
+    seconds: float
+    p50_ms: float
+    p95_ms: float
+
+    @property
+    def rps(self) -> float:
+        return self.requests / self.seconds if self.seconds else 0.0
+
+def _login(base_url: str, email: str, password: str) -> urllib.request.OpenerDirector:
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    data = urllib.parse.urlencode({"email": email, "password": password}).encode()
+    with opener.open(base_url + "/login", data=data, timeout=30) as r:
+        if not r.geturl().endswith("/dashboard"):
+            raise RuntimeError(f"Đăng nhập {base_url} thất bại")
+    return opener
+
+def _hit(opener, url: str) -> tuple[float, bool]:
+    t0 = time.perf_counter()
+    try:
+        with opener.open(url, timeout=60) as r:
+            r.read()
+            ok = r.status == 200
+    except Exception:
+        ok = False
+    return (time.perf_counter() - t0) * 1000, ok
+
+def bench_path(opener, base_url: str, path: str, requests: int, concurrency: int) -> PathStats:
+    url = base_url + path
+    _hit(opener, url)  # làm nóng cache danh mục / template
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: _hit(opener, url), range(requests)))
+    elapsed = time.perf_counter() - t0
+    lat = sorted(ms for ms, _ in results)
+    return PathStats(
+        path=path,
+        requests=requests,
+        errors=sum(1 for _, ok in results if not ok),
+        seconds=elapsed,
+        p50_ms=statistics.median(lat),
+        p95_ms=lat[min(len(lat) - 1, int(len(lat) * 0.95))],
+    )
+
+def bench_reports(
+    base_urls: list[str],
+    email: str,
+    password: str,
+    paths: list[str] | None = None,
+    requests: int = 200,
+    concurrency: int = 16,
+) -> dict[str, list[PathStats]]:
+    out = {}
+    for base in base_urls:
+        base = base.rstrip("/")
+        opener = _login(base, email, password)
+        out[base] = [bench_path(opener, base, p, requests, concurrency) for p in (paths or REPORT_PATHS)]
+    return out
+
+# --------- Template: thời gian compile lúc khởi động + render ---------
+def _percentile(samples: list[float], q: float) -> float:
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(len(s) * q))]
+
+def bench_templates(rows: int = 300, renders: int = 500) -> dict[str, float]:
+    """
+    - startup_*: compile toàn bộ template (không bytecode cache / bytecode cache đã có sẵn).
+    - render_*: trang baocao_ton với `rows` dòng; full = render cả bảng mỗi lần,
+      fragment = bảng lấy từ cache (chỉ render khung trang). Đơn vị ms.
+    """
+    from markupsafe import Markup
+    from . import models, templating
+
+    out: dict[str, float] = {}
+    saved_dir = templating.TEMPLATE_CACHE_DIR
+    with tempfile.TemporaryDirectory() as cache_dir:
+        templating.TEMPLATE_CACHE_DIR = cache_dir  # bytecode cache trống, không đụng cache thật
+        try:
+            t0 = time.perf_counter(); templating.precompile(templating.make_environment(bytecode_cache=False))
+            out["startup_no_bytecode_ms"] = (time.perf_counter() - t0) * 1000
+            templating.precompile(templating.make_environment())  # ghi bytecode
+            t0 = time.perf_counter(); env = templating.make_environment(); templating.precompile(env)
+            out["startup_bytecode_ms"] = (time.perf_counter() - t0) * 1000
+        finally:
+            templating.TEMPLATE_CACHE_DIR = saved_dir
+
+    env.globals["can"] = lambda user, perm: True
+    user = models.User(email="bench@example.com", display_name="Bench", role="SuperAdmin")
+    store = models.Store(code="216HS", name="216 Hồ Sen")
+    data = [dict(code=f"SP{i}", name=f"Sản phẩm {i}", uom="kg", qty=i * 1.5, avg=1000.0 + i, cups=0, value=i * 1500.0)
+            for i in range(rows)]
+    ctx = dict(user=user, store=store, stores=[store], as_of="")
+    page, table_tpl = env.get_template("baocao_ton.html"), env.get_template("_ton_table.html")
+    cached = Markup(table_tpl.render(rows=data, total=0.0))
+    for name, fn in (
+        ("full", lambda: page.render(table=Markup(table_tpl.render(rows=data, total=0.0)), **ctx)),
+        ("fragment", lambda: page.render(table=cached, **ctx)),
+    ):
+        samples = []
+        for _ in range(renders):
+            t0 = time.perf_counter(); fn(); samples.append((time.perf_counter() - t0) * 1000)
+        out[f"render_{name}_p50_ms"] = statistics.median(samples)
+        out[f"render_{name}_p99_ms"] = _percentile(samples, 0.99)
+    return out
@@ -1,18 +1,34 @@
-from fastapi import FastAPI, Request, Form, Depends, HTTPException, Query
-from fastapi.responses import RedirectResponse, HTMLResponse, StreamingResponse
+from fastapi import FastAPI, Request, Form, Depends, HTTPException, Query, Body, File, UploadFile
+from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-from .db import Base, engine, SessionLocal
+from markupsafe import Markup
+from .db import engine, SessionLocal, AsyncSessionLocal, read_concurrently
+from .migrations import run_migrations
+from .templating import make_environment, precompile
+from . import metrics
+from .metrics import MetricsMiddleware
 from . import models
-from sqlalchemy import select, func, desc
+from .services import archive, depreciation, fragments, masterdata as md, search, summary
+from .services.audit import audit_stmt, log_action, commit_with_audit, writer as audit_writer
+from .services.export import csv_response, rows_csv_response, iso
+from .services.importer import import_ledger
+from .services.inventory import (nhap, xuat, kiemke, get_balances, total_onhand, ensure_stock_balance, parse_batch_lines, apply_batch,
+                                 get_balances_as_of, total_onhand_as_of, total_onhand_by_store, get_balances_for_stores, ledger_version,
+                                 ledger_keys, ledger_details, reason_text, ledger_history_stmt, ledger_csv_stmt,
+                                 ledger_export_stmt)
+from sqlalchemy import select, desc
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta
+from urllib.parse import urlencode
 import hashlib, json, io, csv
+from contextlib import nullcontext
 
 app = FastAPI()
 app.add_middleware(SessionMiddleware, secret_key="dev-secret-change-me", same_site="lax")
+app.add_middleware(MetricsMiddleware)  # ngoài cùng: đo cả thời gian session middleware
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
-templates = Environment(loader=FileSystemLoader("app/templates"), autoescape=select_autoescape(["html"]))
+templates = make_environment()
 
 def hash_pw(p: str) -> str:
     return hashlib.sha256(("salt-" + p).encode()).hexdigest()
@@ -21,22 +37,39 @@ def get_db():
     db = SessionLocal()
     try: yield db
     finally: db.close()
-from fastapi import FastAPI
-app = FastAPI()
+
+async def get_async_db():
+    # Trang báo cáo chỉ đọc (async def): không chiếm thread của threadpool
+    async with AsyncSessionLocal() as db:
+        yield db
 
 @app.get("/healthz")
 def healthz():
     return {"ok": True}
-def log_action(db, user, action, detail):
-    db.add(models.AuditLog(user=user, action=action, detail=detail)); db.commit()
 
+@app.get("/metrics")
+def metrics_page(request: Request):
+    if metrics.TOKEN and request.headers.get("authorization") != f"Bearer {metrics.TOKEN}":
+        raise HTTPException(status_code=401)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 @app.on_event("startup")
 def startup():
-    Base.metadata.create_all(bind=engine)
+    precompile(templates)
+    run_migrations(engine)
     db = SessionLocal()
     if not db.execute(select(models.User).limit(1)).first():
-        seed(db)
+        try:
+            seed(db)
+        except IntegrityError:
+            db.rollback()  # node khác khởi động cùng lúc đã seed
+    ensure_stock_balance(db)
+    summary.ensure_daily_summary(db)
     db.close()
+    audit_writer.start()
+
+@app.on_event("shutdown")
+def shutdown():
+    audit_writer.stop()  # ghi nốt audit còn trong hàng đợi
 
 def seed(db):
     stores = [
@@ -72,10 +105,24 @@ def seed(db):
     db.commit()
 
 def require_login(request: Request, db):
+    # 1 lần tra user cho mỗi request; gọi lại trả về bản đã nạp
+    user = getattr(request.state, "user", None)
+    if user is not None: return user
     uid = request.session.get("uid")
     if not uid: raise HTTPException(status_code=401)
     user = db.get(models.User, uid)
     if not user: raise HTTPException(status_code=401)
+    request.state.user = user
+    return user
+
+async def require_login_async(request: Request, db):
+    user = getattr(request.state, "user", None)
+    if user is not None: return user
+    uid = request.session.get("uid")
+    if not uid: raise HTTPException(status_code=401)
+    user = await db.get(models.User, uid)
+    if not user: raise HTTPException(status_code=401)
+    request.state.user = user
     return user
 
 def can(user: models.User, perm: str) -> bool:
@@ -83,12 +130,24 @@ def can(user: models.User, perm: str) -> bool:
     perms = (user.permissions_csv or "").split(",") if user.permissions_csv else []
     return perm in perms
 
-def current_store(request: Request, user: models.User, db) -> models.Store:
+templates.globals["can"] = can  # base.html dựng menu theo quyền
+
+def _store_code(request: Request, user: models.User) -> str:
     if user.role == "User":
-        sc = user.store_code
-    else:
-        sc = request.session.get("store_code") or user.store_code or "216HS"
-    return db.execute(select(models.Store).where(models.Store.code == sc)).scalar_one()
+        return user.store_code
+    return request.session.get("store_code") or user.store_code or "216HS"
+
+def current_store(request: Request, user: models.User, db) -> models.Store:
+    sc = _store_code(request, user)
+    store = md.store(db, sc)
+    if not store: raise HTTPException(status_code=404, detail=f"Cửa hàng không tồn tại: {sc}")
+    return store
+
+async def current_store_async(request: Request, user: models.User, db) -> models.Store:
+    sc = _store_code(request, user)
+    store = await md.astore(db, sc)
+    if not store: raise HTTPException(status_code=404, detail=f"Cửa hàng không tồn tại: {sc}")
+    return store
 
 @app.get("/", response_class=HTMLResponse)
 def root(request: Request): return RedirectResponse("/login")
@@ -104,35 +163,71 @@ def login(request: Request, email: str = Form(...), password: str = Form(...), d
         tpl = templates.get_template("login.html"); return HTMLResponse(tpl.render(error="Email hoặc mật khẩu không đúng"))
     request.session["uid"] = u.id
     if u.role != "User": request.session["store_code"] = u.store_code or "216HS"
-    log_action(db, u.email, "LOGIN", "Đăng nhập")
+    log_action(u.email, "LOGIN", "Đăng nhập", u.store_code or request.session.get("store_code"))
     return RedirectResponse("/dashboard", status_code=302)
 
 @app.get("/logout")
 def logout(request: Request, db=Depends(get_db)):
     uid = request.session.get("uid"); user = db.get(models.User, uid) if uid else None
     request.session.clear()
-    if user: log_action(db, user.email, "LOGOUT", "Đăng xuất")
+    if user: log_action(user.email, "LOGOUT", "Đăng xuất", user.store_code)
     return RedirectResponse("/login")
 
 # ---------- UI Helpers ----------
 def render(tpl_name, **ctx):
     tpl = templates.get_template(tpl_name); return HTMLResponse(tpl.render(**ctx))
 
+def cached_fragment(key: tuple, html: str | None = None) -> Markup | None:
+    # Bảng báo cáo đã render (services/fragments): key = (loại, store_code, ..., ledger_version)
+    if html is None:
+        html = fragments.get(key)
+        return Markup(html) if html is not None else None
+    return Markup(fragments.put(key, html))
+
+def date_range(from_: str | None, to: str | None):
+    """
+    (date_from, date_to, df, dt_to): mặc định từ đầu tháng tới hôm nay; dt_to là cận trên loại trừ.
+    """
+    today = datetime.utcnow().date()
+    date_from = from_ or today.replace(day=1).isoformat()
+    date_to = to or today.isoformat()
+    return date_from, date_to, datetime.fromisoformat(date_from), datetime.fromisoformat(date_to) + timedelta(days=1)
+
+PAGE_SIZE = 200
+
+def keyset_page(db, stmt, id_col, before: int | None, limit: int = PAGE_SIZE):
+    """
+    Phân trang theo id giảm dần (keyset): trả về (rows, cursor trang sau hoặc None).
+    """
+    limit = max(1, min(limit or PAGE_SIZE, 1000))
+    if before:
+        stmt = stmt.where(id_col < before)
+    rows = db.execute(stmt.order_by(id_col.desc()).limit(limit + 1)).scalars().all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, (rows[-1].id if more and rows else None)
+
+def page_url(path: str, params: dict, before: int) -> str:
+    q = {k: v for k, v in params.items() if v not in (None, "")}
+    q["before"] = before
+    return f"{path}?{urlencode(q)}"
+
+def stores_in_scope(user, store, store_codes: list[str]) -> list[str]:
+    # Chỉ Admin/SuperAdmin được xuất nhiều cửa hàng
+    return store_codes if (store_codes and user.role != "User") else [store.code]
+
 # ---------- Dashboard ----------
 @app.get("/dashboard", response_class=HTMLResponse)
-def dashboard(request: Request, db=Depends(get_db)):
-    user = require_login(request, db)
-    stores = db.execute(select(models.Store)).scalars().all()
-    store = current_store(request, user, db)
-    last = db.execute(select(models.Ledger.product_code, func.max(models.Ledger.id)).where(models.Ledger.store_code==store.code).group_by(models.Ledger.product_code)).all()
-    total_onhand = 0.0
-    for code, mid in last:
-        row = db.get(models.Ledger, mid)
-        if row: total_onhand += (row.onhand_value or 0.0)
+async def dashboard(request: Request, db=Depends(get_async_db)):
+    user = await require_login_async(request, db)
+    stores = await md.astores(db)
+    store = await current_store_async(request, user, db)
     today = datetime.utcnow().date()
-    revs = db.execute(select(func.sum(models.Revenue.cash), func.sum(models.Revenue.bank)).where(models.Revenue.store_code==store.code, models.Revenue.date >= today, models.Revenue.date < today+timedelta(days=1))).first()
-    rev_today = (revs[0] or 0.0) + (revs[1] or 0.0)
-    return render("dashboard.html", user=user, stores=stores, store=store, total_onhand=round(total_onhand,0), rev_today=round(rev_today,0))
+    onhand, rev_today = await read_concurrently(db,
+        (total_onhand, store.code),
+        (summary.revenue_total, store.code, today, today),
+    )
+    return render("dashboard.html", user=user, stores=stores, store=store, total_onhand=round(onhand,0), rev_today=round(rev_today,0))
 
 @app.post("/switch-store")
 def switch_store(request: Request, store_code: str = Form(...), db=Depends(get_db)):
@@ -145,7 +240,7 @@ def switch_store(request: Request, store_code: str = Form(...), db=Depends(get_d
 @app.get("/me/password", response_class=HTMLResponse)
 def me_password_page(request: Request, db=Depends(get_db), msg: str = ""):
     user = require_login(request, db)
-    stores = db.execute(select(models.Store)).scalars().all()
+    stores = md.stores(db)
     store = current_store(request, user, db)
     return render("me_password.html", user=user, stores=stores, store=store, msg=msg)
 
@@ -158,25 +253,24 @@ def me_password(request: Request, oldpw: str = Form(...), newpw: str = Form(...)
     return RedirectResponse("/me/password?msg=Đổi mật khẩu thành công", status_code=302)
 
 # ---------- Inventory (Kho) ----------
-from .services.inventory import write_ledger
-
 @app.get("/kho", response_class=HTMLResponse)
 def kho_page(request: Request, q: str | None = None, db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"KHO"): return render("toast.html", message="Không có quyền truy cập")
     store = current_store(request, user, db)
-    prods = db.execute(select(models.Product).order_by(models.Product.name)).scalars().all()
-    if q:
-        prods = [p for p in prods if q.lower() in (p.name + " " + p.code).lower()]
-    return render("kho.html", user=user, store=store, stores=db.execute(select(models.Store)).scalars().all(), prods=prods, q=q or "")
+    prods = search.search_products(db, q) if q else md.products(db)
+    return render("kho.html", user=user, store=store, stores=md.stores(db), prods=prods, q=q or "")
 
 @app.post("/kho/nhap")
 def kho_import(request: Request, product_code: str = Form(...), qty: float = Form(...), price: float = Form(...), note: str = Form(""), db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"KHO"): return RedirectResponse("/kho", status_code=302)
     store = current_store(request, user, db)
-    write_ledger(db, store.code, product_code, qty_in=qty, price_in=price, qty_out=0.0, reason=f"Nhập kho{(' - '+note) if note else ''}")
-    log_action(db, user.email, "IMPORT", f"{product_code} {qty} @ {price} {store.code}")
+    try:
+        nhap(db, store_code=store.code, product_code=product_code, qty=qty, price=price, note=note, created_by=user.email)
+    except ValueError as e:
+        return render("toast.html", message=str(e))
+    commit_with_audit(db, user.email, "IMPORT", f"{product_code} {qty} @ {price} {store.code}", store.code)
     return RedirectResponse("/kho", status_code=302)
 
 @app.post("/kho/xuat")
@@ -185,10 +279,10 @@ def kho_export(request: Request, product_code: str = Form(...), qty: float = For
     if not can(user,"KHO"): return RedirectResponse("/kho", status_code=302)
     store = current_store(request, user, db)
     try:
-        write_ledger(db, store.code, product_code, qty_in=0.0, price_in=0.0, qty_out=qty, reason=reason)
+        xuat(db, store_code=store.code, product_code=product_code, qty=qty, note=reason, created_by=user.email)
     except Exception as e:
         return render("toast.html", message=str(e))
-    log_action(db, user.email, "EXPORT", f"{product_code} {qty} {reason} {store.code}")
+    commit_with_audit(db, user.email, "EXPORT", f"{product_code} {qty} {reason} {store.code}", store.code)
     return RedirectResponse("/kho", status_code=302)
 
 @app.post("/kho/kiemke")
@@ -197,33 +291,134 @@ def kho_physical(request: Request, product_code: str = Form(...), actual: float
     if not can(user,"KHO"): return RedirectResponse("/kho", status_code=302)
     store = current_store(request, user, db)
     # adjust to actual using current avg price
-    from .services.inventory import get_latest_stock
-    stock, avg, onhand = get_latest_stock(db, store.code, product_code)
-    delta = actual - stock
-    if abs(delta) < 1e-9:
+    try:
+        e = kiemke(db, store_code=store.code, product_code=product_code, actual=actual, created_by=user.email)
+    except ValueError as ex:
+        return render("toast.html", message=str(ex))
+    if e is None:
         return RedirectResponse("/kho", status_code=302)
-    if delta > 0:
-        write_ledger(db, store.code, product_code, qty_in=delta, price_in=avg, qty_out=0.0, reason=f"Kiểm kê (+)")
-    else:
-        write_ledger(db, store.code, product_code, qty_in=0.0, price_in=0.0, qty_out=-delta, reason=f"Kiểm kê (-)")
-    log_action(db, user.email, "INVENTORY", f"{product_code}={actual}")
+    commit_with_audit(db, user.email, "INVENTORY", f"{product_code}={actual}", store.code)
+    return RedirectResponse("/kho", status_code=302)
+
+@app.post("/kho/batch")
+def kho_batch(request: Request, lines: list[dict] = Body(..., embed=True), kind: str = Body("nhap", embed=True), db=Depends(get_db)):
+    user = require_login(request, db)
+    if not can(user,"KHO"): raise HTTPException(status_code=403)
+    store = current_store(request, user, db)
+    try:
+        n = apply_batch(db, store_code=store.code, lines=parse_batch_lines(lines, kind), created_by=user.email)
+    except ValueError as e:
+        db.rollback()
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    commit_with_audit(db, user.email, "BATCH", f"{n} dòng {kind} {store.code}", store.code)
+    return {"ok": True, "count": n}
+
+@app.post("/kho/batch/upload")
+def kho_batch_upload(request: Request, file: UploadFile = File(...), kind: str = Form("nhap"), db=Depends(get_db)):
+    user = require_login(request, db)
+    if not can(user,"KHO"): return RedirectResponse("/kho", status_code=302)
+    store = current_store(request, user, db)
+    text = file.file.read().decode("utf-8-sig")
+    try:
+        n = apply_batch(db, store_code=store.code, lines=parse_batch_lines(csv.DictReader(io.StringIO(text)), kind), created_by=user.email)
+    except ValueError as e:
+        db.rollback()
+        return render("toast.html", message=str(e))
+    commit_with_audit(db, user.email, "BATCH", f"{n} dòng {kind} {store.code} ({file.filename})", store.code)
     return RedirectResponse("/kho", status_code=302)
 
+@app.post("/kho/import")
+def kho_import_file(request: Request, file: UploadFile = File(...), kind: str = Form("nhap"), dry_run: bool = Form(False), db=Depends(get_db)):
+    user = require_login(request, db)
+    if not can(user,"KHO"): return RedirectResponse("/kho", status_code=302)
+    store = current_store(request, user, db)
+    src = io.TextIOWrapper(file.file, encoding="utf-8-sig", newline="")
+    try:
+        st = import_ledger(db, src, default_store=store.code, default_kind=kind, created_by=user.email, dry_run=dry_run,
+                           allowed_stores=None if user.role != "User" else [store.code])
+    except ValueError as e:
+        db.rollback()
+        return render("toast.html", message=f"{e} (không ghi dòng nào)")
+    if dry_run:
+        db.rollback()
+        errs = "; ".join(st.errors[:10])
+        return render("toast.html", message=f"Kiểm tra {st.lines} dòng: {len(st.errors)} lỗi. {errs}")
+    commit_with_audit(db, user.email, "IMPORT_FILE", f"{st.written} dòng ({file.filename})", store.code)
+    return render("toast.html", message=f"Đã nhập {st.written} dòng / {st.pairs} mã ({st.seconds:.1f}s)")
+
 @app.get("/kho/lichsu/{product_code}", response_class=HTMLResponse)
-def kho_history(request: Request, product_code: str, db=Depends(get_db)):
+def kho_history(request: Request, product_code: str, before: int | None = None,
+                from_: str | None = Query(None, alias="from"), to: str | None = Query(None, alias="to"),
+                reason: str = "", by: str = "", archived: bool = False, limit: int = PAGE_SIZE, db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"KHO"): return render("toast.html", message="Không có quyền truy cập")
     store = current_store(request, user, db)
-    rows = db.execute(select(models.Ledger).where(models.Ledger.store_code==store.code, models.Ledger.product_code==product_code).order_by(models.Ledger.id.desc()).limit(200)).scalars().all()
-    return render("kho_history.html", user=user, store=store, stores=db.execute(select(models.Store)).scalars().all(), rows=rows, product_code=product_code)
+    filters = {"from": from_, "to": to, "reason": reason, "by": by, "archived": 1 if archived else None,
+               "limit": limit if limit != PAGE_SIZE else None}
+    # Khoá sổ không đổi id dòng ledger còn lại -> mốc khoá sổ cũng nằm trong khoá cache
+    closed = archive.closed_before(db)
+    key = ("lichsu", store.code, product_code, ledger_version(db, store.code, product_code), closed, before, *filters.values())
+    table = cached_fragment(key)
+    if table is None:
+        L = models.Ledger
+        try:
+            sid, pid = ledger_keys(db, store.code, product_code)
+        except ValueError as e:
+            return render("toast.html", message=str(e))
+        stmt = ledger_history_stmt(
+            sid, pid, reason=reason, by=by, by_uid=md.user_id(db, by) if by else None,
+            d_from=datetime.fromisoformat(from_) if from_ else None,
+            d_to=datetime.fromisoformat(to) + timedelta(days=1) if to else None,
+        )
+        # archived: cùng truy vấn trên file lưu trữ (ATTACH chỉ đọc, view ledger/ ledger_notes gộp các năm)
+        with (archive.open_archives(db) if archived else nullcontext(db)) as src:
+            rows, cursor = keyset_page(src, stmt, L.id, before, limit) if src is not None else ([], None)
+            details = ledger_details(db, rows, notes_db=src)
+        path = f"/kho/lichsu/{product_code}"
+        next_url = page_url(path, filters, cursor) if cursor else None
+        table = cached_fragment(key, templates.get_template("_kho_history_table.html").render(
+            rows=rows, details=details, product_code=product_code, next_url=next_url, paged=bool(before),
+            first_url=path + ("?archived=1" if archived else "")))
+    return render("kho_history.html", user=user, store=store, stores=md.stores(db), table=table, product_code=product_code,
+                  filters=filters, closed=closed)
+
+LEDGER_CSV_HEADER = ["date","store","product_code","product_name","uom","qty_in","price_in","qty_out","reason","stock_after","avg_price","onhand_value","cups","production_id","created_by"]
+
+def _ledger_csv_row(r):
+    return (iso(r[0]),) + tuple(r[1:8]) + (reason_text(r[8], r[9]),) + tuple(r[10:15]) + (r[15] or "",)
+
+@app.get("/kho/lichsu/{product_code}/export")
+def kho_history_export(request: Request, product_code: str, db=Depends(get_db)):
+    user = require_login(request, db)
+    if not can(user,"KHO"): return RedirectResponse("/kho", status_code=302)
+    store = current_store(request, user, db)
+    L = models.Ledger
+    try:
+        sid, pid = ledger_keys(db, store.code, product_code)
+    except ValueError as e:
+        return render("toast.html", message=str(e))
+    stmt = ledger_csv_stmt().where(L.store_id==sid, L.product_id==pid).order_by(L.id)
+    return csv_response(stmt, LEDGER_CSV_HEADER, f"ledger_{store.code}_{product_code}.csv", _ledger_csv_row)
+
+@app.get("/kho/export")
+def kho_export_csv(request: Request, from_: str | None = Query(None, alias="from"), to: str | None = Query(None, alias="to"),
+                   store_codes: list[str] = Query([], alias="store"), db=Depends(get_db)):
+    user = require_login(request, db)
+    if not can(user,"KHO"): return RedirectResponse("/kho", status_code=302)
+    codes = stores_in_scope(user, current_store(request, user, db), store_codes)
+    date_from, date_to, df, dt_to = date_range(from_, to)
+    store_ids = [md.store(db, c).id for c in codes if md.store(db, c)]
+    stmt = ledger_export_stmt(store_ids, df, dt_to)
+    return csv_response(stmt, LEDGER_CSV_HEADER, f"ledger_{'_'.join(codes)}_{date_from}_to_{date_to}.csv", _ledger_csv_row)
 
 # ---------- Master Data (DM) ----------
 @app.get("/dm/stores", response_class=HTMLResponse)
 def dm_stores(request: Request, db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"DM"): return render("toast.html", message="Không có quyền truy cập")
-    rows = db.execute(select(models.Store).order_by(models.Store.name)).scalars().all()
-    return render("dm_stores.html", user=user, stores=db.execute(select(models.Store)).scalars().all(), store=current_store(request,user,db), rows=rows)
+    stores = md.stores(db)
+    rows = sorted(stores, key=lambda s: s.name)
+    return render("dm_stores.html", user=user, stores=stores, store=current_store(request,user,db), rows=rows)
 
 @app.post("/dm/stores/add")
 def dm_stores_add(request: Request, code: str = Form(...), name: str = Form(...), address: str = Form(""), allow_production: int = Form(1), db=Depends(get_db)):
@@ -231,35 +426,46 @@ def dm_stores_add(request: Request, code: str = Form(...), name: str = Form(...)
     if not can(user,"DM"): return RedirectResponse("/dm/stores", status_code=302)
     db.add(models.Store(code=code, name=name, address=address, allow_production=bool(int(allow_production))))
     db.commit()
+    md.invalidate("stores")
     return RedirectResponse("/dm/stores", status_code=302)
 
 @app.get("/dm/categories", response_class=HTMLResponse)
 def dm_categories(request: Request, db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"DM"): return render("toast.html", message="Không có quyền truy cập")
-    rows = db.execute(select(models.Category).order_by(models.Category.name)).scalars().all()
-    return render("dm_categories.html", user=user, stores=db.execute(select(models.Store)).scalars().all(), store=current_store(request,user,db), rows=rows)
+    rows = md.categories(db)
+    return render("dm_categories.html", user=user, stores=md.stores(db), store=current_store(request,user,db), rows=rows)
 
 @app.post("/dm/categories/add")
 def dm_categories_add(request: Request, code: str = Form(...), name: str = Form(...), db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"DM"): return RedirectResponse("/dm/categories", status_code=302)
     db.add(models.Category(code=code, name=name)); db.commit()
+    md.invalidate("categories")
     return RedirectResponse("/dm/categories", status_code=302)
 
 @app.get("/dm/products", response_class=HTMLResponse)
 def dm_products(request: Request, db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"DM"): return render("toast.html", message="Không có quyền truy cập")
-    cats = db.execute(select(models.Category).order_by(models.Category.name)).scalars().all()
-    rows = db.execute(select(models.Product).order_by(models.Product.name)).scalars().all()
-    return render("dm_products.html", user=user, stores=db.execute(select(models.Store)).scalars().all(), store=current_store(request,user,db), rows=rows, cats=cats)
+    cats = md.categories(db)
+    rows = md.products(db)
+    return render("dm_products.html", user=user, stores=md.stores(db), store=current_store(request,user,db), rows=rows, cats=cats)
+
+@app.get("/dm/products/search")
+def dm_products_search(request: Request, q: str = "", limit: int = 10, db=Depends(get_db)):
+    # Gợi ý khi gõ (typeahead) cho trang kho: không dấu, theo tiền tố
+    user = require_login(request, db)
+    if not can(user,"KHO") and not can(user,"DM"): raise HTTPException(status_code=403)
+    rows = search.search_products(db, q, min(max(1, limit), search.SEARCH_LIMIT))
+    return [dict(code=p.code, name=p.name, uom=p.uom) for p in rows]
 
 @app.post("/dm/products/add")
 def dm_products_add(request: Request, code: str = Form(...), name: str = Form(...), uom: str = Form(...), category_code: str = Form(...), db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"DM"): return RedirectResponse("/dm/products", status_code=302)
     db.add(models.Product(code=code, name=name, uom=uom, category_code=category_code)); db.commit()
+    md.invalidate("products")
     return RedirectResponse("/dm/products", status_code=302)
 
 # ---------- Users & permissions ----------
@@ -268,7 +474,7 @@ def users_page(request: Request, db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"USERS"): return render("toast.html", message="Không có quyền truy cập")
     rows = db.execute(select(models.User)).scalars().all()
-    stores = db.execute(select(models.Store)).scalars().all()
+    stores = md.stores(db)
     return render("users.html", user=user, store=current_store(request,user,db), stores=stores, rows=rows)
 
 @app.post("/users/add")
@@ -278,6 +484,7 @@ def users_add(request: Request, email: str = Form(...), display_name: str = Form
     csv = ",".join(perms) if isinstance(perms, list) else perms
     db.add(models.User(email=email, display_name=display_name, role=role, store_code=(store_code or None), permissions_csv=csv, password_hash=hash_pw(password)))
     db.commit()
+    md.invalidate("users")
     return RedirectResponse("/users", status_code=302)
 
 # ---------- Formulas ----------
@@ -285,12 +492,12 @@ def users_add(request: Request, email: str = Form(...), display_name: str = Form
 def formula_page(request: Request, db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"SẢNXUẤT"): return render("toast.html", message="Không có quyền truy cập")
-    prods = db.execute(select(models.Product).order_by(models.Product.name)).scalars().all()
+    prods = md.products(db)
     fruits = [p for p in prods if p.category_code=="TRÁI_CÂY"]
     outputs = [p for p in prods if p.category_code in ("CỐT","MỨT")]
     additives = [p for p in prods if p.category_code in ("PHỤ_GIA","CỐT")]
     formulas = db.execute(select(models.Formula)).scalars().all()
-    return render("congthuc.html", user=user, store=current_store(request,user,db), stores=db.execute(select(models.Store)).scalars().all(), fruits=fruits, outputs=outputs, additives=additives, formulas=formulas)
+    return render("congthuc.html", user=user, store=current_store(request,user,db), stores=md.stores(db), fruits=fruits, outputs=outputs, additives=additives, formulas=formulas)
 
 @app.post("/congthuc/add")
 def formula_add(request: Request,
@@ -304,10 +511,13 @@ def formula_add(request: Request,
     db.add(models.Formula(code=code, name=name, kind=kind, output_product_code=output_product_code, output_uom=output_uom,
                           yield_factor=yield_factor, cups_per_kg=cups_per_kg, fruits_csv=fruits_csv, additives_json=additives_json, note=note))
     db.commit()
+    invalidate_formula_cache()
     return RedirectResponse("/congthuc", status_code=302)
 
 # ---------- Production ----------
-from .services.production import start_production, preview_additives, complete_jam
+from .services.production import (start_production, complete_jam, production_cost,
+                                  preview_runs, invalidate_formula_cache)
+from .services import planner
 
 @app.get("/sanxuat", response_class=HTMLResponse)
 def production_page(request: Request, db=Depends(get_db)):
@@ -316,14 +526,48 @@ def production_page(request: Request, db=Depends(get_db)):
     store = current_store(request, user, db)
     formulas = db.execute(select(models.Formula)).scalars().all()
     wips = db.execute(select(models.ProductionLog).where(models.ProductionLog.store_code==store.code, models.ProductionLog.status=="WIP")).scalars().all()
-    return render("sanxuat.html", user=user, store=store, stores=db.execute(select(models.Store)).scalars().all(), formulas=formulas, wips=wips)
+    return render("sanxuat.html", user=user, store=store, stores=md.stores(db), formulas=formulas, wips=wips)
 
 @app.post("/sanxuat/preview", response_class=HTMLResponse)
 def production_preview(request: Request, formula_code: str = Form(...), kg_sau: float = Form(...), db=Depends(get_db)):
-    f = db.execute(select(models.Formula).where(models.Formula.code==formula_code)).scalar_one()
-    addons = preview_additives(f, kg_sau)
+    try:
+        addons = preview_runs(db, [(formula_code, kg_sau)])[0]["additives"]
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     return HTMLResponse(json.dumps(addons, ensure_ascii=False))
 
+@app.post("/sanxuat/preview/batch")
+def production_preview_batch(request: Request, runs: list[dict] = Body(..., embed=True), db=Depends(get_db)):
+    """
+    runs = [{"formula_code": "CT_COT_ND", "kg_sau": 10}, ...]
+    """
+    try:
+        pairs = [(str(r["formula_code"]), float(r.get("kg_sau") or 0.0)) for r in runs]
+        return {"ok": True, "runs": preview_runs(db, pairs)}
+    except (KeyError, TypeError, ValueError) as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+
+@app.post("/sanxuat/plan")
+def production_plan(request: Request, runs: list[dict] = Body(..., embed=True), db=Depends(get_db)):
+    """
+    runs = [{"store": "216HS", "formula_code": "CT_COT_ND", "kg_sau": 10, "fruits": {"XOAI": 6}}, ...]
+    store bỏ trống = cửa hàng hiện tại; User chỉ lập kế hoạch cho cửa hàng của mình.
+    """
+    user = require_login(request, db)
+    if not can(user,"SẢNXUẤT"): return JSONResponse({"ok": False, "error": "Không có quyền"}, status_code=403)
+    store = current_store(request, user, db)
+    try:
+        plan_runs = [planner.Run(store_code=str(r.get("store") or store.code), formula_code=str(r["formula_code"]),
+                                 kg_sau=float(r.get("kg_sau") or 0.0),
+                                 fruits=None if r.get("fruits") is None else {str(k): float(v) for k, v in r["fruits"].items()})
+                     for r in runs]
+        for sc in {r.store_code for r in plan_runs}:
+            if sc not in stores_in_scope(user, store, [sc]) or not md.store(db, sc):
+                raise ValueError(f"Cửa hàng không hợp lệ: {sc}")
+        return {"ok": True, **planner.plan(db, plan_runs)}
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+
 @app.post("/sanxuat/start")
 def production_start(request: Request,
     formula_code: str = Form(...), kg_sau: float = Form(...),
@@ -333,25 +577,39 @@ def production_start(request: Request,
     store = current_store(request, user, db)
     f = db.execute(select(models.Formula).where(models.Formula.code==formula_code)).scalar_one()
     inputs = json.loads(fruits_raw or "{}")
-    plog = start_production(db, store.code, f, inputs, kg_sau, user.email, note)
-    # Cost: approximate – sum qty_out*avg_price for entries since last 2 minutes containing this formula code
-    since = datetime.utcnow() - timedelta(minutes=2)
-    q = db.execute(select(models.Ledger).where(models.Ledger.store_code==store.code, models.Ledger.date >= since)).scalars().all()
-    cost = 0.0
-    for e in q:
-        if f.code in (e.reason or ""):
-            cost += (e.qty_out or 0.0) * (e.avg_price or 0.0)
+    try:
+        plog = start_production(db, store.code, f, inputs, kg_sau, user.email, note)
+    except ValueError as e:
+        db.rollback()
+        return render("toast.html", message=str(e))
+    # Cost: NVL/PG xuất cho đúng lô này (ledger.production_id)
+    cost = production_cost(db, plog.id)
     if f.kind == "CỐT":
         kg_tp = kg_sau * (f.yield_factor or 1.0)
         unit_cost = (cost / kg_tp) if kg_tp>0 else 0.0
         cups = kg_tp * (f.cups_per_kg or 0.0)
-        from .services.inventory import write_ledger
-        write_ledger(db, store.code, f.output_product_code, qty_in=kg_tp, price_in=unit_cost, qty_out=0.0, reason=f"Nhập TP CỐT {f.code}", cups=cups)
-        log_action(db, user.email, "PROD_FINISH", f"CỐT {f.code} kg_tp={kg_tp} đơn_giá={unit_cost}")
+        nhap(db, store_code=store.code, product_code=f.output_product_code, qty=kg_tp, price=unit_cost, reason=models.Reason.SX_NHAP, note=f"CỐT {f.code}", created_by=user.email, cups=cups, production_id=plog.id)
+        plog.kg_tp = kg_tp; plog.cups = cups
+        commit_with_audit(db, user.email, "PROD_FINISH", f"CỐT {f.code} kg_tp={kg_tp} đơn_giá={unit_cost}", store.code)
     else:
-        log_action(db, user.email, "PROD_WIP", f"Tạo lô WIP {plog.batch_id} {f.code}")
+        commit_with_audit(db, user.email, "PROD_WIP", f"Tạo lô WIP {plog.batch_id} {f.code}", store.code)
     return RedirectResponse("/sanxuat", status_code=302)
 
+@app.get("/sanxuat/export")
+def production_export(request: Request, from_: str | None = Query(None, alias="from"), to: str | None = Query(None, alias="to"),
+                      store_codes: list[str] = Query([], alias="store"), db=Depends(get_db)):
+    user = require_login(request, db)
+    if not can(user,"SẢNXUẤT"): return RedirectResponse("/sanxuat", status_code=302)
+    codes = stores_in_scope(user, current_store(request, user, db), store_codes)
+    date_from, date_to, df, dt_to = date_range(from_, to)
+    PL = models.ProductionLog
+    stmt = select(PL.id, PL.date, PL.store_code, PL.batch_id, PL.kind, PL.formula_code, PL.formula_name, PL.fruits_json,
+                  PL.kg_sau, PL.additives_json, PL.kg_tp, PL.cups, PL.status, PL.created_by, PL.note
+                  ).where(PL.store_code.in_(codes), PL.date >= df, PL.date < dt_to).order_by(PL.id)
+    return csv_response(stmt, ["id","date","store","batch_id","kind","formula_code","formula_name","fruits","kg_sau",
+                               "additives","kg_tp","cups","status","created_by","note"],
+                        f"production_{date_from}_to_{date_to}.csv", lambda r: (r[0], iso(r[1])) + tuple(r[2:]))
+
 @app.post("/sanxuat/complete")
 def production_complete(request: Request, batch_id: str = Form(...), kg_tp: float = Form(...), db=Depends(get_db)):
     user = require_login(request, db)
@@ -359,30 +617,26 @@ def production_complete(request: Request, batch_id: str = Form(...), kg_tp: floa
     store = current_store(request, user, db)
     log = db.execute(select(models.ProductionLog).where(models.ProductionLog.batch_id==batch_id)).scalar_one()
     f = db.execute(select(models.Formula).where(models.Formula.code==log.formula_code)).scalar_one()
-    q = db.execute(select(models.Ledger).where(models.Ledger.store_code==store.code, models.Ledger.date >= log.date)).scalars().all()
-    cost = 0.0
-    for e in q:
-        if f.code in (e.reason or ""):
-            cost += (e.qty_out or 0.0) * (e.avg_price or 0.0)
+    cost = production_cost(db, log.id)
     unit_cost = (cost / kg_tp) if kg_tp>0 else 0.0
-    cups = complete_jam(db, store.code, batch_id, kg_tp, unit_cost, f.cups_per_kg or 0.0, f.output_product_code)
-    log_action(db, user.email, "PROD_FINISH", f"Hoàn thành MỨT {batch_id} kg_tp={kg_tp} đơn_giá={unit_cost}")
+    try:
+        cups = complete_jam(db, store.code, batch_id, kg_tp, unit_cost, f.cups_per_kg or 0.0, f.output_product_code, user.email)
+    except ValueError as e:
+        db.rollback()
+        return render("toast.html", message=str(e))
+    commit_with_audit(db, user.email, "PROD_FINISH", f"Hoàn thành MỨT {batch_id} kg_tp={kg_tp} đơn_giá={unit_cost}", store.code)
     return RedirectResponse("/sanxuat", status_code=302)
 
 # ---------- Revenue ----------
 @app.get("/doanhthu", response_class=HTMLResponse)
-def revenue_page(request: Request, from_: str | None = Query(None, alias="from"), to: str | None = Query(None, alias="to"), db=Depends(get_db)):
-    user = require_login(request, db)
+async def revenue_page(request: Request, from_: str | None = Query(None, alias="from"), to: str | None = Query(None, alias="to"), db=Depends(get_async_db)):
+    user = await require_login_async(request, db)
     if not can(user,"DOANHTHU"): return render("toast.html", message="Không có quyền truy cập")
-    store = current_store(request, user, db)
-    today = datetime.utcnow().date()
-    date_from = from_ or today.replace(day=1).isoformat()
-    date_to = to or today.isoformat()
-    df = datetime.fromisoformat(date_from)
-    dt_to = datetime.fromisoformat(date_to) + timedelta(days=1)
-    rows = db.execute(select(models.Revenue).where(models.Revenue.store_code==store.code, models.Revenue.date >= df, models.Revenue.date < dt_to).order_by(desc(models.Revenue.date))).scalars().all()
-    total_cash = sum(r.cash for r in rows); total_bank = sum(r.bank for r in rows)
-    return render("doanhthu.html", user=user, store=store, stores=db.execute(select(models.Store)).scalars().all(),
+    store = await current_store_async(request, user, db)
+    date_from, date_to, df, dt_to = date_range(from_, to)
+    rows = (await db.execute(select(models.Revenue).where(models.Revenue.store_code==store.code, models.Revenue.date >= df, models.Revenue.date < dt_to).order_by(desc(models.Revenue.date)))).scalars().all()
+    total_cash, total_bank = await db.run_sync(summary.revenue_totals, store.code, df.date(), (dt_to - timedelta(days=1)).date())
+    return render("doanhthu.html", user=user, store=store, stores=await md.astores(db),
                   rows=rows, total_cash=total_cash, total_bank=total_bank, total_all=total_cash+total_bank,
                   date_from=date_from, date_to=date_to)
 
@@ -391,9 +645,11 @@ def revenue_add(request: Request, cash: float = Form(0.0), bank: float = Form(0.
     user = require_login(request, db)
     if not can(user,"DOANHTHU"): return RedirectResponse("/doanhthu", status_code=302)
     store = current_store(request, user, db)
-    r = models.Revenue(store_code=store.code, cash=cash, bank=bank, note=note, created_by=user.email)
-    db.add(r); db.commit()
-    log_action(db, user.email, "REVENUE", f"TM={cash} CK={bank} {store.code}")
+    r = models.Revenue(date=models.now(), store_code=store.code, cash=cash, bank=bank, note=note, created_by=user.email)
+    db.add(r)
+    summary.add_daily(db, store.code, r.date.date(), cash=cash, bank=bank)
+    db.commit()
+    log_action(user.email, "REVENUE", f"TM={cash} CK={bank} {store.code}", store.code)
     return RedirectResponse("/doanhthu", status_code=302)
 
 @app.get("/doanhthu/export")
@@ -401,86 +657,118 @@ def doanhthu_export(
     request: Request,
     from_: str | None = Query(None, alias="from"),
     to: str | None = Query(None, alias="to"),
-    db: Session = Depends(get_db)
+    db=Depends(get_db)
 ):
     user = require_login(request, db)
     if not can(user, "DOANHTHU"):
         return RedirectResponse("/doanhthu", status_code=302)
-
-    today = datetime.utcnow().date()
-    date_from = from_ or today.replace(day=1).isoformat()
-    date_to = to or today.isoformat()
-
-    df = datetime.fromisoformat(date_from)
-    dt_to = datetime.fromisoformat(date_to) + timedelta(days=1)
-
-    rows = db.query(models.Revenue).filter(
-        models.Revenue.store_code == user.store_code,
-        models.Revenue.date >= df,
-        models.Revenue.date < dt_to
-    ).order_by(models.Revenue.date.desc()).all()
-
-    # Ghi CSV an toàn bằng csv.writer
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["date","store","cash","bank","note","created_by"])
-    for r in rows:
-        writer.writerow([
-            r.date.isoformat(),
-            r.store_code,
-            r.cash,
-            r.bank,
-            (r.note or ""),
-            (r.created_by or "")
-        ])
-    output.seek(0)
-
-    filename = f"revenue_{date_from}_to_{date_to}.csv"
-    return StreamingResponse(
-        output,
-        media_type="text/csv",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
-    )
+    store = current_store(request, user, db)
+    date_from, date_to, df, dt_to = date_range(from_, to)
+    R = models.Revenue
+    stmt = select(R.date, R.store_code, R.cash, R.bank, R.note, R.created_by).where(
+        R.store_code == store.code, R.date >= df, R.date < dt_to
+    ).order_by(R.date.desc())
+    return csv_response(stmt, ["date","store","cash","bank","note","created_by"], f"revenue_{date_from}_to_{date_to}.csv",
+                        lambda r: (iso(r[0]), r[1], r[2], r[3], r[4] or "", r[5] or ""))
 
 # ---------- Reports ----------
 @app.get("/baocao/ton", response_class=HTMLResponse)
-def report_stock(request: Request, db=Depends(get_db)):
-    user = require_login(request, db)
+async def report_stock(request: Request, as_of: str | None = None, db=Depends(get_async_db)):
+    user = await require_login_async(request, db)
     if not (can(user,"BAOCAO") or can(user,"KHO")): return render("toast.html", message="Không có quyền truy cập")
-    store = current_store(request, user, db)
-    last = db.execute(select(models.Ledger.product_code, func.max(models.Ledger.id)).where(models.Ledger.store_code==store.code).group_by(models.Ledger.product_code)).all()
-    rows = []
-    for code, mid in last:
-        e = db.get(models.Ledger, mid)
-        if not e: continue
-        p = db.execute(select(models.Product).where(models.Product.code==code)).scalar_one()
-        cups = e.cups if p.category_code in ("CỐT","MỨT") else 0
-        rows.append(dict(code=code, name=p.name, uom=p.uom, qty=e.stock_after, avg=e.avg_price, cups=cups, value=e.onhand_value))
-    rows.sort(key=lambda x: x["name"])
-    total = sum(r["value"] or 0.0 for r in rows)
-    return render("baocao_ton.html", user=user, store=store, stores=db.execute(select(models.Store)).scalars().all(), rows=rows, total=total)
+    store = await current_store_async(request, user, db)
+    key = ("ton", store.code, as_of or "", await db.run_sync(ledger_version, store.code))
+    table = cached_fragment(key)
+    if table is None:
+        if as_of:
+            balances = await db.run_sync(get_balances_as_of, store.code, datetime.fromisoformat(as_of).date())
+        else:
+            balances = await db.run_sync(get_balances, store.code)
+        rows = []
+        for b, p in balances:
+            cups = b.cups if p.category_code in ("CỐT","MỨT") else 0
+            rows.append(dict(code=p.code, name=p.name, uom=p.uom, qty=b.stock_after, avg=b.avg_price, cups=cups, value=b.onhand_value))
+        total = sum(r["value"] or 0.0 for r in rows)
+        table = cached_fragment(key, templates.get_template("_ton_table.html").render(rows=rows, total=total))
+    return render("baocao_ton.html", user=user, store=store, stores=await md.astores(db), table=table, as_of=as_of or "")
+
+def audit_store_scope(user, store, store_code: str) -> str:
+    # Nhân viên chỉ xem/ xuất nhật ký cửa hàng của mình; Admin/SuperAdmin chọn cửa hàng hoặc tất cả ("")
+    return store.code if user.role == "User" else store_code
 
 @app.get("/nhatky", response_class=HTMLResponse)
-def audit_page(request: Request, db=Depends(get_db)):
+async def audit_page(request: Request, before: int | None = None,
+               from_: str | None = Query(None, alias="from"), to: str | None = Query(None, alias="to"),
+               by: str = "", action: str = "", store_code: str = Query("", alias="store"), limit: int = PAGE_SIZE, db=Depends(get_async_db)):
+    user = await require_login_async(request, db)
+    store = await current_store_async(request, user, db)
+    store_code = audit_store_scope(user, store, store_code)
+    A = models.AuditLog
+    stmt = audit_stmt(store_code=store_code, by=by, action=action,
+                      d_from=datetime.fromisoformat(from_) if from_ else None,
+                      d_to=datetime.fromisoformat(to) + timedelta(days=1) if to else None)
+    logs, cursor = await db.run_sync(keyset_page, stmt, A.id, before, limit)
+    filters = {"from": from_, "to": to, "by": by, "action": action, "store": store_code, "limit": limit if limit != PAGE_SIZE else None}
+    next_url = page_url("/nhatky", filters, cursor) if cursor else None
+    return render("nhatky.html", user=user, store=store, stores=await md.astores(db), logs=logs,
+                  filters=filters, next_url=next_url, paged=bool(before))
+
+@app.get("/nhatky/export")
+def audit_export(request: Request, from_: str | None = Query(None, alias="from"), to: str | None = Query(None, alias="to"),
+                 by: str = "", action: str = "", store_code: str = Query("", alias="store"), db=Depends(get_db)):
     user = require_login(request, db)
-    logs = db.execute(select(models.AuditLog).order_by(desc(models.AuditLog.id)).limit(200)).scalars().all()
-    return render("nhatky.html", user=user, store=current_store(request,user,db), stores=db.execute(select(models.Store)).scalars().all(), logs=logs)
+    store_code = audit_store_scope(user, current_store(request, user, db), store_code)
+    date_from, date_to, df, dt_to = date_range(from_, to)
+    A = models.AuditLog
+    stmt = (audit_stmt(store_code=store_code, by=by, action=action, d_from=df, d_to=dt_to)
+            .with_only_columns(A.ts, A.user, A.action, A.detail).order_by(A.id))
+    return csv_response(stmt, ["ts","user","action","detail"], f"audit_{date_from}_to_{date_to}.csv",
+                        lambda r: (iso(r[0]), r[1], r[2], r[3]))
+
+@app.get("/baocao/doanhthu", response_class=HTMLResponse)
+async def revenue_report(request: Request, from_: str | None = Query(None, alias="from"), to: str | None = Query(None, alias="to"),
+                         period: str = "month", store_codes: list[str] = Query([], alias="store"), db=Depends(get_async_db)):
+    # Doanh thu / nhập / xuất / sản xuất theo ngày-tháng-năm, đọc từ daily_summary
+    user = await require_login_async(request, db)
+    if not can(user,"BAOCAO"): return render("toast.html", message="Không có quyền truy cập")
+    store = await current_store_async(request, user, db)
+    codes = stores_in_scope(user, store, store_codes)
+    if period not in summary.PERIODS: period = "month"
+    today = datetime.utcnow().date()
+    date_from = from_ or today.replace(month=1, day=1).isoformat()
+    date_to = to or today.isoformat()
+    rows = await db.run_sync(summary.period_report, codes, datetime.fromisoformat(date_from).date(),
+                             datetime.fromisoformat(date_to).date(), period)
+    totals = {k: sum(r[k] for r in rows) for k in summary.FIELDS}
+    return render("baocao_doanhthu.html", user=user, store=store, stores=await md.astores(db), chosen=codes,
+                  rows=rows, totals=totals, period=period, date_from=date_from, date_to=date_to)
 
 # ---------- Fixed Assets ----------
 @app.get("/tssd", response_class=HTMLResponse)
 def tscd_page(request: Request, db=Depends(get_db)):
     user = require_login(request, db)
     if not can(user,"TSCD"): return render("toast.html", message="Không có quyền truy cập")
-    rows = db.execute(select(models.FixedAsset)).scalars().all()
-    out = []
+    rows = depreciation.asset_rows(db, datetime.utcnow().date())
+    return render("tscd.html", user=user, store=current_store(request,user,db), stores=md.stores(db), rows=rows)
+
+@app.get("/tssd/export")
+def tscd_export(request: Request, from_: str | None = Query(None, alias="from"), to: str | None = Query(None, alias="to"),
+                format: str = "csv", db=Depends(get_db)):
+    user = require_login(request, db)
+    if not can(user,"TSCD"): return RedirectResponse("/tssd", status_code=302)
     today = datetime.utcnow().date()
-    for a in rows:
-        dep_month = (a.cost / max(1,a.life_months))
-        months = max(0, (today.year - a.start_date.date().year)*12 + (today.month - a.start_date.date().month))
-        acc = min(months, a.life_months) * dep_month
-        nbv = max(0.0, a.cost - acc)
-        out.append(dict(code=a.code, name=a.name, cost=a.cost, dep_month=dep_month, acc_dep=acc, nbv=nbv))
-    return render("tscd.html", user=user, store=current_store(request,user,db), stores=db.execute(select(models.Store)).scalars().all(), rows=out)
+    # from/ to dạng YYYY-MM; mặc định tháng 1 năm nay -> tháng hiện tại
+    m_from = datetime.strptime(from_, "%Y-%m").date() if from_ else today.replace(month=1, day=1)
+    m_to = datetime.strptime(to, "%Y-%m").date() if to else today
+    try:
+        sched = depreciation.schedule(db, m_from, m_to)
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    name = f"khauhao_{sched.months[0]}_to_{sched.months[-1]}"
+    if format == "json":
+        return JSONResponse(depreciation.schedule_json(sched),
+                            headers={"Content-Disposition": f'attachment; filename="{name}.json"'})
+    return rows_csv_response(depreciation.schedule_csv_rows(sched), depreciation.SCHEDULE_CSV_HEADER, f"{name}.csv")
 
 @app.post("/tssd/add")
 def tscd_add(request: Request, code: str = Form(...), name: str = Form(...), cost: float = Form(...), life_months: int = Form(...), start_date: str = Form(...), db=Depends(get_db)):
@@ -492,22 +780,55 @@ def tscd_add(request: Request, code: str = Form(...), name: str = Form(...), cos
 
 # ---------- Balance Sheet (snapshot MVP) ----------
 @app.get("/baocao/candoi", response_class=HTMLResponse)
-def candoi(request: Request, db=Depends(get_db)):
-    user = require_login(request, db)
+async def candoi(request: Request, as_of: str | None = None, db=Depends(get_async_db)):
+    user = await require_login_async(request, db)
     if not can(user,"BAOCAO"): return render("toast.html", message="Không có quyền truy cập")
-    store = current_store(request, user, db)
-    last = db.execute(select(models.Ledger.product_code, func.max(models.Ledger.id)).where(models.Ledger.store_code==store.code).group_by(models.Ledger.product_code)).all()
-    stock_value = 0.0
-    for code, mid in last:
-        row = db.get(models.Ledger, mid)
-        if row: stock_value += (row.onhand_value or 0.0)
-    rows = db.execute(select(models.FixedAsset)).scalars().all()
-    today = datetime.utcnow().date()
-    nbv = 0.0
-    for a in rows:
-        dep_month = (a.cost / max(1,a.life_months))
-        months = max(0, (today.year - a.start_date.date().year)*12 + (today.month - a.start_date.date().month))
-        acc = min(months, a.life_months) * dep_month
-        nbv += max(0.0, a.cost - acc)
+    store = await current_store_async(request, user, db)
+    if as_of:
+        today = datetime.fromisoformat(as_of).date()
+        stock_call = (total_onhand_as_of, store.code, today)
+    else:
+        today = datetime.utcnow().date()
+        stock_call = (total_onhand, store.code)
+    stock_value, nbv = await read_concurrently(db, stock_call, (depreciation.total_nbv, today, bool(as_of)))
     total_assets = stock_value + nbv
-    return render("baocao_candoi.html", user=user, store=store, stores=db.execute(select(models.Store)).scalars().all(), stock_value=round(stock_value,0), tscd_nbv=round(nbv,0), total_assets=round(total_assets,0))
+    return render("baocao_candoi.html", user=user, store=store, stores=await md.astores(db), stock_value=round(stock_value,0), tscd_nbv=round(nbv,0), total_assets=round(total_assets,0), as_of=as_of or "")
+
+# ---------- Consolidated reports (multi-store) ----------
+def _consolidated_scope(db, store_codes: list[str]):
+    all_stores = md.stores(db)
+    chosen = [s for s in all_stores if s.code in store_codes] if store_codes else all_stores
+    return all_stores, chosen
+
+@app.get("/baocao/tonghop", response_class=HTMLResponse)
+def consolidated_summary(request: Request, store_codes: list[str] = Query([], alias="store"), db=Depends(get_db)):
+    user = require_login(request, db)
+    if user.role == "User" or not can(user,"BAOCAO"): return render("toast.html", message="Không có quyền truy cập")
+    stores, chosen = _consolidated_scope(db, store_codes)
+    codes = [s.code for s in chosen]
+    onhand = total_onhand_by_store(db, codes)
+    today = datetime.utcnow().date()
+    revs = summary.revenue_by_store(db, codes, today, today)
+    rows = [dict(code=s.code, name=s.name, onhand=onhand.get(s.code, 0.0), rev_today=revs.get(s.code, 0.0)) for s in chosen]
+    total_onhand_all = sum(r["onhand"] for r in rows)
+    nbv = depreciation.total_nbv(db, today)
+    return render("baocao_tonghop.html", user=user, store=current_store(request,user,db), stores=stores, chosen=codes, rows=rows,
+                  total_onhand=round(total_onhand_all,0), rev_today=round(sum(r["rev_today"] for r in rows),0),
+                  tscd_nbv=round(nbv,0), total_assets=round(total_onhand_all+nbv,0))
+
+@app.get("/baocao/ton/tonghop", response_class=HTMLResponse)
+def consolidated_stock(request: Request, store_codes: list[str] = Query([], alias="store"), db=Depends(get_db)):
+    user = require_login(request, db)
+    if user.role == "User" or not can(user,"BAOCAO"): return render("toast.html", message="Không có quyền truy cập")
+    stores, chosen = _consolidated_scope(db, store_codes)
+    codes = [s.code for s in chosen]
+    names = {s.code: s.name for s in chosen}
+    groups = {}
+    for b, p in get_balances_for_stores(db, codes):
+        cups = b.cups if p.category_code in ("CỐT","MỨT") else 0
+        g = groups.setdefault(b.store_code, dict(code=b.store_code, name=names.get(b.store_code, b.store_code), rows=[], total=0.0))
+        g["rows"].append(dict(code=p.code, name=p.name, uom=p.uom, qty=b.stock_after, avg=b.avg_price, cups=cups, value=b.onhand_value))
+        g["total"] += b.onhand_value or 0.0
+    total = sum(g["total"] for g in groups.values())
+    return render("baocao_ton_tonghop.html", user=user, store=current_store(request,user,db), stores=stores, chosen=codes,
+                  groups=list(groups.values()), total=total)
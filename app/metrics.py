@@ -0,0 +1,164 @@
+"""
+Đo theo request: thời gian (histogram), số câu SQL, tổng thời gian SQL, số dòng ghi — gộp theo route,
+xuất dạng text Prometheus ở /metrics. Câu SQL chậm (>= SLOW_QUERY_MS) ghi log kèm route.
+- METRICS_ENABLED=0: tắt cả middleware lẫn hook SQL.
+- METRICS_TOKEN: nếu đặt, /metrics yêu cầu header "Authorization: Bearer <token>".
+- Số dòng ghi = rowcount của INSERT/UPDATE/DELETE; KHÔNG tính dòng đọc (SQLite trả -1 cho SELECT,
+  PostgreSQL trả số dòng -> bỏ SELECT để 2 backend cùng nghĩa).
+Số liệu nằm trong từng tiến trình (mỗi worker uvicorn 1 bộ, Prometheus scrape từng worker).
+"""
+from __future__ import annotations
+import bisect
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger("app.sql.slow")
+
+ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+TOKEN = os.getenv("METRICS_TOKEN", "")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))  # 0 = tắt log
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # giây
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)  # số câu SQL/ request
+
+@dataclass
+class _Request:
+    scope: dict
+    queries: int = 0
+    sql_seconds: float = 0.0
+    rows_affected: int = 0
+
+    @property
+    def route(self) -> str:
+        # Router gắn "route" vào scope khi khớp; không khớp (404, /static) -> gộp chung, tránh nổ số nhãn theo URL
+        return getattr(self.scope.get("route"), "path", None) or "other"
+
+@dataclass
+class _RouteStats:
+    count: int = 0
+    seconds: float = 0.0
+    buckets: list[int] = field(default_factory=lambda: [0] * (len(BUCKETS) + 1))
+    query_buckets: list[int] = field(default_factory=lambda: [0] * (len(QUERY_BUCKETS) + 1))
+    queries: int = 0
+    sql_seconds: float = 0.0
+    rows_affected: int = 0
+    status: dict[str, int] = field(default_factory=dict)
+
+_current: ContextVar[_Request | None] = ContextVar("metrics_request", default=None)
+_routes: dict[tuple[str, str], _RouteStats] = {}
+_lock = threading.Lock()
+
+# --------- Hook SQL (mọi Engine, kể cả async_engine.sync_engine) ---------
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_t0", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get("metrics_t0")
+    if not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    req = _current.get()
+    if req is not None:
+        req.queries += 1
+        req.sql_seconds += elapsed
+        if context is not None and (context.isinsert or context.isupdate or context.isdelete):
+            rc = cursor.rowcount
+            if rc and rc > 0:
+                req.rows_affected += rc
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        log.warning("SQL chậm %.0f ms route=%s: %s", elapsed * 1000, req.route if req else "-",
+                    " ".join(statement.split())[:2000])
+
+if ENABLED:
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+# --------- Middleware ASGI (không bọc response như BaseHTTPMiddleware) ---------
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED:
+            return await self.app(scope, receive, send)
+        req = _Request(scope)
+        token = _current.set(req)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - t0
+            _current.reset(token)
+            _record(scope["method"], req, status[0], elapsed)
+
+def _record(method: str, req: _Request, status: int, elapsed: float) -> None:
+    key = (method, req.route)
+    with _lock:
+        st = _routes.get(key)
+        if st is None:
+            st = _routes[key] = _RouteStats()
+        st.count += 1
+        st.seconds += elapsed
+        st.buckets[bisect.bisect_left(BUCKETS, elapsed)] += 1
+        st.query_buckets[bisect.bisect_left(QUERY_BUCKETS, req.queries)] += 1
+        st.queries += req.queries
+        st.sql_seconds += req.sql_seconds
+        st.rows_affected += req.rows_affected
+        code = str(status)
+        st.status[code] = st.status.get(code, 0) + 1
+
+# --------- Xuất Prometheus text ---------
+def _esc(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _histogram(lines: list[str], name: str, labels: str, bounds, counts: list[int], total: float, n: int) -> None:
+    acc = 0
+    for b, c in zip(bounds, counts):
+        acc += c
+        lines.append(f'{name}_bucket{{{labels},le="{b}"}} {acc}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {n}')
+    lines.append(f"{name}_sum{{{labels}}} {total}")
+    lines.append(f"{name}_count{{{labels}}} {n}")
+
+def render() -> str:
+    with _lock:
+        snap = {k: (st.count, st.seconds, list(st.buckets), list(st.query_buckets), st.queries, st.sql_seconds,
+                    st.rows_affected, dict(st.status)) for k, st in sorted(_routes.items())}
+    lines = [
+        "# HELP http_requests_total Số request theo route và mã trạng thái.",
+        "# TYPE http_requests_total counter",
+    ]
+    for (method, route), (*_, status) in snap.items():
+        for code, n in sorted(status.items()):
+            lines.append(f'http_requests_total{{method="{method}",route="{_esc(route)}",status="{code}"}} {n}')
+    lines += ["# HELP http_request_duration_seconds Thời gian xử lý request.",
+              "# TYPE http_request_duration_seconds histogram"]
+    for (method, route), (n, secs, buckets, *_) in snap.items():
+        _histogram(lines, "http_request_duration_seconds", f'method="{method}",route="{_esc(route)}"',
+                   BUCKETS, buckets, secs, n)
+    lines += ["# HELP http_request_db_queries Số câu SQL mỗi request.",
+              "# TYPE http_request_db_queries histogram"]
+    for (method, route), (n, _, _, qbuckets, queries, *_) in snap.items():
+        _histogram(lines, "http_request_db_queries", f'method="{method}",route="{_esc(route)}"',
+                   QUERY_BUCKETS, qbuckets, queries, n)
+    for name, idx, help_ in (
+        ("http_request_db_seconds_total", 5, "Tổng thời gian SQL theo route."),
+        ("http_request_db_rows_affected_total", 6,
+         "Tổng số dòng INSERT/UPDATE/DELETE ghi (rowcount) theo route; không tính dòng SELECT đọc ra."),
+    ):
+        lines += [f"# HELP {name} {help_}", f"# TYPE {name} counter"]
+        for (method, route), vals in snap.items():
+            lines.append(f'{name}{{method="{method}",route="{_esc(route)}"}} {vals[idx]}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,239 @@
+"""
+Migration schema có đánh số phiên bản.
+create_all() chỉ tạo bảng còn thiếu, không sửa bảng đã có; mọi thay đổi
+trên DB đang chạy (index, cột mới...) được thêm vào MIGRATIONS theo thứ tự.
+"""
+from __future__ import annotations
+import re
+from typing import Callable
+from sqlalchemy import (Column, DateTime, Float, Index, Integer, MetaData, SmallInteger, String, Table,
+                        select, insert, inspect, text, func)
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.schema import CreateTable
+from . import models
+from .services import search
+
+def _columns(conn: Connection, table: str) -> set[str]:
+    return {c["name"] for c in inspect(conn).get_columns(table)}
+
+def _add_column(conn: Connection, table: str, name: str, ddl_type: str) -> None:
+    if name not in _columns(conn, table):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl_type}"))
+
+def _create_index(conn: Connection, name: str, table: str, *cols: str) -> None:
+    # DDL ghi cố định trong từng bước: đổi tên/ cột index ở models.py không làm đổi migration cũ
+    q = conn.dialect.identifier_preparer.quote
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(q(c) for c in cols)})"))
+
+def _create_indexes(conn: Connection, table: Table, *names: str) -> None:
+    # Chỉ tạo đúng các index được nêu tên; tên không có trong bảng -> lỗi (không lặng lẽ bỏ qua)
+    known = {ix.name: ix for ix in table.indexes}
+    missing = [n for n in names if n not in known]
+    if missing:
+        raise ValueError(f"Index không có trong bảng {table.name}: {', '.join(missing)}")
+    for n in names:
+        known[n].create(conn, checkfirst=True)
+
+# --------- Các bước migration ---------
+# v1/ v2: index trên ledger dạng mã (store_code, product_code) trước v6. DB tạo mới bằng create_all
+# đã là ledger khoá số -> bỏ qua phần ledger.
+def _v1_composite_indexes(conn: Connection) -> None:
+    if "store_code" in _columns(conn, "ledger"):
+        _create_index(conn, "ix_ledger_store_product_id", "ledger", "store_code", "product_code", "id")
+        _create_index(conn, "ix_ledger_store_date", "ledger", "store_code", "date")
+    _create_index(conn, "ix_revenues_store_date", "revenues", "store_code", "date")
+    _create_index(conn, "ix_production_logs_store_status", "production_logs", "store_code", "status")
+
+def _v2_ledger_as_of_index(conn: Connection) -> None:
+    if "store_code" in _columns(conn, "ledger"):
+        _create_index(conn, "ix_ledger_store_product_date", "ledger", "store_code", "product_code", "date")
+
+def _v3_ledger_production_id(conn: Connection) -> None:
+    _add_column(conn, "ledger", "production_id", "INTEGER")
+    _create_index(conn, "ix_ledger_production", "ledger", "production_id")
+
+def _v4_audit_store(conn: Connection) -> None:
+    _add_column(conn, "audit_logs", "store_code", "VARCHAR")
+    _create_index(conn, "ix_audit_logs_store_id", "audit_logs", "store_code", "id")
+    _create_index(conn, "ix_audit_logs_user_id", "audit_logs", "user", "id")
+
+def _v5_product_search(conn: Connection) -> None:
+    search.create_index(conn)
+
+# v6: ledger khoá số (store_id, product_id), reason = models.Reason, ghi chú sang ledger_notes,
+# created_by_id = User.id. Lý do cũ dạng "<chữ> (by email)" được tách lại theo tiền tố nhãn.
+_LEGACY_BY = re.compile(r"^(.*?)\s*\(by ([^()]*)\)$", re.S)
+_LEGACY_PREFIXES = sorted(((label, r) for r, label in models.REASON_LABELS.items()), key=lambda x: -len(x[0]))
+_COPY_CHUNK = 5000
+
+# Cấu trúc ledger/ ledger_notes tại v6 (ghi cố định, không đọc models.Ledger)
+_v6_meta = MetaData()
+_LEDGER_V6 = Table(
+    "ledger", _v6_meta,
+    Column("id", Integer, primary_key=True),
+    Column("date", DateTime),
+    Column("store_id", Integer, nullable=False),
+    Column("product_id", Integer, nullable=False),
+    Column("qty_in", Float),
+    Column("price_in", Float),
+    Column("qty_out", Float),
+    Column("reason", SmallInteger, nullable=False),
+    Column("created_by_id", Integer, nullable=True),
+    Column("stock_after", Float),
+    Column("avg_price", Float),
+    Column("cups", Float),
+    Column("onhand_value", Float),
+    Column("production_id", Integer, nullable=True),
+    Index("ix_ledger_sp_id", "store_id", "product_id", "id"),
+    Index("ix_ledger_s_date", "store_id", "date"),
+    Index("ix_ledger_sp_date", "store_id", "product_id", "date"),
+    Index("ix_ledger_production", "production_id"),
+)
+_LEDGER_NOTES_V6 = Table(
+    "ledger_notes", _v6_meta,
+    Column("ledger_id", Integer, primary_key=True),
+    Column("note", String, nullable=False),
+)
+
+def _legacy_reason(text_: str | None, qty_in: float | None, users: dict[str, int]) -> tuple[int, str, int | None]:
+    """
+    "Xuất SX CT01 (by a@b.c)" -> (Reason.SX_XUAT, "CT01", id của a@b.c). Không khớp nhãn -> NHAP/XUAT theo số lượng,
+    cả chuỗi thành ghi chú. Email không phải user giữ lại trong ghi chú.
+    """
+    t, by = (text_ or "").strip(), ""
+    m = _LEGACY_BY.match(t)
+    if m:
+        t, by = m.group(1).strip(), m.group(2).strip()
+    for label, r in _LEGACY_PREFIXES:
+        if t == label or t.startswith(label + " "):
+            reason, note = r, t[len(label):].strip(" -:")
+            break
+    else:
+        reason, note = (models.Reason.NHAP if (qty_in or 0) > 0 else models.Reason.XUAT), t
+    uid = users.get(by) if by else None
+    if by and uid is None:
+        note = f"{note} (by {by})".strip()
+    return int(reason), note, uid
+
+def _v6_compact_ledger(conn: Connection) -> None:
+    if "store_id" in _columns(conn, "ledger"):
+        return  # DB mới: create_all đã tạo đúng cấu trúc
+    pg = conn.dialect.name == "postgresql"
+    for ix in inspect(conn).get_indexes("ledger"):
+        conn.execute(text(f"DROP INDEX {ix['name']}"))
+    conn.execute(text("ALTER TABLE ledger RENAME TO ledger_old"))
+    if pg:
+        conn.execute(text("ALTER TABLE ledger_old RENAME CONSTRAINT ledger_pkey TO ledger_old_pkey"))
+        conn.execute(text("ALTER SEQUENCE ledger_id_seq RENAME TO ledger_old_id_seq"))
+    t = _LEDGER_V6
+    conn.execute(CreateTable(t))  # index tạo sau khi chép (nhanh hơn cập nhật index từng dòng)
+    _LEDGER_NOTES_V6.create(conn, checkfirst=True)
+
+    # Mã có trong ledger nhưng thiếu danh mục (dữ liệu cũ/ thử) -> thêm vào danh mục để giữ khoá
+    S, P = models.Store, models.Product
+    stores = dict(conn.execute(select(S.code, S.id)).all())
+    for (code,) in conn.execute(text("SELECT DISTINCT store_code FROM ledger_old")).all():
+        if code not in stores:
+            stores[code] = conn.execute(insert(S).values(code=code, name=code).returning(S.id)).scalar()
+    products = dict(conn.execute(select(P.code, P.id)).all())
+    n_products = len(products)
+    for code, name, uom in conn.execute(text(
+            "SELECT product_code, MAX(product_name), MAX(uom) FROM ledger_old GROUP BY product_code")).all():
+        if code not in products:
+            products[code] = conn.execute(insert(P).values(code=code, name=name or code, uom=uom or "",
+                                                           category_code="").returning(P.id)).scalar()
+    if len(products) > n_products:
+        search.create_index(conn)  # insert Core không qua mapper event -> nạp lại product_search
+    users = dict(conn.execute(select(models.User.email, models.User.id)).all())
+
+    last = 0
+    while True:
+        rows = conn.execute(text(
+            "SELECT id, date, store_code, product_code, qty_in, price_in, qty_out, reason, stock_after, avg_price,"
+            " cups, onhand_value, production_id FROM ledger_old WHERE id > :last ORDER BY id LIMIT :n"
+        ).columns(date=DateTime), dict(last=last, n=_COPY_CHUNK)).all()
+        if not rows:
+            break
+        out, notes = [], []
+        for (lid, date, sc, pc, qty_in, price_in, qty_out, reason, stock_after, avg_price,
+             cups, onhand_value, production_id) in rows:
+            code, note, uid = _legacy_reason(reason, qty_in, users)
+            out.append(dict(id=lid, date=date, store_id=stores[sc], product_id=products[pc], qty_in=qty_in,
+                            price_in=price_in, qty_out=qty_out, reason=code, created_by_id=uid,
+                            stock_after=stock_after, avg_price=avg_price, cups=cups, onhand_value=onhand_value,
+                            production_id=production_id))
+            if note:
+                notes.append(dict(ledger_id=lid, note=note))
+        conn.execute(insert(t), out)
+        if notes:
+            conn.execute(insert(_LEDGER_NOTES_V6), notes)
+        last = rows[-1][0]
+    conn.execute(text("DROP TABLE ledger_old"))
+    _create_indexes(conn, t, "ix_ledger_sp_id", "ix_ledger_s_date", "ix_ledger_sp_date", "ix_ledger_production")
+    if pg:
+        conn.execute(text("SELECT setval(pg_get_serial_sequence('ledger', 'id'), COALESCE(MAX(id), 1)) FROM ledger"))
+
+# v7: bộ đếm phiên bản danh mục, mỗi kind 1 dòng (mapper event chỉ UPDATE, không tranh nhau INSERT)
+_MASTERDATA_KINDS = ("stores", "categories", "products", "users")
+
+def _v7_masterdata_version(conn: Connection) -> None:
+    conn.execute(text("CREATE TABLE IF NOT EXISTS masterdata_version (kind VARCHAR PRIMARY KEY, version INTEGER NOT NULL)"))
+    have = set(conn.execute(text("SELECT kind FROM masterdata_version")).scalars())
+    for kind in _MASTERDATA_KINDS:
+        if kind not in have:
+            conn.execute(text("INSERT INTO masterdata_version (kind, version) VALUES (:k, 0)"), dict(k=kind))
+
+def _v8_ledger_revision(conn: Connection) -> None:
+    conn.execute(text("CREATE TABLE IF NOT EXISTS ledger_revision (store_code VARCHAR PRIMARY KEY, revision INTEGER NOT NULL)"))
+
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "Index tổng hợp ledger / revenues / production_logs", _v1_composite_indexes),
+    (2, "Index ledger (store, product, date) cho báo cáo theo ngày", _v2_ledger_as_of_index),
+    (3, "Cột ledger.production_id liên kết lô sản xuất", _v3_ledger_production_id),
+    (4, "Cột audit_logs.store_code + index phân trang nhật ký", _v4_audit_store),
+    (5, "Chỉ mục tìm sản phẩm không dấu (product_search)", _v5_product_search),
+    (6, "Ledger gọn: khoá số cửa hàng/ sản phẩm/ người ghi, mã lý do + ledger_notes", _v6_compact_ledger),
+    (7, "Bộ đếm phiên bản danh mục (masterdata_version) cho cache nhiều tiến trình", _v7_masterdata_version),
+    (8, "Bộ đếm ghi lại ledger theo cửa hàng (ledger_revision) cho khoá cache báo cáo", _v8_ledger_revision),
+]
+
+# --------- Runner ---------
+def applied_versions(conn: Connection) -> set[int]:
+    return set(conn.execute(select(models.SchemaVersion.version)).scalars().all())
+
+# Nhiều node khởi động cùng lúc trên PostgreSQL: chỉ 1 node chạy migration
+_PG_LOCK_ID = 7_211_001
+
+def _lock(conn: Connection) -> None:
+    if conn.dialect.name == "postgresql":
+        conn.execute(select(func.pg_advisory_lock(_PG_LOCK_ID)))
+
+def _unlock(conn: Connection) -> None:
+    if conn.dialect.name == "postgresql":
+        conn.execute(select(func.pg_advisory_unlock(_PG_LOCK_ID)))
+        conn.commit()
+
+def run_migrations(engine: Engine) -> list[int]:
+    """
+    Tạo bảng còn thiếu (create_all) rồi áp dụng các migration chưa chạy (mỗi bước trong 1 transaction),
+    cùng dưới khoá migration: nhiều node khởi động cùng lúc trên DB mới không tranh nhau CREATE TABLE.
+    Trả về danh sách phiên bản vừa áp dụng.
+    """
+    with engine.connect() as lock_conn:
+        _lock(lock_conn)
+        try:
+            models.Base.metadata.create_all(bind=lock_conn)
+            lock_conn.commit()
+            done = applied_versions(lock_conn)
+            lock_conn.commit()
+            applied = []
+            for version, note, step in MIGRATIONS:
+                if version in done:
+                    continue
+                with engine.begin() as conn:
+                    step(conn)
+                    conn.execute(insert(models.SchemaVersion).values(version=version, note=note, applied_at=models.now()))
+                applied.append(version)
+        finally:
+            _unlock(lock_conn)
+    return applied
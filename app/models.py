@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, Text
+import enum
+from sqlalchemy import Column, Integer, SmallInteger, String, Float, Date, DateTime, Boolean, Text, Index
 from datetime import datetime
 from .db import Base
 
@@ -42,22 +43,84 @@ class Product(Base):
     category_code = Column(String, nullable=False)  # tham chiếu Category
 
 # ---------- Kho (Ledger) ----------
+class Reason(enum.IntEnum):
+    """
+    Lý do ghi sổ (ledger.reason). Chữ tự do đi kèm nằm ở ledger_notes.
+    """
+    NHAP = 1
+    XUAT = 2
+    KIEMKE_TANG = 3
+    KIEMKE_GIAM = 4
+    SX_XUAT = 5   # xuất NVL/PG cho lô sản xuất
+    SX_NHAP = 6   # nhập TP của lô sản xuất
+    DAU_KY = 7    # tồn đầu kỳ sau khoá sổ (qty = 0, mang trạng thái của kỳ đã lưu trữ)
+
+REASON_LABELS = {
+    Reason.NHAP: "Nhập kho",
+    Reason.XUAT: "Xuất kho",
+    Reason.KIEMKE_TANG: "Kiểm kê (+)",
+    Reason.KIEMKE_GIAM: "Kiểm kê (-)",
+    Reason.SX_XUAT: "Xuất SX",
+    Reason.SX_NHAP: "Nhập TP",
+    Reason.DAU_KY: "Tồn đầu kỳ",
+}
+
 class Ledger(Base):
     __tablename__ = "ledger"
     id = Column(Integer, primary_key=True)
     date = Column(DateTime, default=now)
-    store_code = Column(String, nullable=False)
-    product_code = Column(String, nullable=False)
-    product_name = Column(String, nullable=False)
-    uom = Column(String, nullable=False)
+    store_id = Column(Integer, nullable=False)      # Store.id
+    product_id = Column(Integer, nullable=False)    # Product.id (tên, ĐVT đọc từ danh mục)
     qty_in = Column(Float, default=0.0)
     price_in = Column(Float, default=0.0)
     qty_out = Column(Float, default=0.0)
-    reason = Column(String, default="")
+    reason = Column(SmallInteger, nullable=False)   # Reason
+    created_by_id = Column(Integer, nullable=True)  # User.id
     stock_after = Column(Float, default=0.0)   # tồn sau giao dịch
     avg_price = Column(Float, default=0.0)     # giá bình quân
     cups = Column(Float, default=0.0)          # số cốc (nếu có)
     onhand_value = Column(Float, default=0.0)  # giá trị tồn
+    production_id = Column(Integer, nullable=True)  # ProductionLog.id (NVL xuất / TP nhập của lô)
+
+    __table_args__ = (
+        Index("ix_ledger_sp_id", "store_id", "product_id", "id"),
+        Index("ix_ledger_s_date", "store_id", "date"),
+        Index("ix_ledger_sp_date", "store_id", "product_id", "date"),
+        Index("ix_ledger_production", "production_id"),
+    )
+
+class LedgerNote(Base):
+    # Ghi chú tự do của dòng ledger (chỉ dòng có ghi chú mới có bản ghi)
+    __tablename__ = "ledger_notes"
+    ledger_id = Column(Integer, primary_key=True)
+    note = Column(String, nullable=False)
+
+class LedgerArchive(Base):
+    # File lưu trữ ledger theo năm (services/archive.close_period)
+    __tablename__ = "ledger_archives"
+    year = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False)
+    rows = Column(Integer, default=0)
+    closed_before = Column(DateTime, nullable=False)  # mốc khoá sổ: ledger trước mốc nằm trong lưu trữ
+    closed_at = Column(DateTime, default=now)
+
+# ---------- Tồn kho hiện tại (snapshot theo cửa hàng/sản phẩm) ----------
+class StockBalance(Base):
+    __tablename__ = "stock_balance"
+    store_code = Column(String, primary_key=True)
+    product_code = Column(String, primary_key=True)
+    stock_after = Column(Float, default=0.0)
+    avg_price = Column(Float, default=0.0)
+    onhand_value = Column(Float, default=0.0)
+    cups = Column(Float, default=0.0)
+    last_ledger_id = Column(Integer, nullable=True)  # dòng ledger cuối cùng đã áp dụng
+    updated_at = Column(DateTime, default=now)
+
+class LedgerRevision(Base):
+    # Tăng khi replay/ repair ghi lại dòng ledger cũ hoặc snapshot: id lớn nhất không đổi nhưng bảng báo cáo đã khác
+    __tablename__ = "ledger_revision"
+    store_code = Column(String, primary_key=True)
+    revision = Column(Integer, nullable=False, default=0)
 
 # ---------- Công thức sản xuất ----------
 class Formula(Base):
@@ -93,6 +156,10 @@ class ProductionLog(Base):
     note = Column(String, default="")
     batch_id = Column(String, unique=True, nullable=True) # cho mứt WIP
 
+    __table_args__ = (
+        Index("ix_production_logs_store_status", "store_code", "status"),
+    )
+
 # ---------- Doanh thu ----------
 class Revenue(Base):
     __tablename__ = "revenues"
@@ -104,6 +171,23 @@ class Revenue(Base):
     note = Column(String, default="")
     created_by = Column(String, default="")
 
+    __table_args__ = (
+        Index("ix_revenues_store_date", "store_code", "date"),
+    )
+
+# ---------- Tổng hợp theo ngày ----------
+class DailySummary(Base):
+    # Cộng dồn theo (cửa hàng, ngày): /doanhthu/add và ledger writer cập nhật cùng transaction
+    __tablename__ = "daily_summary"
+    store_code = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    cash = Column(Float, default=0.0)
+    bank = Column(Float, default=0.0)
+    value_in = Column(Float, default=0.0)    # giá trị nhập = qty_in * price_in
+    value_out = Column(Float, default=0.0)   # giá trị xuất = qty_out * giá BQ
+    prod_kg = Column(Float, default=0.0)     # TP sản xuất nhập kho (ledger có production_id)
+    prod_cups = Column(Float, default=0.0)
+
 # ---------- Nhật ký hệ thống ----------
 class AuditLog(Base):
     __tablename__ = "audit_logs"
@@ -112,6 +196,12 @@ class AuditLog(Base):
     user = Column(String, default="")
     action = Column(String, default="")
     detail = Column(Text, default="")
+    store_code = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index("ix_audit_logs_store_id", "store_code", "id"),
+        Index("ix_audit_logs_user_id", "user", "id"),
+    )
 
 # ---------- Tài sản cố định ----------
 class FixedAsset(Base):
@@ -123,3 +213,16 @@ class FixedAsset(Base):
     cost = Column(Float, default=0.0)
     life_months = Column(Integer, default=60)
     note = Column(String, default="")
+
+# ---------- Phiên bản schema (migration) ----------
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+    note = Column(String, default="")
+    applied_at = Column(DateTime, default=now)
+
+# ---------- Phiên bản danh mục (cache master-data giữa các tiến trình) ----------
+class MasterdataVersion(Base):
+    __tablename__ = "masterdata_version"
+    kind = Column(String, primary_key=True)  # stores / categories / products / users
+    version = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,110 @@
+"""
+Kiểm tra EXPLAIN QUERY PLAN (SQLite) cho các truy vấn main.py / services dùng.
+- Truy vấn ledger/ nhật ký dựng bằng đúng helper của main.py (inventory.ledger_*_stmt, audit.audit_stmt), không chép tay.
+- Truy vấn có điều kiện lọc phải đi qua index hoặc khoá chính.
+- Truy vấn liệt kê cả danh mục (stores, products, formulas...) được đánh dấu full=True.
+Chạy: python -m app.cli check-plans
+"""
+from __future__ import annotations
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, desc
+from sqlalchemy.engine import Engine
+from . import models
+from .services.audit import audit_stmt
+from .services.inventory import (_as_of_ids, ledger_history_stmt, ledger_csv_stmt, ledger_export_stmt,
+                                 ledger_version_stmt)
+
+def main_queries() -> list[tuple[str, object, bool]]:
+    """
+    (tên, câu lệnh, cho phép quét toàn bảng)
+    """
+    L, R, P, S = models.Ledger, models.Revenue, models.Product, models.Store
+    B, PL, U = models.StockBalance, models.ProductionLog, models.User
+    D = models.DailySummary
+    now = datetime.utcnow()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return [
+        ("user theo id", select(U).where(U.id == 1), False),
+        ("user theo email", select(U).where(U.email == "a@b.c"), False),
+        ("store theo mã", select(S).where(S.code == "216HS"), False),
+        ("product theo mã", select(P).where(P.code == "CAM"), False),
+        ("formula theo mã", select(models.Formula).where(models.Formula.code == "CT"), False),
+        ("tồn hiện tại (stock_balance)", select(B).where(B.store_code == "216HS", B.product_code == "CAM"), False),
+        ("mốc ledger cửa hàng", ledger_version_stmt("216HS"), False),
+        ("mốc ledger sản phẩm", ledger_version_stmt("216HS", "CAM"), False),
+        ("tổng giá trị tồn", select(func.sum(B.onhand_value)).where(B.store_code == "216HS"), False),
+        ("báo cáo tồn",
+         select(B, P).join(P, P.code == B.product_code).where(B.store_code == "216HS").order_by(P.name), False),
+        ("tồn tại ngày (as_of)",
+         select(L).where(L.id.in_(_as_of_ids("216HS", today.date()))), False),
+        ("doanh thu hôm nay (daily_summary)",
+         select(func.sum(D.cash + D.bank)).where(D.store_code.in_(["216HS"]), D.day >= today.date(), D.day <= today.date()), False),
+        ("báo cáo theo kỳ (daily_summary)",
+         select(D.day, func.sum(D.cash)).where(D.store_code.in_(["216HS", "AEON"]), D.day >= today.date(), D.day <= now.date())
+         .group_by(D.day).order_by(D.day), False),
+        ("doanh thu theo khoảng",
+         select(R).where(R.store_code == "216HS", R.date >= today, R.date < now).order_by(desc(R.date)), False),
+        ("lịch sử sản phẩm",
+         select(L).where(L.store_id == 1, L.product_id == 1).order_by(L.id.desc()).limit(200), False),
+        ("ghi chú ledger theo trang",
+         select(models.LedgerNote).where(models.LedgerNote.ledger_id.in_([1, 2, 3])), False),
+        ("chi phí lô sản xuất", select(func.sum(L.qty_out * L.avg_price)).where(L.production_id == 1), False),
+        ("lô WIP", select(PL).where(PL.store_code == "216HS", PL.status == "WIP"), False),
+        ("lô theo batch_id", select(PL).where(PL.batch_id == "B1"), False),
+        # Duyệt ngược theo rowid + LIMIT: không cần index phụ
+        ("nhật ký (top 200)", select(models.AuditLog).order_by(desc(models.AuditLog.id)).limit(200), True),
+        ("nhật ký theo cửa hàng (keyset)",
+         audit_stmt(store_code="216HS").where(models.AuditLog.id < 1000)
+         .order_by(desc(models.AuditLog.id)).limit(201), False),
+        ("nhật ký theo user (keyset)",
+         audit_stmt(by="a@b.c").where(models.AuditLog.id < 1000)
+         .order_by(desc(models.AuditLog.id)).limit(201), False),
+        ("CSV nhật ký theo cửa hàng (/nhatky/export)",
+         audit_stmt(store_code="216HS", d_from=today - timedelta(days=30), d_to=now)
+         .with_only_columns(models.AuditLog.ts, models.AuditLog.user).order_by(models.AuditLog.id), False),
+        ("lịch sử sản phẩm (keyset)",
+         ledger_history_stmt(1, 1).where(L.id < 1000).order_by(L.id.desc()).limit(201), False),
+        ("lịch sử sản phẩm lọc ngày + lý do + người ghi",
+         ledger_history_stmt(1, 1, d_from=today - timedelta(days=30), d_to=now, reason="Nhập", by="a@b.c", by_uid=1)
+         .order_by(L.id.desc()).limit(201), False),
+        ("lịch sử sản phẩm lọc người ghi ngoài user",
+         ledger_history_stmt(1, 1, by="cli").order_by(L.id.desc()).limit(201), False),
+        ("CSV lịch sử sản phẩm",
+         ledger_csv_stmt().where(L.store_id == 1, L.product_id == 1).order_by(L.id), False),
+        ("CSV kho nhiều cửa hàng (/kho/export)", ledger_export_stmt([1, 2], today - timedelta(days=30), now), False),
+        ("CSV sản xuất",
+         select(PL).where(PL.store_code.in_(["216HS"]), PL.date >= today, PL.date < now).order_by(PL.id), False),
+        ("CSV doanh thu",
+         select(R).where(R.store_code == "216HS", R.date >= today, R.date < now).order_by(R.date.desc()), False),
+        ("danh sách store", select(S), True),
+        ("danh sách category", select(models.Category).order_by(models.Category.name), True),
+        ("danh sách product", select(P).order_by(P.name), True),
+        ("danh sách user", select(U), True),
+        ("danh sách formula", select(models.Formula), True),
+        ("danh sách TSCĐ", select(models.FixedAsset), True),
+    ]
+
+def explain(engine: Engine, stmt) -> list[str]:
+    with engine.connect() as conn:
+        compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})  # IN (...) mở sẵn
+        params = tuple(compiled.params[k] for k in (compiled.positiontup or []))
+        rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params).all()
+    return [r[-1] for r in rows]
+
+def _is_full_scan(detail: str) -> bool:
+    # SCAN CONSTANT ROW: SELECT chỉ gồm scalar subquery, không quét bảng
+    return detail.startswith("SCAN ") and " USING " not in detail and detail != "SCAN CONSTANT ROW"
+
+def check_query_plans(engine: Engine) -> list[tuple[str, list[str], bool]]:
+    """
+    Trả về [(tên, các dòng plan, đạt?)] cho từng truy vấn.
+    Chỉ áp dụng cho SQLite.
+    """
+    if engine.dialect.name != "sqlite":
+        return []
+    out = []
+    for name, stmt, full_ok in main_queries():
+        plan = explain(engine, stmt)
+        ok = full_ok or not any(_is_full_scan(d) for d in plan)
+        out.append((name, plan, ok))
+    return out
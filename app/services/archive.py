@@ -0,0 +1,217 @@
+from __future__ import annotations
+import os
+import sqlite3
+import time as _time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date, datetime, time, timedelta
+from urllib.parse import quote
+from sqlalchemy import create_engine, select, insert, delete, func, text
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.pool import StaticPool
+from .. import models
+from ..db import begin_write
+
+# ========================
+# Khoá sổ kho: chuyển ledger cũ sang file lưu trữ theo năm
+# ========================
+# close_period(cutoff):
+# - dòng ledger có date < cutoff (kèm ledger_notes) chép sang ARCHIVE_DIR/ledger_<năm>.db (SQLite,
+#   cùng cấu trúc bảng + index), rồi xoá khỏi DB chính;
+# - mỗi (cửa hàng, sản phẩm) còn 1 dòng Reason.DAU_KY lúc cutoff - 1µs mang stock_after/ avg_price/
+#   onhand_value/ cups của dòng cuối trước cutoff, qty = 0 (daily_summary không đổi). Dòng này dùng lại id
+#   nhỏ nhất của mã trong kỳ đã khoá -> thứ tự id (phân trang, last_ledger_id) giữ nguyên;
+# - replay coi DAU_KY là điểm đặt lại trạng thái; stock_balance/ get_latest_state không đổi.
+# Sau khoá sổ không ghi lùi ngày vào trước cutoff (ValueError). Dòng DAU_KY của lần khoá trước
+# không chép lại sang lưu trữ (file năm đã có dòng gốc).
+# Đọc: open_archives() mở 1 connection SQLite chỉ đọc, ATTACH mọi file năm (mode=ro) và tạo view
+# tạm `ledger`/ `ledger_notes` gộp các năm -> truy vấn ORM models.Ledger/ LedgerNote chạy nguyên văn.
+ARCHIVE_DIR = os.getenv("LEDGER_ARCHIVE_DIR", "archive")
+CHUNK_ROWS = 5000
+
+def closed_before(db: Session) -> datetime | None:
+    """
+    Mốc khoá sổ hiện tại (dòng trước mốc này đã lưu trữ), None = chưa khoá sổ.
+    """
+    return db.execute(select(func.max(models.LedgerArchive.closed_before))).scalar()
+
+def check_open(db: Session, when: datetime | None) -> None:
+    """
+    Ghi lùi ngày vào kỳ đã khoá sổ -> ValueError.
+    """
+    if when is None:
+        return
+    closed = closed_before(db)
+    if closed is not None and when < closed:
+        raise ValueError(f"Sổ kho đã khoá trước ngày {closed:%d/%m/%Y}")
+
+def archive_path(year: int, archive_dir: str = ARCHIVE_DIR) -> str:
+    return os.path.abspath(os.path.join(archive_dir, f"ledger_{year}.db"))
+
+# --------- Khoá sổ ---------
+@dataclass
+class CloseStats:
+    cutoff: datetime
+    rows: int = 0
+    pairs: int = 0
+    years: dict[int, int] = field(default_factory=dict)  # năm -> số dòng chép sang file
+    started: float = field(default_factory=_time.perf_counter)
+
+    @property
+    def seconds(self) -> float:
+        return _time.perf_counter() - self.started
+
+class _YearFiles:
+    # Mỗi năm 1 file + 1 transaction mở tới khi chép xong (commit cùng lúc trước khi xoá ở DB chính)
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        self.open: dict[int, tuple] = {}
+
+    def conn(self, year: int):
+        if year not in self.open:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            eng = create_engine(f"sqlite:///{archive_path(year, self.archive_dir)}")
+            conn = eng.connect()
+            tx = conn.begin()
+            models.Ledger.__table__.create(conn, checkfirst=True)
+            models.LedgerNote.__table__.create(conn, checkfirst=True)
+            self.open[year] = (eng, conn, tx)
+        return self.open[year][1]
+
+    def write(self, year: int, rows: list[dict], notes: list[dict]) -> None:
+        # OR REPLACE: chạy lại sau khi DB chính rollback không bị trùng khoá
+        conn = self.conn(year)
+        conn.execute(insert(models.Ledger.__table__).prefix_with("OR REPLACE"), rows)
+        if notes:
+            conn.execute(insert(models.LedgerNote.__table__).prefix_with("OR REPLACE"), notes)
+
+    def finish(self, ok: bool) -> None:
+        for eng, conn, tx in self.open.values():
+            (tx.commit if ok else tx.rollback)()
+            conn.close()
+            eng.dispose()
+        self.open.clear()
+
+def _opening_rows(db: Session, cutoff: datetime) -> list[dict]:
+    # Dòng cuối (date, id) trước cutoff của từng mã + id nhỏ nhất của mã trong kỳ khoá
+    L = models.Ledger
+    part = (L.store_id, L.product_id)
+    sub = select(
+        L.store_id, L.product_id, L.stock_after, L.avg_price, L.onhand_value, L.cups,
+        func.row_number().over(partition_by=part, order_by=(L.date.desc(), L.id.desc())).label("rn"),
+        func.min(L.id).over(partition_by=part).label("first_id"),
+    ).where(L.date < cutoff).subquery()
+    when = cutoff - timedelta(microseconds=1)
+    return [dict(id=r.first_id, date=when, store_id=r.store_id, product_id=r.product_id,
+                 qty_in=0.0, price_in=0.0, qty_out=0.0, reason=int(models.Reason.DAU_KY), created_by_id=None,
+                 stock_after=r.stock_after, avg_price=r.avg_price, onhand_value=r.onhand_value, cups=r.cups,
+                 production_id=None)
+            for r in db.execute(select(sub).where(sub.c.rn == 1))]
+
+def close_period(db: Session, cutoff: date, archive_dir: str = ARCHIVE_DIR, chunk_rows: int = CHUNK_ROWS) -> CloseStats:
+    """
+    Khoá sổ mọi dòng ledger trước ngày cutoff (00:00). File lưu trữ được commit trước;
+    thay đổi ở DB chính không commit (người gọi commit). cutoff <= mốc đã khoá -> ValueError.
+    """
+    cut = datetime.combine(cutoff, time.min)
+    st = CloseStats(cut)
+    begin_write(db)
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("LOCK TABLE ledger IN SHARE ROW EXCLUSIVE MODE"))  # chặn ghi ledger tới hết transaction
+    prev = closed_before(db)
+    if prev is not None and cut <= prev:
+        raise ValueError(f"Sổ kho đã khoá tới {prev:%d/%m/%Y}")
+    opening = _opening_rows(db, cut)
+    if not opening:
+        raise ValueError(f"Không có dòng ledger trước ngày {cut:%d/%m/%Y}")
+
+    L, N = models.Ledger, models.LedgerNote
+    files = _YearFiles(archive_dir)
+    try:
+        rows: dict[int, list[dict]] = {}
+        notes: dict[int, list[dict]] = {}
+        cols = [c for c in L.__table__.c]
+        stmt = (select(*cols, N.note).outerjoin(N, N.ledger_id == L.id)
+                .where(L.date < cut, L.reason != int(models.Reason.DAU_KY)).order_by(L.id))
+        for part in db.execute(stmt).yield_per(chunk_rows).partitions():
+            for r in part:
+                d = r._mapping
+                year = d["date"].year
+                rows.setdefault(year, []).append({c.name: d[c] for c in cols})
+                if d["note"]:
+                    notes.setdefault(year, []).append(dict(ledger_id=d["id"], note=d["note"]))
+            for year, buf in rows.items():
+                if buf:
+                    files.write(year, buf, notes.get(year, []))
+                    st.years[year] = st.years.get(year, 0) + len(buf)
+                    st.rows += len(buf)
+            rows.clear()
+            notes.clear()
+        files.finish(ok=True)
+    except BaseException:
+        files.finish(ok=False)
+        raise
+
+    old = select(L.id).where(L.date < cut)
+    db.execute(delete(N).where(N.ledger_id.in_(old)), execution_options={"synchronize_session": False})
+    db.execute(delete(L).where(L.date < cut), execution_options={"synchronize_session": False})
+    db.execute(insert(L.__table__), opening)
+    A = models.LedgerArchive
+    archives = {a.year: a for a in db.execute(select(A)).scalars()}
+    for year in st.years.keys() - archives.keys():
+        archives[year] = A(year=year, path=archive_path(year, archive_dir), rows=0)
+        db.add(archives[year])
+    for year, a in archives.items():
+        # Mốc khoá sổ ghi trên mọi năm (kể cả năm không có dòng mới), closed_before() lấy max
+        a.rows = (a.rows or 0) + st.years.get(year, 0)
+        a.closed_before, a.closed_at = cut, models.now()
+    db.flush()
+    st.pairs = len(opening)
+    return st
+
+# --------- Đọc lưu trữ ---------
+def _connect(paths: list[tuple[int, str]]):
+    # SQLite mặc định ATTACH tối đa 10 file (SQLITE_MAX_ATTACHED) = 10 năm lưu trữ
+    con = sqlite3.connect(":memory:", uri=True, check_same_thread=False)
+    for year, path in paths:
+        con.execute(f"ATTACH DATABASE ? AS y{int(year)}", (f"file:{quote(path)}?mode=ro",))
+    for table in ("ledger", "ledger_notes"):
+        union = " UNION ALL ".join(f"SELECT * FROM y{int(year)}.{table}" for year, _ in paths)
+        con.execute(f"CREATE TEMP VIEW {table} AS {union}")
+    con.execute("PRAGMA query_only = ON")
+    return con
+
+@contextmanager
+def open_archives(db: Session):
+    """
+    Session chỉ đọc trên mọi file lưu trữ (ATTACH), bảng ledger/ ledger_notes = view gộp các năm.
+    Chưa có file lưu trữ -> None.
+    """
+    A = models.LedgerArchive
+    paths = [(y, p) for y, p in db.execute(select(A.year, A.path).order_by(A.year)).all() if os.path.exists(p)]
+    if not paths:
+        yield None
+        return
+    eng = create_engine("sqlite://", creator=lambda: _connect(paths), poolclass=StaticPool)
+    s = Session(bind=eng)
+    try:
+        yield s
+    finally:
+        s.close()
+        eng.dispose()
+
+def balances_as_of(db: Session, store_id: int, as_of: date) -> list[tuple[models.Ledger, models.Product]]:
+    """
+    Tồn cuối ngày as_of (trong kỳ đã khoá sổ) của cửa hàng, đọc từ file lưu trữ.
+    """
+    cut = datetime.combine(as_of + timedelta(days=1), time.min)
+    L, P = models.Ledger, models.Product
+    with open_archives(db) as a:
+        if a is None:
+            return []
+        # Lọc store/ ngày đi thẳng vào từng file (ix_ledger_s_date), 1 lần sắp theo sản phẩm
+        rn = func.row_number().over(partition_by=L.product_id, order_by=(L.date.desc(), L.id.desc())).label("rn")
+        sub = select(L, rn).where(L.store_id == store_id, L.date < cut).subquery()
+        rows = a.execute(select(aliased(L, sub)).where(sub.c.rn == 1)).scalars().all()
+    prods = {p.id: p for p in db.execute(select(P).where(P.id.in_({r.product_id for r in rows}))).scalars()}
+    return sorted(((r, prods[r.product_id]) for r in rows if r.product_id in prods), key=lambda t: t[1].name)
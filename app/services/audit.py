@@ -0,0 +1,221 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+from .. import models
+from ..db import SessionLocal
+
+log = logging.getLogger(__name__)
+
+# ========================
+# Ghi nhật ký hệ thống theo lô (nền)
+# ========================
+# AUDIT_INVENTORY_IN_TX=1 (mặc định): thao tác kho ghi audit trong cùng transaction nghiệp vụ.
+INVENTORY_IN_TX = os.getenv("AUDIT_INVENTORY_IN_TX", "1") == "1"
+BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "0.5"))  # giây
+# Lô ghi lỗi sau mọi lần thử -> nối vào file JSONL này, ghi lại vào DB khi start() và sau lần ghi thành công kế tiếp
+SPILL_PATH = os.getenv("AUDIT_SPILL_PATH", "audit_spill.jsonl")
+
+class AuditWriter:
+    """
+    Hàng đợi trong tiến trình + 1 thread ghi: gom sự kiện, ghi 1 lần/ lô
+    khi đủ batch_size hoặc sau flush_interval giây. stop() ghi nốt phần còn lại.
+    Khi chưa start (CLI, script) submit() ghi đồng bộ.
+    Lô không ghi được (DB lỗi) không bị bỏ: đổ ra spill_path, ghi lại sau.
+    """
+    def __init__(self, session_factory=SessionLocal, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 spill_path: str = SPILL_PATH):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._spill_lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._q: queue.Queue[dict] = queue.Queue()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self.replay_spill()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._drain()
+
+    def submit(self, event: dict) -> None:
+        event.setdefault("ts", models.now())
+        if self.running:
+            self._q.put(event)
+        else:
+            self._write([event])
+
+    def flush(self) -> None:
+        """
+        Chờ tới khi mọi sự kiện đã nộp được ghi xuống DB.
+        """
+        if self.running:
+            self._q.join()
+        else:
+            self._drain()
+
+    # --------- nội bộ ---------
+    def _take_batch(self, timeout: float) -> list[dict]:
+        try:
+            batch = [self._q.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            left = deadline - time.monotonic()
+            if left <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(self._q.get(timeout=left))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            batch = self._take_batch(self.flush_interval)
+            if not batch:
+                continue
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._q.task_done()
+
+    def _drain(self) -> None:
+        batch = []
+        while True:
+            try:
+                batch.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+        for i in range(0, len(batch), self.batch_size):
+            self._write(batch[i:i + self.batch_size])
+        for _ in batch:
+            self._q.task_done()
+
+    def replay_spill(self) -> int:
+        """
+        Ghi lại các lô đã đổ ra file. Trả về số dòng ghi được; lỗi lần nữa -> dòng quay lại file.
+        """
+        replay = self.spill_path + ".replay"
+        if not self._replay_lock.acquire(blocking=False):
+            return 0  # thread khác đang ghi lại
+        try:
+            with self._spill_lock:
+                # Đổi tên trước khi đọc: lô lỗi mới (kể cả của chính lần ghi lại này) vào file mới.
+                # .replay còn sót (dừng giữa chừng) được ghi lại trước; xoá sau khi ghi (trùng còn hơn mất).
+                if not os.path.exists(replay):
+                    if not os.path.exists(self.spill_path):
+                        return 0
+                    os.replace(self.spill_path, replay)
+            with open(replay, encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            for r in rows:
+                r["ts"] = datetime.fromisoformat(r["ts"])
+            done = 0
+            for i in range(0, len(rows), self.batch_size):
+                chunk = rows[i:i + self.batch_size]
+                if self._write(chunk, replay=False):
+                    done += len(chunk)
+            os.remove(replay)
+        finally:
+            self._replay_lock.release()
+        if done:
+            log.warning("Đã ghi lại %d/%d dòng audit từ %s", done, len(rows), self.spill_path)
+        return done
+
+    def _spill(self, batch: list[dict]) -> None:
+        with self._spill_lock:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for e in batch:
+                    f.write(json.dumps(dict(e, ts=e["ts"].isoformat()), ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _write(self, batch: list[dict], retries: int = 3, replay: bool = True) -> bool:
+        for attempt in range(1, retries + 1):
+            db = self.session_factory()
+            try:
+                db.execute(insert(models.AuditLog), batch)
+                db.commit()
+                break
+            except Exception:
+                db.rollback()
+                if attempt == retries:
+                    # Không được làm mất sự kiện: đổ ra file, ghi lại khi DB ghi được
+                    log.exception("Không ghi được %d dòng audit, lưu tạm vào %s", len(batch), self.spill_path)
+                    try:
+                        self._spill(batch)
+                    except OSError:
+                        log.exception("Không lưu tạm được audit: %r", batch)
+                    return False
+                time.sleep(0.05 * attempt)
+            finally:
+                db.close()
+        if replay and os.path.exists(self.spill_path):
+            self.replay_spill()
+        return True
+
+writer = AuditWriter()
+
+# --------- Truy vấn nhật ký (dùng chung /nhatky, /nhatky/export + queryplan.py) ---------
+def audit_stmt(*, store_code: str = "", by: str = "", action: str = "",
+               d_from: datetime | None = None, d_to: datetime | None = None):
+    """
+    select(AuditLog) theo bộ lọc; store_code rỗng = mọi cửa hàng (người gọi giới hạn theo quyền).
+    """
+    A = models.AuditLog
+    stmt = select(A)
+    if store_code: stmt = stmt.where(A.store_code == store_code)
+    if by: stmt = stmt.where(A.user == by)
+    if action: stmt = stmt.where(A.action == action)
+    if d_from is not None: stmt = stmt.where(A.ts >= d_from)
+    if d_to is not None: stmt = stmt.where(A.ts < d_to)
+    return stmt
+
+# --------- API dùng trong handler ---------
+def _event(user: str, action: str, detail: str, store_code: str | None) -> dict:
+    return dict(ts=models.now(), user=user, action=action, detail=detail, store_code=store_code)
+
+def log_action(user: str, action: str, detail: str, store_code: str | None = None) -> None:
+    """
+    Nộp sự kiện vào hàng đợi (không đụng tới transaction của request).
+    """
+    writer.submit(_event(user, action, detail, store_code))
+
+def commit_with_audit(db: Session, user: str, action: str, detail: str, store_code: str | None = None) -> None:
+    """
+    Commit thao tác kho kèm audit.
+    - INVENTORY_IN_TX: audit nằm trong cùng commit với dòng ledger.
+    - Ngược lại: commit nghiệp vụ trước, audit đi qua hàng đợi.
+    """
+    if INVENTORY_IN_TX:
+        db.add(models.AuditLog(**_event(user, action, detail, store_code)))
+        db.commit()
+    else:
+        db.commit()
+        log_action(user, action, detail, store_code)
@@ -0,0 +1,181 @@
+from __future__ import annotations
+import calendar
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date, timedelta
+import numpy as np
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+from .. import models
+
+# ========================
+# Khấu hao TSCĐ (đường thẳng, theo tháng) — tính bằng mảng numpy
+# ========================
+# Quy ước: 1 tháng khấu hao được tính khi đã trọn tháng kể từ ngày bắt đầu KH, tính cả
+# ngày đánh giá (bắt đầu 20/01 -> 18/02 vẫn 0 tháng, hết ngày 19/02 được 1 tháng; bắt đầu
+# 01/01 -> cuối tháng 1 được 1 tháng). Ngày bắt đầu 29-31 mà tháng đánh giá ngắn hơn ->
+# lấy ngày cuối tháng. Lịch theo tháng lấy giá trị cuối tháng.
+# Kết quả cache theo (ngày/ kỳ, phiên bản danh sách TS); phiên bản lấy từ DB nên mọi worker
+# đều thấy TS mới.
+CACHE_SIZE = 64
+MAX_MONTHS = 1200
+
+@dataclass(frozen=True)
+class Assets:
+    version: tuple
+    codes: list[str]
+    names: list[str]
+    cost: np.ndarray         # nguyên giá
+    life: np.ndarray         # số tháng KH (>= 1)
+    start_month: np.ndarray  # năm*12 + tháng-1 của ngày bắt đầu KH
+    start_day: np.ndarray
+    start_ord: np.ndarray    # date.toordinal() của ngày bắt đầu
+
+    @property
+    def dep_month(self) -> np.ndarray:
+        return self.cost / self.life
+
+@dataclass(frozen=True)
+class Schedule:
+    months: list[str]        # "YYYY-MM"
+    assets: Assets
+    dep: np.ndarray          # (số TS, số tháng) khấu hao trong tháng
+    acc: np.ndarray          # luỹ kế cuối tháng
+    nbv: np.ndarray          # giá trị còn lại cuối tháng
+
+_assets: Assets | None = None
+_results: OrderedDict[tuple, object] = OrderedDict()
+_lock = threading.Lock()
+
+def month_index(d: date) -> int:
+    return d.year * 12 + d.month - 1
+
+def month_label(m: int) -> str:
+    return f"{m // 12}-{m % 12 + 1:02d}"
+
+def asset_version(db: Session) -> tuple:
+    # Chỉ có thêm TS (/tssd/add) -> (số dòng, id lớn nhất) đủ nhận biết thay đổi
+    n, max_id = db.execute(select(func.count(models.FixedAsset.id), func.max(models.FixedAsset.id))).one()
+    return (n or 0, max_id or 0)
+
+def load_assets(db: Session) -> Assets:
+    global _assets
+    version = asset_version(db)
+    with _lock:
+        if _assets is not None and _assets.version == version:
+            return _assets
+    FA = models.FixedAsset
+    rows = db.execute(select(FA.code, FA.name, FA.cost, FA.life_months, FA.start_date).order_by(FA.code)).all()
+    starts = [r.start_date.date() for r in rows]
+    a = Assets(
+        version=version,
+        codes=[r.code for r in rows],
+        names=[r.name for r in rows],
+        cost=np.array([r.cost or 0.0 for r in rows], dtype=np.float64),
+        life=np.array([max(1, r.life_months or 1) for r in rows], dtype=np.int64),
+        start_month=np.array([month_index(d) for d in starts], dtype=np.int64),
+        start_day=np.array([d.day for d in starts], dtype=np.int64),
+        start_ord=np.array([d.toordinal() for d in starts], dtype=np.int64),
+    )
+    with _lock:
+        _assets = a
+        _results.clear()
+    return a
+
+def _cached(key: tuple, compute):
+    with _lock:
+        v = _results.get(key)
+        if v is not None:
+            _results.move_to_end(key)
+            return v
+    v = compute()
+    with _lock:
+        _results[key] = v
+        while len(_results) > CACHE_SIZE:
+            _results.popitem(last=False)
+    return v
+
+def months_elapsed(a: Assets, on: date) -> np.ndarray:
+    """
+    Số tháng đã khấu hao của từng TS tính đến hết ngày `on` (0..life).
+    """
+    nxt = on + timedelta(days=1)  # hết ngày `on` = đầu ngày hôm sau
+    dim = calendar.monthrange(nxt.year, nxt.month)[1]
+    k = month_index(nxt) - a.start_month - (nxt.day < np.minimum(a.start_day, dim))
+    return np.clip(k, 0, a.life)
+
+def as_of(db: Session, on: date, started_only: bool = False) -> dict[str, np.ndarray]:
+    """
+    dep_month / acc / nbv của từng TS tại ngày `on`.
+    started_only: TS có ngày bắt đầu sau `on` có nbv = 0 (chưa có trên sổ).
+    """
+    a = load_assets(db)
+
+    def compute():
+        acc = months_elapsed(a, on) * a.dep_month
+        nbv = np.maximum(0.0, a.cost - acc)
+        if started_only:
+            nbv = np.where(a.start_ord <= on.toordinal(), nbv, 0.0)
+        return dict(dep_month=a.dep_month, acc=acc, nbv=nbv)
+    return _cached(("as_of", on, started_only, a.version), compute)
+
+def total_nbv(db: Session, on: date, started_only: bool = False) -> float:
+    return float(as_of(db, on, started_only)["nbv"].sum())
+
+def asset_rows(db: Session, on: date) -> list[dict]:
+    a = load_assets(db)
+    r = as_of(db, on)
+    return [dict(code=c, name=n, cost=cost, dep_month=dm, acc_dep=acc, nbv=nbv)
+            for c, n, cost, dm, acc, nbv in zip(a.codes, a.names, a.cost.tolist(), r["dep_month"].tolist(),
+                                                r["acc"].tolist(), r["nbv"].tolist())]
+
+def schedule(db: Session, m_from: date, m_to: date) -> Schedule:
+    """
+    Lịch khấu hao mọi TS từ tháng của m_from tới tháng của m_to (giá trị cuối tháng).
+    """
+    a = load_assets(db)
+    first, last = month_index(m_from), month_index(m_to)
+    if last < first:
+        raise ValueError("Kỳ không hợp lệ")
+    if last - first + 1 > MAX_MONTHS:
+        raise ValueError(f"Tối đa {MAX_MONTHS} tháng")
+
+    def compute():
+        # Cuối tháng m = đầu ngày 01 tháng m+1 (như months_elapsed); cột đầu là tháng trước m_from để lấy chênh lệch
+        months = np.arange(first - 1, last + 1, dtype=np.int64)
+        k = months[None, :] + 1 - a.start_month[:, None] - (a.start_day[:, None] > 1)
+        k = np.clip(k, 0, a.life[:, None])
+        acc_all = k * a.dep_month[:, None]
+        acc = acc_all[:, 1:]
+        return Schedule(
+            months=[month_label(int(m)) for m in months[1:]],
+            assets=a,
+            dep=np.diff(acc_all, axis=1),
+            acc=acc,
+            nbv=np.maximum(0.0, a.cost[:, None] - acc),
+        )
+    return _cached(("schedule", first, last, a.version), compute)
+
+# --------- Xuất ---------
+SCHEDULE_CSV_HEADER = ["code", "name", "month", "dep", "acc_dep", "nbv"]
+
+def schedule_csv_rows(s: Schedule):
+    """
+    Dạng dài: mỗi (TS, tháng) 1 dòng; sinh theo từng TS để stream.
+    """
+    a = s.assets
+    for i, (code, name) in enumerate(zip(a.codes, a.names)):
+        for m, dep, acc, nbv in zip(s.months, s.dep[i].tolist(), s.acc[i].tolist(), s.nbv[i].tolist()):
+            yield (code, name, m, round(dep, 2), round(acc, 2), round(nbv, 2))
+
+def schedule_json(s: Schedule) -> dict:
+    a = s.assets
+    return dict(
+        months=s.months,
+        assets=[dict(code=c, name=n, cost=cost, life_months=life, dep=dep, acc_dep=acc, nbv=nbv)
+                for c, n, cost, life, dep, acc, nbv in zip(
+                    a.codes, a.names, a.cost.tolist(), a.life.tolist(),
+                    np.round(s.dep, 2).tolist(), np.round(s.acc, 2).tolist(), np.round(s.nbv, 2).tolist())],
+        total_nbv=np.round(s.nbv.sum(axis=0), 2).tolist(),
+    )
@@ -0,0 +1,64 @@
+from __future__ import annotations
+import csv
+import io
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Sequence
+from fastapi.responses import StreamingResponse
+from ..db import SessionLocal
+
+# ========================
+# Xuất CSV dạng stream
+# ========================
+CHUNK_ROWS = 2000
+
+def csv_stream(
+    stmt,
+    header: Sequence[str],
+    fmt: Callable[[tuple], Sequence] | None = None,
+    chunk_rows: int = CHUNK_ROWS,
+) -> Iterator[str]:
+    """
+    Đọc stmt theo từng khối (yield_per) và trả CSV từng khối một.
+    Dùng session riêng: session của request đã đóng trước khi body được gửi.
+    """
+    db = SessionLocal()
+    try:
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(header)
+        yield buf.getvalue()
+        result = db.execute(stmt.execution_options(yield_per=chunk_rows))
+        for part in result.partitions():
+            buf.seek(0); buf.truncate(0)
+            for r in part:
+                w.writerow(fmt(r) if fmt else r)
+            yield buf.getvalue()
+    finally:
+        db.close()
+
+def csv_response(stmt, header: Sequence[str], filename: str, fmt: Callable[[tuple], Sequence] | None = None) -> StreamingResponse:
+    return StreamingResponse(
+        csv_stream(stmt, header, fmt),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+def rows_csv_response(rows: Iterable[Sequence], header: Sequence[str], filename: str, chunk_rows: int = CHUNK_ROWS) -> StreamingResponse:
+    """
+    Như csv_response nhưng nguồn là iterator dòng đã tính sẵn (không đọc DB).
+    """
+    def gen():
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(header)
+        it = iter(rows)
+        while part := list(islice(it, chunk_rows)):
+            w.writerows(part)
+            yield buf.getvalue()
+            buf.seek(0); buf.truncate(0)
+        yield buf.getvalue()
+    return StreamingResponse(gen(), media_type="text/csv",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+def iso(v) -> str:
+    return v.isoformat() if v else ""
@@ -0,0 +1,42 @@
+from __future__ import annotations
+import os
+import threading
+from collections import OrderedDict
+
+# ========================
+# Cache HTML của bảng báo cáo (trong tiến trình, LRU)
+# ========================
+# Khoá luôn chứa mốc ledger (inventory.ledger_version) của cửa hàng/ sản phẩm = (revision, id mới nhất):
+# ghi ledger -> id đổi, replay/ repair ghi lại dòng cũ -> revision đổi -> khoá cũ không còn được đọc
+# (mọi worker đều thấy, vì mốc lấy từ DB) và bị đẩy ra dần theo LRU.
+MAX_ENTRIES = int(os.getenv("FRAGMENT_CACHE_SIZE", "512"))
+
+_cache: OrderedDict[tuple, str] = OrderedDict()
+_lock = threading.Lock()
+
+def get(key: tuple) -> str | None:
+    with _lock:
+        html = _cache.get(key)
+        if html is not None:
+            _cache.move_to_end(key)
+        return html
+
+def put(key: tuple, html: str) -> str:
+    with _lock:
+        _cache[key] = html
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return html
+
+def invalidate_store(store_code: str) -> None:
+    """
+    Bỏ ngay các bảng của 1 cửa hàng (khoá dạng (loại, store_code, ...)).
+    """
+    with _lock:
+        for k in [k for k in _cache if k[1] == store_code]:
+            del _cache[k]
+
+def clear() -> None:
+    with _lock:
+        _cache.clear()
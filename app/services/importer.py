@@ -0,0 +1,193 @@
+from __future__ import annotations
+import csv
+import itertools
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, TextIO
+from sqlalchemy import select, insert, func, exists
+from sqlalchemy.orm import Session
+from .. import models
+from ..db import begin_write
+from . import archive, summary
+from .inventory import _apply_balance, _calc_in, _calc_out, add_notes, creator, get_latest_state, join_note, parse_line, stock_key
+from .replay import replay_product
+
+# ========================
+# Import ledger từ file CSV lớn (POS, hoá đơn NCC, tồn đầu kỳ)
+# ========================
+# Cột: product_code, qty, price, note, kind (nhap/xuat), store_code (tuỳ chọn), date (tuỳ chọn, ISO).
+# - Đọc từng dòng (không giữ cả file), sản phẩm/ cửa hàng kiểm tra theo map nạp 1 lần;
+# - tồn/ BQ chạy trong bộ nhớ theo (cửa hàng, sản phẩm), bắt đầu từ stock_balance;
+# - ghi theo khối CHUNK_ROWS dòng (executemany) trong 1 transaction; người gọi commit;
+# - dry_run: chỉ kiểm tra, gom tối đa MAX_ERRORS lỗi, không ghi gì.
+# Dòng có ngày sớm hơn ledger sẵn có (hoặc file không theo thứ tự ngày) -> replay từ ngày đó.
+# Ngày trong kỳ đã khoá sổ -> lỗi dòng.
+CHUNK_ROWS = 5000
+MAX_ERRORS = 100
+
+@dataclass
+class ImportStats:
+    dry_run: bool = False
+    lines: int = 0
+    written: int = 0
+    pairs: int = 0
+    replayed: int = 0
+    errors: list[str] = field(default_factory=list)
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def seconds(self) -> float:
+        return time.perf_counter() - self.started
+
+@dataclass
+class _Pair:
+    state: tuple[float, float, float, float]
+    first_date: datetime
+    last_date: datetime
+    unordered: bool = False
+
+def _reader(src: TextIO) -> csv.DictReader:
+    # Excel bản tiếng Việt hay xuất CSV phân cách ';'
+    header = src.readline()
+    delim = ";" if header.count(";") > header.count(",") else ","
+    return csv.DictReader(itertools.chain([header], src), delimiter=delim)
+
+def _parse_date(v: str | None, default: datetime) -> datetime:
+    v = (v or "").strip()
+    if not v:
+        return default
+    try:
+        return datetime.fromisoformat(v)
+    except ValueError:
+        raise ValueError(f"ngày không hợp lệ: {v}")
+
+def import_ledger(
+    db: Session,
+    src: TextIO,
+    *,
+    default_store: str,
+    default_kind: str = "nhap",
+    allowed_stores: list[str] | None = None,
+    created_by: str = "",
+    dry_run: bool = False,
+    chunk_rows: int = CHUNK_ROWS,
+    progress: Callable[[ImportStats], None] | None = None,
+) -> ImportStats:
+    """
+    Import file CSV vào ledger. Không dry_run: lỗi đầu tiên -> ValueError (người gọi rollback).
+    allowed_stores: giới hạn cửa hàng được ghi (None = mọi cửa hàng).
+    """
+    st = ImportStats(dry_run=dry_run)
+    prods = dict(db.execute(select(models.Product.code, models.Product.id)).all())
+    stores = dict(db.execute(select(models.Store.code, models.Store.id)).all())
+    if allowed_stores is not None:
+        stores = {c: i for c, i in stores.items() if c in allowed_stores}
+    uid, by = creator(db, created_by)
+    if not dry_run:
+        begin_write(db)  # SQLite: giữ khoá ghi từ đầu; PostgreSQL: khoá từng mã khi gặp
+    max_id_before = db.execute(select(func.max(models.Ledger.id))).scalar() or 0
+    closed = archive.closed_before(db)
+
+    now = datetime.utcnow()
+    pairs: dict[tuple[str, str], _Pair] = {}
+    daily: dict[tuple[str, object], list[float]] = defaultdict(lambda: [0.0, 0.0])
+    buf: list[dict] = []
+    notes: list[str] = []
+    L = models.Ledger
+
+    def flush_chunk():
+        if buf and not dry_run:
+            if any(notes):
+                ids = db.execute(insert(L).returning(L.id, sort_by_parameter_order=True), buf).scalars().all()
+                add_notes(db, zip(ids, notes))
+            else:
+                db.execute(insert(L.__table__), buf)
+            st.written += len(buf)
+        buf.clear()
+        notes.clear()
+        if progress:
+            progress(st)
+
+    for i, r in enumerate(_reader(src), start=2):  # dòng 1 là header
+        st.lines += 1
+        try:
+            ln = parse_line(i, r, default_kind)
+            store_code = (r.get("store_code") or "").strip() or default_store
+            if store_code not in stores:
+                raise ValueError(f"Dòng {i}: cửa hàng không hợp lệ: {store_code}")
+            code = ln["product_code"]
+            if code not in prods:
+                raise ValueError(f"Dòng {i}: sản phẩm không tồn tại: {code}")
+            try:
+                when = _parse_date(r.get("date"), now)
+            except ValueError as e:
+                raise ValueError(f"Dòng {i}: {e}")
+            if closed is not None and when < closed:
+                raise ValueError(f"Dòng {i}: sổ kho đã khoá trước ngày {closed:%d/%m/%Y}")
+            key = (store_code, code)
+            pair = pairs.get(key)
+            if pair is None:
+                if not dry_run:
+                    begin_write(db, stock_key(store_code, code))
+                pair = pairs[key] = _Pair(get_latest_state(db, store_code, code), when, when)
+            if ln["kind"] == "nhap":
+                state = _calc_in(pair.state, ln["qty"], ln["price"])
+                price, qty_in, qty_out = ln["price"], ln["qty"], 0.0
+                reason = models.Reason.NHAP
+            else:
+                try:
+                    state = _calc_out(pair.state, ln["qty"])
+                except ValueError as e:
+                    raise ValueError(f"Dòng {i} ({code}): {e}")
+                price, qty_in, qty_out = 0.0, 0.0, ln["qty"]
+                reason = models.Reason.XUAT
+        except ValueError as e:
+            if not dry_run:
+                raise
+            if len(st.errors) < MAX_ERRORS:
+                st.errors.append(str(e))
+            continue
+        pair.state = state
+        pair.unordered |= when < pair.last_date
+        pair.first_date = min(pair.first_date, when)
+        pair.last_date = max(pair.last_date, when)
+        buf.append(dict(
+            date=when, store_id=stores[store_code], product_id=prods[code],
+            qty_in=qty_in, price_in=price, qty_out=qty_out, reason=int(reason), created_by_id=uid,
+            stock_after=state[0], avg_price=state[1], onhand_value=state[2], cups=state[3],
+            production_id=None,
+        ))
+        notes.append(join_note(ln["note"], by))
+        d = daily[(store_code, when.date())]
+        d[0] += qty_in * price
+        d[1] += qty_out * state[1]
+        if len(buf) >= chunk_rows:
+            flush_chunk()
+    flush_chunk()
+    st.pairs = len(pairs)
+    if dry_run or not st.written:
+        return st
+
+    # Snapshot: id lớn nhất của từng mã trong các dòng vừa ghi
+    store_codes = {i: c for c, i in stores.items()}
+    product_codes = {i: c for c, i in prods.items()}
+    for sid, pid, last_id in db.execute(
+        select(L.store_id, L.product_id, func.max(L.id)).where(L.id > max_id_before)
+        .group_by(L.store_id, L.product_id)
+    ):
+        sc, pc = store_codes[sid], product_codes[pid]
+        _apply_balance(db, sc, pc, pairs[(sc, pc)].state, last_id)
+    for (sc, day), (v_in, v_out) in daily.items():
+        summary.add_daily(db, sc, day, value_in=v_in, value_out=v_out)
+    db.flush()
+
+    for (sc, pc), pair in pairs.items():
+        backdated = pair.unordered or db.execute(select(exists().where(
+            L.store_id == stores[sc], L.product_id == prods[pc], L.id <= max_id_before, L.date > pair.first_date
+        ))).scalar()
+        if backdated:
+            replay_product(db, sc, pc, since=pair.first_date, strict=True)
+            st.replayed += 1
+    return st
@@ -1,38 +1,395 @@
 from __future__ import annotations
-from sqlalchemy.orm import Session
-from sqlalchemy import select
-from datetime import datetime
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import select, insert, delete, func, event, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime, date, time, timedelta
 from .. import models
+from ..db import begin_write
+from . import archive, fragments, summary
+from . import masterdata as md
 
 # --------- Helpers ---------
+def stock_key(store_code: str, product_code: str) -> str:
+    """
+    Khoá ghi tồn của 1 (cửa hàng, sản phẩm) -> begin_write.
+    """
+    return f"stock:{store_code}:{product_code}"
+
 def _get_product(db: Session, code: str) -> models.Product:
-    p = db.execute(select(models.Product).where(models.Product.code == code)).scalar_one_or_none()
+    p = md.product(db, code)
+    if not p:
+        # Sản phẩm thêm ngoài /dm/products/add (seed, import...): đọc DB và làm mới cache
+        p = db.execute(select(models.Product).where(models.Product.code == code)).scalar_one_or_none()
+        if p:
+            md.invalidate("products")
     if not p:
         raise ValueError(f"Sản phẩm không tồn tại: {code}")
     return p
 
+def _get_store(db: Session, code: str) -> models.Store:
+    s = md.store(db, code)
+    if not s:
+        s = db.execute(select(models.Store).where(models.Store.code == code)).scalar_one_or_none()
+        if s:
+            md.invalidate("stores")
+    if not s:
+        raise ValueError(f"Cửa hàng không tồn tại: {code}")
+    return s
+
+def ledger_keys(db: Session, store_code: str, product_code: str) -> tuple[int, int]:
+    """
+    (store_id, product_id) của ledger theo mã, tra qua cache danh mục.
+    """
+    return _get_store(db, store_code).id, _get_product(db, product_code).id
+
+def creator(db: Session, created_by: str) -> tuple[int | None, str]:
+    """
+    (User.id, phần ghi chú thêm). Người ghi không phải user (CLI --by, job...) -> id None,
+    tên giữ trong ghi chú dạng "(by ...)".
+    """
+    if not created_by:
+        return None, ""
+    uid = md.user_id(db, created_by)
+    if uid is None:
+        uid = db.execute(select(models.User.id).where(models.User.email == created_by)).scalar()
+        if uid is not None:
+            md.invalidate("users")
+    return (uid, "") if uid is not None else (None, f"(by {created_by})")
+
+def join_note(note: str, extra: str) -> str:
+    return " ".join(x for x in ((note or "").strip(), extra) if x)
+
+def add_notes(db: Session, pairs) -> None:
+    """
+    Ghi ledger_notes cho các (ledger_id, note) có ghi chú.
+    """
+    rows = [dict(ledger_id=i, note=n) for i, n in pairs if n]
+    if rows:
+        db.execute(insert(models.LedgerNote), rows)
+
+def reason_text(reason: int, note: str | None) -> str:
+    label = models.REASON_LABELS.get(reason, str(reason))
+    return f"{label}: {note}" if note else label
+
+def ledger_details(db: Session, rows: list[models.Ledger], notes_db: Session | None = None) -> dict[int, tuple[str, str]]:
+    """
+    id -> (lý do hiển thị, email người ghi) cho 1 trang dòng ledger: 2 truy vấn theo id.
+    notes_db: nơi đọc ledger_notes nếu khác db (session lưu trữ).
+    """
+    ids = [r.id for r in rows]
+    notes = dict((notes_db or db).execute(
+        select(models.LedgerNote.ledger_id, models.LedgerNote.note).where(models.LedgerNote.ledger_id.in_(ids))
+    ).all()) if ids else {}
+    uids = {r.created_by_id for r in rows if r.created_by_id}
+    emails = dict(db.execute(
+        select(models.User.id, models.User.email).where(models.User.id.in_(uids))
+    ).all()) if uids else {}
+    return {r.id: (reason_text(r.reason, notes.get(r.id)), emails.get(r.created_by_id, "")) for r in rows}
+
+# --------- Truy vấn nhật ký (dùng chung main.py + queryplan.py) ---------
+def ledger_history_stmt(
+    store_id: int,
+    product_id: int,
+    *,
+    d_from: datetime | None = None,
+    d_to: datetime | None = None,
+    reason: str = "",
+    by: str = "",
+    by_uid: int | None = None,
+):
+    """
+    Dòng ledger của 1 (cửa hàng, sản phẩm) cho /kho/lichsu (chưa sắp/ phân trang).
+    reason: khớp nhãn lý do hoặc ghi chú; by: người ghi (by_uid = User.id nếu là user, còn lại tìm "(by ...)" trong ghi chú).
+    Lọc ghi chú bằng EXISTS theo ledger_id (tra khoá chính ledger_notes cho từng dòng của mã, không quét cả bảng).
+    """
+    L, N = models.Ledger, models.LedgerNote
+
+    def note_has(s: str):
+        return select(N.ledger_id).where(N.ledger_id == L.id, N.note.contains(s, autoescape=True)).exists()
+
+    stmt = select(L).where(L.store_id == store_id, L.product_id == product_id)
+    if d_from is not None:
+        stmt = stmt.where(L.date >= d_from)
+    if d_to is not None:
+        stmt = stmt.where(L.date < d_to)
+    if reason:
+        codes = [int(r) for r, label in models.REASON_LABELS.items() if reason.lower() in label.lower()]
+        stmt = stmt.where(or_(L.reason.in_(codes), note_has(reason)))
+    if by:
+        by_note = note_has(f"(by {by})")
+        stmt = stmt.where(or_(L.created_by_id == by_uid, by_note) if by_uid is not None else by_note)
+    return stmt
+
+def ledger_csv_stmt():
+    """
+    Cột xuất CSV ledger: mã/ tên/ ĐVT, ghi chú, email người ghi join theo khoá số (chưa lọc).
+    """
+    L, S, P, N, U = models.Ledger, models.Store, models.Product, models.LedgerNote, models.User
+    return (select(L.date, S.code, P.code, P.name, P.uom, L.qty_in, L.price_in, L.qty_out, L.reason, N.note,
+                   L.stock_after, L.avg_price, L.onhand_value, L.cups, L.production_id, U.email)
+            .join(S, S.id == L.store_id).join(P, P.id == L.product_id)
+            .outerjoin(N, N.ledger_id == L.id).outerjoin(U, U.id == L.created_by_id))
+
+def ledger_export_stmt(store_ids: list[int], d_from: datetime, d_to: datetime):
+    """
+    CSV /kho/export: nhiều cửa hàng trong khoảng ngày [d_from, d_to).
+    """
+    L = models.Ledger
+    return (ledger_csv_stmt().where(L.store_id.in_(store_ids), L.date >= d_from, L.date < d_to)
+            .order_by(L.store_id, L.date, L.id))
+
 def get_latest_state(db: Session, store_code: str, product_code: str) -> tuple[float, float, float, float]:
     """
     Trả về: (stock_after, avg_price, onhand_value, cups_cumulative)
+    Đọc từ bảng stock_balance (1 lần tra theo khoá chính).
     """
-    row = db.execute(
-        select(models.Ledger)
-        .where(
-            models.Ledger.store_code == store_code,
-            models.Ledger.product_code == product_code
-        )
-        .order_by(models.Ledger.id.desc())
-        .limit(1)
-    ).scalar_one_or_none()
-    if not row:
+    b = db.get(models.StockBalance, (store_code, product_code))
+    if not b:
         return 0.0, 0.0, 0.0, 0.0
     return (
-        float(row.stock_after or 0.0),
-        float(row.avg_price or 0.0),
-        float(row.onhand_value or 0.0),
-        float(row.cups or 0.0),
+        float(b.stock_after or 0.0),
+        float(b.avg_price or 0.0),
+        float(b.onhand_value or 0.0),
+        float(b.cups or 0.0),
     )
 
+def get_state_as_of(db: Session, store_code: str, product_code: str, when: datetime) -> tuple[float, float, float, float]:
+    """
+    Như get_latest_state nhưng tại thời điểm `when` (ghi lùi ngày): giá trị của dòng cuối cùng
+    theo (date, id) có date <= when. Dòng mới ghi với date = when xếp sau các dòng cùng giờ đã có.
+    """
+    L = models.Ledger
+    store_id, product_id = ledger_keys(db, store_code, product_code)
+    r = db.execute(
+        select(L.stock_after, L.avg_price, L.onhand_value, L.cups)
+        .where(L.store_id == store_id, L.product_id == product_id, L.date <= when)
+        .order_by(L.date.desc(), L.id.desc()).limit(1)
+    ).first()
+    return tuple(float(v or 0.0) for v in r) if r else (0.0, 0.0, 0.0, 0.0)
+
+def get_balances(db: Session, store_code: str) -> list[tuple[models.StockBalance, models.Product]]:
+    """
+    Tồn hiện tại của mọi sản phẩm trong cửa hàng, kèm thông tin sản phẩm.
+    """
+    return db.execute(
+        select(models.StockBalance, models.Product)
+        .join(models.Product, models.Product.code == models.StockBalance.product_code)
+        .where(models.StockBalance.store_code == store_code)
+        .order_by(models.Product.name)
+    ).all()
+
+def total_onhand(db: Session, store_code: str) -> float:
+    """
+    Tổng giá trị tồn kho của cửa hàng.
+    """
+    v = db.execute(
+        select(func.sum(models.StockBalance.onhand_value))
+        .where(models.StockBalance.store_code == store_code)
+    ).scalar()
+    return float(v or 0.0)
+
+def total_onhand_by_store(db: Session, store_codes: list[str] | None = None) -> dict[str, float]:
+    """
+    Tổng giá trị tồn theo từng cửa hàng (1 truy vấn GROUP BY). None = mọi cửa hàng.
+    """
+    B = models.StockBalance
+    q = select(B.store_code, func.sum(B.onhand_value)).group_by(B.store_code)
+    if store_codes is not None:
+        q = q.where(B.store_code.in_(store_codes))
+    return {sc: float(v or 0.0) for sc, v in db.execute(q).all()}
+
+def get_balances_for_stores(db: Session, store_codes: list[str] | None = None) -> list[tuple[models.StockBalance, models.Product]]:
+    """
+    Tồn hiện tại của nhiều cửa hàng, sắp theo cửa hàng rồi tên sản phẩm.
+    """
+    B = models.StockBalance
+    q = (
+        select(B, models.Product)
+        .join(models.Product, models.Product.code == B.product_code)
+        .order_by(B.store_code, models.Product.name)
+    )
+    if store_codes is not None:
+        q = q.where(B.store_code.in_(store_codes))
+    return db.execute(q).all()
+
+def ledger_version_stmt(store_code: str, product_code: str | None = None):
+    B, R = models.StockBalance, models.LedgerRevision
+    if product_code:
+        last = select(B.last_ledger_id).where(B.store_code == store_code, B.product_code == product_code)
+    else:
+        last = select(func.max(B.last_ledger_id)).where(B.store_code == store_code)
+    rev = select(R.revision).where(R.store_code == store_code)
+    return select(func.coalesce(rev.scalar_subquery(), 0), func.coalesce(last.scalar_subquery(), 0))
+
+def ledger_version(db: Session, store_code: str, product_code: str | None = None) -> tuple[int, int]:
+    """
+    (revision ghi lại của cửa hàng, id dòng ledger mới nhất của cửa hàng hoặc 1 sản phẩm).
+    Dùng làm mốc trong khoá cache bảng báo cáo: ghi thêm -> id đổi; replay/ repair -> revision đổi.
+    """
+    rev, last = db.execute(ledger_version_stmt(store_code, product_code)).one()
+    return int(rev), int(last)
+
+def bump_revision(db: Session, store_code: str) -> None:
+    """
+    Tăng revision của cửa hàng (cùng transaction): dòng ledger/ snapshot cũ vừa bị ghi lại.
+    """
+    R = models.LedgerRevision
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        ins = (sqlite_insert if dialect == "sqlite" else pg_insert)(R).values(store_code=store_code, revision=1)
+        db.execute(ins.on_conflict_do_update(index_elements=[R.store_code], set_={"revision": R.revision + 1}))
+        return
+    row = db.get(R, store_code)
+    if row is None:
+        db.add(R(store_code=store_code, revision=1))
+    else:
+        row.revision = (row.revision or 0) + 1
+    db.flush()
+
+def _as_of_ids(store_code: str, as_of: date):
+    """
+    Id dòng ledger cuối cùng (theo ngày) của từng sản phẩm tính đến hết ngày as_of.
+    Mỗi sản phẩm 1 lần seek trên ix_ledger_sp_date.
+    """
+    cutoff = datetime.combine(as_of + timedelta(days=1), time.min)
+    x = aliased(models.Ledger)
+    B, P, S = models.StockBalance, models.Product, models.Store
+    sid = select(S.id).where(S.code == store_code).scalar_subquery()
+    last_id = (
+        select(x.id)
+        .where(x.store_id == sid, x.product_id == P.id, x.date < cutoff)
+        .order_by(x.date.desc(), x.id.desc())
+        .limit(1)
+        .correlate(P)
+        .scalar_subquery()
+    )
+    return select(last_id).select_from(B).join(P, P.code == B.product_code).where(B.store_code == store_code)
+
+def _archived(db: Session, as_of: date) -> bool:
+    # Cuối ngày as_of nằm trước dòng tồn đầu kỳ (cutoff - 1µs) -> chỉ file lưu trữ có dữ liệu
+    closed = archive.closed_before(db)
+    return closed is not None and datetime.combine(as_of + timedelta(days=1), time.min) < closed
+
+def get_balances_as_of(db: Session, store_code: str, as_of: date) -> list[tuple[models.Ledger, models.Product]]:
+    """
+    Tồn của cửa hàng tại cuối ngày as_of (1 truy vấn SQL; kỳ đã khoá sổ đọc từ file lưu trữ).
+    Dòng Ledger có cùng tên cột với StockBalance (stock_after, avg_price, onhand_value, cups).
+    """
+    if _archived(db, as_of):
+        return archive.balances_as_of(db, _get_store(db, store_code).id, as_of)
+    L = models.Ledger
+    return db.execute(
+        select(L, models.Product)
+        .join(models.Product, models.Product.id == L.product_id)
+        .where(L.id.in_(_as_of_ids(store_code, as_of)))
+        .order_by(models.Product.name)
+    ).all()
+
+def total_onhand_as_of(db: Session, store_code: str, as_of: date) -> float:
+    if _archived(db, as_of):
+        return sum(float(e.onhand_value or 0.0) for e, _ in get_balances_as_of(db, store_code, as_of))
+    L = models.Ledger
+    v = db.execute(
+        select(func.sum(L.onhand_value)).where(L.id.in_(_as_of_ids(store_code, as_of)))
+    ).scalar()
+    return float(v or 0.0)
+
+def _apply_balance(
+    db: Session,
+    store_code: str,
+    product_code: str,
+    state: tuple[float, float, float, float],
+    ledger_id: int | None,
+) -> models.StockBalance:
+    """
+    Cập nhật snapshot tồn theo dòng ledger vừa ghi (cùng transaction).
+    state = (stock_after, avg_price, onhand_value, cups)
+    """
+    b = db.get(models.StockBalance, (store_code, product_code))
+    if not b:
+        b = models.StockBalance(store_code=store_code, product_code=product_code)
+        db.add(b)
+    b.stock_after, b.avg_price, b.onhand_value, b.cups = state
+    b.last_ledger_id = ledger_id
+    b.updated_at = datetime.utcnow()
+    db.info.setdefault("ledger_stores", set()).add(store_code)
+    return b
+
+@event.listens_for(Session, "after_commit")
+def _drop_store_fragments(session):
+    # Bảng báo cáo đã cache của cửa hàng vừa ghi ledger: bỏ ngay trong tiến trình này
+    for sc in session.info.pop("ledger_stores", ()):
+        fragments.invalidate_store(sc)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_store_fragments(session):
+    session.info.pop("ledger_stores", None)
+
+def _calc_in(
+    state: tuple[float, float, float, float], qty: float, price: float, cups: float = 0.0
+) -> tuple[float, float, float, float]:
+    """
+    Nhập: BQ = (V + qty*price) / (S + qty); cốc cộng dồn.
+    """
+    stock, _, val, cups_now = state
+    new_stock = stock + qty
+    new_val = val + qty * price
+    new_avg = (new_val / new_stock) if new_stock > 0 else 0.0
+    return new_stock, new_avg, new_val, cups_now + float(cups or 0.0)
+
+def _calc_out(state: tuple[float, float, float, float], qty: float, check: bool = True) -> tuple[float, float, float, float]:
+    """
+    Xuất: giữ BQ, giảm giá trị theo BQ, giảm cốc theo tỷ lệ tồn.
+    check=False: cho phép âm kho (replay dữ liệu cũ, báo cáo thay vì chặn).
+    """
+    stock, avg, val, cups_now = state
+    if check and qty > stock + 1e-9:
+        raise ValueError("Âm kho không được phép")
+    if stock > 0 and cups_now > 0:
+        cups_out = qty * (cups_now / stock)
+    else:
+        cups_out = 0.0
+    return stock - qty, avg, val - qty * avg, max(0.0, cups_now - cups_out)
+
+def rebuild_stock_balance(db: Session) -> int:
+    """
+    Dựng lại toàn bộ stock_balance từ dòng ledger mới nhất của từng (cửa hàng, sản phẩm).
+    Trả về số dòng snapshot đã ghi. Không commit.
+    """
+    L, S, P = models.Ledger, models.Store, models.Product
+    last = (
+        select(func.max(L.id).label("mid"))
+        .group_by(L.store_id, L.product_id)
+        .subquery()
+    )
+    src = (
+        select(S.code, P.code, L.stock_after, L.avg_price, L.onhand_value, L.cups, L.id, func.current_timestamp())
+        .join(last, L.id == last.c.mid)
+        .join(S, S.id == L.store_id)
+        .join(P, P.id == L.product_id)
+    )
+    db.execute(delete(models.StockBalance))
+    db.execute(
+        insert(models.StockBalance).from_select(
+            ["store_code", "product_code", "stock_after", "avg_price",
+             "onhand_value", "cups", "last_ledger_id", "updated_at"],
+            src,
+        )
+    )
+    db.flush()
+    return db.execute(select(func.count()).select_from(models.StockBalance)).scalar() or 0
+
+def ensure_stock_balance(db: Session) -> None:
+    """
+    DB cũ (có ledger nhưng chưa có snapshot) -> dựng snapshot một lần.
+    """
+    has_balance = db.execute(select(models.StockBalance.store_code).limit(1)).first()
+    has_ledger = db.execute(select(models.Ledger.id).limit(1)).first()
+    if has_ledger and not has_balance:
+        rebuild_stock_balance(db)
+        db.commit()
+
 # --------- Core ledger writer ---------
 def _write_ledger(
     db: Session,
@@ -43,32 +400,56 @@ def _write_ledger(
     qty_in: float,
     price_in: float,
     qty_out: float,
-    reason: str,
+    reason: models.Reason,
+    note: str,
+    created_by: str,
     stock_after: float,
     avg_price: float,
     onhand_value: float,
     cups_after: float,
+    production_id: int | None = None,
+    cups_in: float = 0.0,
 ) -> models.Ledger:
-    p = _get_product(db, product_code)
+    archive.check_open(db, when)
+    store_id, product_id = ledger_keys(db, store_code, product_code)
+    uid, by = creator(db, created_by)
     e = models.Ledger(
         date=when or datetime.utcnow(),
-        store_code=store_code,
-        product_code=product_code,
-        product_name=p.name,
-        uom=p.uom,
+        store_id=store_id,
+        product_id=product_id,
         qty_in=qty_in,
         price_in=price_in if qty_in > 0 else 0.0,
         qty_out=qty_out,
-        reason=reason or "",
+        reason=int(reason),
+        created_by_id=uid,
         stock_after=stock_after,
         avg_price=avg_price,
         cups=cups_after,
         onhand_value=onhand_value,
+        production_id=production_id,
     )
     db.add(e)
     db.flush()
+    add_notes(db, [(e.id, join_note(note, by))])
+    _apply_balance(db, store_code, product_code, (stock_after, avg_price, onhand_value, cups_after), e.id)
+    summary.add_ledger(db, store_code, e.date, qty_in=qty_in, price_in=e.price_in, qty_out=qty_out,
+                       avg_price=avg_price, production_id=production_id, cups_in=cups_in)
+    db.flush()  # snapshot mới phải thấy được ngay ở lần đọc sau (autoflush=False)
+    if when is not None:
+        _replay_since(db, store_code, product_code, when)
     return e
 
+def _replay_since(db: Session, store_code: str, product_code: str, when: datetime) -> None:
+    # Ghi lùi ngày: giá trị vừa tính theo dòng id lớn nhất -> tính lại từ `when` (âm kho tại thời điểm đó -> ValueError).
+    # Chưa có dòng nào sau `when` (vd. lô sản xuất ghi when=now) -> dòng mới là dòng cuối, không cần replay.
+    L = models.Ledger
+    store_id, product_id = ledger_keys(db, store_code, product_code)
+    later = db.execute(select(L.id).where(L.store_id == store_id, L.product_id == product_id, L.date > when).limit(1)).first()
+    if later is None:
+        return
+    from .replay import replay_product
+    replay_product(db, store_code, product_code, since=when, strict=True)
+
 # --------- Public APIs ---------
 def nhap(
     db: Session,
@@ -81,6 +462,8 @@ def nhap(
     created_by: str = "",
     when: datetime | None = None,
     cups: float = 0.0,  # số cốc tăng thêm khi nhập (nếu là CỐT/MỨT)
+    production_id: int | None = None,
+    reason: models.Reason = models.Reason.NHAP,
 ) -> models.Ledger:
     """
     Nhập kho: cập nhật giá bình quân (BQ) = (V + qty*price) / (S + qty)
@@ -91,16 +474,9 @@ def nhap(
     if qty <= 0:
         raise ValueError("Số lượng nhập phải > 0")
 
-    stock, avg, val, cups_now = get_latest_state(db, store_code, product_code)
-
-    new_stock = stock + qty
-    new_val = val + qty * price
-    new_avg = (new_val / new_stock) if new_stock > 0 else 0.0
-    new_cups = cups_now + float(cups or 0.0)
-
-    reason = (note or "Nhập kho").strip()
-    if created_by:
-        reason = f"{reason} (by {created_by})"
+    begin_write(db, stock_key(store_code, product_code))
+    state = get_latest_state(db, store_code, product_code)
+    new_stock, new_avg, new_val, new_cups = _calc_in(state, qty, price, cups)
 
     return _write_ledger(
         db,
@@ -111,10 +487,14 @@ def nhap(
         price_in=price,
         qty_out=0.0,
         reason=reason,
+        note=note,
+        created_by=created_by,
         stock_after=new_stock,
         avg_price=new_avg,
         onhand_value=new_val,
         cups_after=new_cups,
+        production_id=production_id,
+        cups_in=float(cups or 0.0),
     )
 
 def xuat(
@@ -123,9 +503,11 @@ def xuat(
     store_code: str,
     product_code: str,
     qty: float,
-    reason: str = "Xuất kho",
+    note: str = "",
     created_by: str = "",
     when: datetime | None = None,
+    production_id: int | None = None,
+    reason: models.Reason = models.Reason.XUAT,
 ) -> models.Ledger:
     """
     Xuất kho: giảm tồn theo giá BQ hiện tại.
@@ -137,23 +519,9 @@ def xuat(
     if qty <= 0:
         raise ValueError("Số lượng xuất phải > 0")
 
-    stock, avg, val, cups_now = get_latest_state(db, store_code, product_code)
-
-    if qty > stock + 1e-9:
-        raise ValueError("Âm kho không được phép")
-
-    new_stock = stock - qty
-    new_val = val - qty * avg
-    # Giảm cốc theo tỷ lệ tồn
-    if stock > 0 and cups_now > 0:
-        cups_out = qty * (cups_now / stock)
-    else:
-        cups_out = 0.0
-    new_cups = max(0.0, cups_now - cups_out)
-
-    reason = (reason or "Xuất kho").strip()
-    if created_by:
-        reason = f"{reason} (by {created_by})"
+    begin_write(db, stock_key(store_code, product_code))
+    state = get_latest_state(db, store_code, product_code)
+    new_stock, avg, new_val, new_cups = _calc_out(state, qty)
 
     return _write_ledger(
         db,
@@ -164,10 +532,13 @@ def xuat(
         price_in=0.0,
         qty_out=qty,
         reason=reason,
+        note=note,
+        created_by=created_by,
         stock_after=new_stock,
         avg_price=avg,          # Avg giữ nguyên khi xuất
         onhand_value=new_val,
         cups_after=new_cups,
+        production_id=production_id,
     )
 
 def kiemke(
@@ -183,9 +554,14 @@ def kiemke(
     Kiểm kê: đưa tồn về mức 'actual' bằng cách sinh 1 dòng nhập (+) hoặc 1 dòng xuất (-).
     - Nếu tăng: nhập với price = avg hiện tại (không làm sai lệch avg).
     - Nếu giảm: xuất với qty = -delta.
+    - when (kiểm kê lùi ngày): chênh lệch tính theo tồn tại thời điểm when.
     """
     actual = float(actual or 0.0)
-    stock, avg, _, _ = get_latest_state(db, store_code, product_code)
+    begin_write(db, stock_key(store_code, product_code))
+    if when is None:
+        stock, avg, _, _ = get_latest_state(db, store_code, product_code)
+    else:
+        stock, avg, _, _ = get_state_as_of(db, store_code, product_code, when)
     delta = actual - stock
     if abs(delta) < 1e-9:
         return None
@@ -197,7 +573,7 @@ def kiemke(
             product_code=product_code,
             qty=delta,
             price=avg,
-            note="Kiểm kê (+)",
+            reason=models.Reason.KIEMKE_TANG,
             created_by=created_by,
             when=when,
             cups=0.0,
@@ -209,7 +585,115 @@ def kiemke(
             store_code=store_code,
             product_code=product_code,
             qty=-delta,
-            reason="Kiểm kê (-)",
+            reason=models.Reason.KIEMKE_GIAM,
             created_by=created_by,
             when=when,
         )
+
+# --------- Batch nhập/xuất ---------
+_KIND_ALIASES = {"N": "nhap", "NHAP": "nhap", "NHẬP": "nhap", "IN": "nhap",
+                 "X": "xuat", "XUAT": "xuat", "XUẤT": "xuat", "OUT": "xuat"}
+
+def parse_line(i: int, r: dict, default_kind: str = "nhap") -> dict:
+    """
+    Chuẩn hoá 1 dòng (dict từ JSON hoặc csv.DictReader), i = số dòng để báo lỗi:
+    product_code, qty, price (nhập), note/reason, kind (nhap/xuat, mặc định default_kind).
+    """
+    code = str(r.get("product_code") or "").strip()
+    if not code:
+        raise ValueError(f"Dòng {i}: thiếu product_code")
+    kind_raw = str(r.get("kind") or default_kind).strip().upper()
+    kind = _KIND_ALIASES.get(kind_raw)
+    if not kind:
+        raise ValueError(f"Dòng {i}: loại không hợp lệ: {kind_raw}")
+    try:
+        qty = float(r.get("qty") or 0.0)
+        price = float(r.get("price") or 0.0)
+    except (TypeError, ValueError):
+        raise ValueError(f"Dòng {i}: số lượng/giá không hợp lệ")
+    if qty <= 0:
+        raise ValueError(f"Dòng {i}: số lượng phải > 0")
+    note = str(r.get("note") or r.get("reason") or "").strip()
+    return dict(kind=kind, product_code=code, qty=qty, price=price, note=note)
+
+def parse_batch_lines(rows, default_kind: str = "nhap") -> list[dict]:
+    return [parse_line(i, r, default_kind) for i, r in enumerate(rows, start=1)]
+
+def apply_batch(
+    db: Session,
+    *,
+    store_code: str,
+    lines: list[dict],
+    created_by: str = "",
+    when: datetime | None = None,
+) -> int:
+    """
+    Ghi nhiều dòng nhập/xuất trong 1 transaction (không commit).
+    - Sản phẩm + tồn hiện tại của mọi mã liên quan: 2 truy vấn.
+    - BQ/tồn chạy trong bộ nhớ theo thứ tự dòng (một mã có thể xuất hiện nhiều lần).
+    - Một dòng âm kho -> ValueError, không ghi gì.
+    Trả về số dòng ledger đã ghi.
+    """
+    if not lines:
+        return 0
+    archive.check_open(db, when)
+    codes = {ln["product_code"] for ln in lines}
+    begin_write(db, *(stock_key(store_code, c) for c in codes))
+    prods = {p.code: p for p in db.execute(
+        select(models.Product).where(models.Product.code.in_(codes))
+    ).scalars()}
+    missing = sorted(codes - prods.keys())
+    if missing:
+        raise ValueError(f"Sản phẩm không tồn tại: {', '.join(missing)}")
+    states = {b.product_code: (b.stock_after or 0.0, b.avg_price or 0.0, b.onhand_value or 0.0, b.cups or 0.0)
+              for b in db.execute(
+                  select(models.StockBalance).where(
+                      models.StockBalance.store_code == store_code,
+                      models.StockBalance.product_code.in_(codes),
+                  )
+              ).scalars()}
+
+    date = when or datetime.utcnow()
+    store_id = _get_store(db, store_code).id
+    uid, by = creator(db, created_by)
+    rows, notes = [], []
+    for i, ln in enumerate(lines, start=1):
+        code, qty = ln["product_code"], ln["qty"]
+        state = states.get(code, (0.0, 0.0, 0.0, 0.0))
+        if ln["kind"] == "nhap":
+            price = ln["price"]
+            state = _calc_in(state, qty, price)
+            reason = models.Reason.NHAP
+            qty_in, qty_out = qty, 0.0
+        else:
+            try:
+                state = _calc_out(state, qty)
+            except ValueError as e:
+                raise ValueError(f"Dòng {i} ({code}): {e}")
+            price, qty_in, qty_out = 0.0, 0.0, qty
+            reason = models.Reason.XUAT
+        states[code] = state
+        rows.append(dict(
+            date=date, store_id=store_id, product_id=prods[code].id,
+            qty_in=qty_in, price_in=price, qty_out=qty_out, reason=int(reason), created_by_id=uid,
+            stock_after=state[0], avg_price=state[1], onhand_value=state[2], cups=state[3],
+        ))
+        notes.append(join_note(ln["note"], by))
+
+    ids = db.execute(
+        insert(models.Ledger).returning(models.Ledger.id, sort_by_parameter_order=True),
+        rows,
+    ).scalars().all()
+    add_notes(db, zip(ids, notes))
+    last_id = {ln["product_code"]: lid for ln, lid in zip(lines, ids)}
+    for code, state in states.items():
+        if code in last_id:
+            _apply_balance(db, store_code, code, state, last_id[code])
+    summary.add_daily(db, store_code, date.date(),
+                      value_in=sum(r["qty_in"] * r["price_in"] for r in rows),
+                      value_out=sum(r["qty_out"] * r["avg_price"] for r in rows))
+    db.flush()
+    if when is not None:
+        for code in sorted(last_id):
+            _replay_since(db, store_code, code, when)
+    return len(rows)
@@ -0,0 +1,164 @@
+from __future__ import annotations
+import os
+import threading
+import time
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import event, select, update
+from .. import models
+from . import search  # noqa: F401  đăng ký cập nhật chỉ mục tìm kiếm khi thêm/ sửa Product
+
+# ========================
+# Cache danh mục (trong tiến trình): cửa hàng, nhóm hàng, sản phẩm
+# ========================
+# kind -> {code: object đã expunge khỏi session (chỉ đọc)}; users: {email: id}
+# Các endpoint /dm/*/add, /users/add gọi invalidate(kind) sau khi commit.
+# Nhiều tiến trình: mọi ghi Store/ Category/ Product/ User qua ORM tăng masterdata_version[kind] cùng
+# transaction (mapper event); trước khi phục vụ từ cache, tối đa mỗi CHECK_SECONDS đọc lại bảng đếm
+# (1 truy vấn nhỏ) và bỏ kind đã đổi. Tra mã không thấy -> kiểm tra ngay (thêm ở tiến trình khác).
+CHECK_SECONDS = float(os.getenv("MASTERDATA_CHECK_SECONDS", "2"))
+
+_MODELS = {
+    "stores": (models.Store, models.Store.code),
+    "categories": (models.Category, models.Category.name),
+    "products": (models.Product, models.Product.name),
+}
+_KINDS = {models.Store: "stores", models.Category: "categories", models.Product: "products", models.User: "users"}
+
+_cache: dict[str, dict] = {}
+_lock = threading.Lock()
+_versions: dict[str, int] = {}
+_checked = float("-inf")
+
+# --------- Phiên bản ---------
+def touch(db, *kinds: str) -> None:
+    """
+    Tăng phiên bản danh mục (cùng transaction). Ghi qua ORM đã tự gọi; ghi bằng Core insert/ delete gọi tay.
+    """
+    V = models.MasterdataVersion
+    db.execute(update(V).where(V.kind.in_(kinds)).values(version=V.version + 1))
+
+def _on_saved(mapper, conn, target):
+    touch(conn, _KINDS[mapper.class_])
+
+for _model in _KINDS:
+    for _ev in ("after_insert", "after_update", "after_delete"):
+        event.listen(_model, _ev, _on_saved)
+
+def _versions_stmt():
+    return select(models.MasterdataVersion.kind, models.MasterdataVersion.version)
+
+def _due(force: bool) -> bool:
+    return force or time.monotonic() - _checked >= CHECK_SECONDS
+
+def _sync(versions: dict[str, int]) -> None:
+    global _versions, _checked
+    with _lock:
+        for kind in _versions.keys() | versions.keys():
+            if _versions.get(kind) != versions.get(kind):
+                _cache.pop(kind, None)
+        _versions, _checked = versions, time.monotonic()
+
+def _check(db: Session, force: bool = False) -> None:
+    if _due(force):
+        _sync(dict(db.execute(_versions_stmt()).all()))
+
+async def _acheck(db: AsyncSession, force: bool = False) -> None:
+    if _due(force):
+        _sync(dict((await db.execute(_versions_stmt())).all()))
+
+# --------- Nạp ---------
+def _load(db: Session, kind: str) -> dict:
+    _check(db)
+    data = _cache.get(kind)
+    if data is not None:
+        return data
+    with _lock:
+        data = _cache.get(kind)
+        if data is None:
+            model, order = _MODELS[kind]
+            rows = db.execute(select(model).order_by(order)).scalars().all()
+            for r in rows:
+                db.expunge(r)
+            data = {r.code: r for r in rows}
+            _cache[kind] = data
+    return data
+
+def _load_users(db: Session) -> dict:
+    _check(db)
+    data = _cache.get("users")
+    if data is None:
+        data = dict(db.execute(select(models.User.email, models.User.id)).all())
+        with _lock:
+            data = _cache.setdefault("users", data)
+    return data
+
+async def _aload(db: AsyncSession, kind: str) -> dict:
+    # Bản async: không giữ _lock trong lúc await (lock thread chặn cả event loop)
+    await _acheck(db)
+    data = _cache.get(kind)
+    if data is not None:
+        return data
+    model, order = _MODELS[kind]
+    rows = (await db.execute(select(model).order_by(order))).scalars().all()
+    for r in rows:
+        db.expunge(r)
+    with _lock:
+        return _cache.setdefault(kind, {r.code: r for r in rows})
+
+def invalidate(kind: str | None = None) -> None:
+    with _lock:
+        if kind is None:
+            _cache.clear()
+        else:
+            _cache.pop(kind, None)
+
+def _get(db: Session, kind: str, code: str):
+    obj = _load(db, kind).get(code)
+    if obj is None:
+        _check(db, force=True)
+        obj = _load(db, kind).get(code)
+    return obj
+
+async def _aget(db: AsyncSession, kind: str, code: str):
+    obj = (await _aload(db, kind)).get(code)
+    if obj is None:
+        await _acheck(db, force=True)
+        obj = (await _aload(db, kind)).get(code)
+    return obj
+
+# --------- Truy cập ---------
+def stores(db: Session) -> list[models.Store]:
+    return list(_load(db, "stores").values())
+
+def store(db: Session, code: str) -> models.Store | None:
+    return _get(db, "stores", code)
+
+def categories(db: Session) -> list[models.Category]:
+    return list(_load(db, "categories").values())
+
+def products(db: Session) -> list[models.Product]:
+    """
+    Sắp theo tên sản phẩm.
+    """
+    return list(_load(db, "products").values())
+
+def product(db: Session, code: str) -> models.Product | None:
+    return _get(db, "products", code)
+
+def product_map(db: Session) -> dict[str, models.Product]:
+    return _load(db, "products")
+
+def user_id(db: Session, email: str) -> int | None:
+    uid = _load_users(db).get(email)
+    if uid is None:
+        _check(db, force=True)
+        uid = _load_users(db).get(email)
+    return uid
+
+# --------- Truy cập (async) ---------
+async def astores(db: AsyncSession) -> list[models.Store]:
+    return list((await _aload(db, "stores")).values())
+
+async def astore(db: AsyncSession, code: str) -> models.Store | None:
+    return await _aget(db, "stores", code)
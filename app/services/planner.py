@@ -0,0 +1,132 @@
+from __future__ import annotations
+from dataclasses import dataclass
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from .. import models
+from .production import formula_defs
+
+# ========================
+# Kế hoạch sản xuất: nhu cầu NVL/PG cho nhiều lô (nhiều cửa hàng) — tính bằng mảng numpy
+# ========================
+# Mỗi lô: (store, formula_code, kg_sau[, fruits]).
+# - Phụ gia: qty_per_kg_sau * kg_sau (như preview).
+# - Trái cây: công thức chỉ liệt kê mã (fruits_csv), không có định lượng -> mặc định chia đều kg_sau
+#   cho các mã; lô có thể truyền fruits={"XOAI": 6, ...} (kg thô thực tế, như /sanxuat/start) để thay.
+# - Tồn + đơn giá BQ đọc 1 lần từ stock_balance cho mọi cặp (store, mã) cần dùng.
+# - covered: lô làm được từ tồn hiện tại nếu chạy theo thứ tự danh sách (cộng dồn trong từng cửa hàng).
+# - Chi phí ước tính = nhu cầu * avg_price hiện tại; mã chưa từng có tồn -> giá 0, nằm trong unpriced.
+
+@dataclass
+class Run:
+    store_code: str
+    formula_code: str
+    kg_sau: float
+    fruits: dict[str, float] | None = None
+
+def _coefficients(defs: dict[str, dict], codes: list[str]) -> tuple[list[str], np.ndarray]:
+    """
+    Ma trận hệ số (công thức x mã NVL/PG): lượng cần cho 1 kg_sau.
+    """
+    items: dict[str, int] = {}
+    entries = []
+    for fi, code in enumerate(codes):
+        d = defs[code]
+        fruits = d["fruits"]
+        for fc in fruits:
+            entries.append((fi, items.setdefault(fc, len(items)), 1.0 / len(fruits)))
+        for ac, per in d["additives"]:
+            entries.append((fi, items.setdefault(ac, len(items)), per))
+    coef = np.zeros((len(codes), len(items)))
+    for fi, ii, v in entries:
+        coef[fi, ii] += v
+    return list(items), coef
+
+def plan(db: Session, runs: list[Run]) -> dict:
+    """
+    Nhu cầu gộp theo (cửa hàng, mã), thiếu hụt so với tồn, chi phí ước tính từng lô.
+    Công thức không tồn tại / kg_sau âm -> ValueError.
+    """
+    defs = formula_defs(db)
+    for r in runs:
+        if r.formula_code not in defs:
+            raise ValueError(f"Công thức không tồn tại: {r.formula_code}")
+        if r.kg_sau < 0 or any(q < 0 for q in (r.fruits or {}).values()):
+            raise ValueError(f"Số lượng âm: {r.formula_code}")
+    if not runs:
+        return dict(runs=[], requirements=[], shortfalls=[], unpriced=[], total_cost=0.0)
+
+    f_codes = sorted({r.formula_code for r in runs})
+    f_pos = {c: i for i, c in enumerate(f_codes)}
+    f_idx = np.array([f_pos[r.formula_code] for r in runs])
+    items, coef = _coefficients(defs, f_codes)
+    # Mã trái cây truyền tay ngoài công thức (VD: MUT_COT chọn mã CỐT) -> thêm cột
+    extra = sorted({c for r in runs for c in (r.fruits or {})} - set(items))
+    items += extra
+    coef = np.hstack([coef, np.zeros((len(f_codes), len(extra)))])
+    item_idx = {c: i for i, c in enumerate(items)}
+
+    kg = np.array([float(r.kg_sau) for r in runs])
+    need = coef[f_idx] * kg[:, None]  # (lô x mã)
+    for ri, r in enumerate(runs):
+        if r.fruits is not None:
+            d = defs[r.formula_code]
+            need[ri, [item_idx[c] for c in d["fruits"]]] = 0.0
+            for c, q in r.fruits.items():
+                need[ri, item_idx[c]] = float(q)
+
+    stores = sorted({r.store_code for r in runs})
+    s_pos = {c: i for i, c in enumerate(stores)}
+    s_idx = np.array([s_pos[r.store_code] for r in runs])
+    total = np.zeros((len(stores), len(items)))
+    np.add.at(total, s_idx, need)
+
+    # 1 truy vấn tồn cho (các cửa hàng x các mã) trong kế hoạch
+    onhand = np.zeros_like(total)
+    price = np.zeros_like(total)
+    known = np.zeros(total.shape, dtype=bool)
+    si, ii = np.nonzero(total)
+    if len(si):
+        B = models.StockBalance
+        for sc, pc, qty, avg in db.execute(
+            select(B.store_code, B.product_code, B.stock_after, B.avg_price)
+            .where(B.store_code.in_(stores), B.product_code.in_(items))
+        ).all():
+            s, i = s_pos[sc], item_idx[pc]
+            onhand[s, i], price[s, i], known[s, i] = float(qty or 0.0), float(avg or 0.0), True
+
+    short = np.maximum(total - onhand, 0.0)
+    cost = (need * price[s_idx]).sum(axis=1)
+
+    # Cộng dồn nhu cầu trong từng cửa hàng theo thứ tự lô -> lô nào còn đủ tồn
+    order = np.argsort(s_idx, kind="stable")
+    so = s_idx[order]
+    cum = np.cumsum(need[order], axis=0)
+    first = np.r_[True, so[1:] != so[:-1]]
+    base = np.vstack([np.zeros(len(items)), cum])[np.flatnonzero(first)][np.cumsum(first) - 1]
+    covered = np.empty(len(runs), dtype=bool)
+    covered[order] = ((cum - base) <= onhand[so] + 1e-9).all(axis=1)
+
+    out_runs = []
+    for ri, r in enumerate(runs):
+        d = defs[r.formula_code]
+        kg_tp = r.kg_sau * d["yield_factor"]
+        nz = np.nonzero(need[ri])[0]
+        out_runs.append(dict(
+            store=r.store_code, formula_code=r.formula_code, kg_sau=r.kg_sau,
+            kg_tp=kg_tp, cups=kg_tp * d["cups_per_kg"],
+            inputs={items[i]: float(need[ri, i]) for i in nz},
+            cost=float(cost[ri]), unit_cost=float(cost[ri] / kg_tp) if kg_tp > 0 else 0.0,
+            covered=bool(covered[ri]),
+        ))
+    requirements, shortfalls, unpriced = [], [], []
+    for s, i in zip(si, ii):
+        row = dict(store=stores[s], product_code=items[i], need=float(total[s, i]), onhand=float(onhand[s, i]),
+                   avg_price=float(price[s, i]), short=float(short[s, i]))
+        requirements.append(row)
+        if short[s, i] > 1e-9:
+            shortfalls.append(row)
+        if not known[s, i]:
+            unpriced.append(dict(store=stores[s], product_code=items[i]))
+    return dict(runs=out_runs, requirements=requirements, shortfalls=shortfalls, unpriced=unpriced,
+                total_cost=float(cost.sum()))
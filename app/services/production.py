@@ -1,42 +1,178 @@
 import json
+import threading
 from datetime import datetime
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import select, func
 from .. import models
+from ..db import begin_write
+from .inventory import nhap, xuat, stock_key
 
 # ========================
 # Hỗ trợ Sản xuất
 # ========================
-def preview_additives(formula: models.Formula, kg_sau: float) -> dict[str,float]:
+def parse_additives(additives_json: str | None) -> list[tuple[str, float]]:
     """
-    Tính lượng phụ gia cần theo công thức.
-    additives_json = [{"code": "PG01", "qty_per_kg_sau": 0.2}, ...]
+    additives_json = [{"code": "PG01", "qty_per_kg_sau": 0.2}, ...] -> [("PG01", 0.2), ...]
     """
     try:
-        addons = json.loads(formula.additives_json or "[]")
+        addons = json.loads(additives_json or "[]")
     except Exception:
         addons = []
-    out: dict[str,float] = {}
+    out: list[tuple[str, float]] = []
     for a in addons:
         code = str(a.get("code", "")).strip().upper()
         per = float(a.get("qty_per_kg_sau", 0))
         if code:
-            out[code] = per * kg_sau
+            out.append((code, per))
+    return out
+
+def parse_fruits(fruits_csv: str | None) -> list[str]:
+    return [x.strip() for x in (fruits_csv or "").split(",") if x.strip()]
+
+def _scale(additives: list[tuple[str, float]], kg_sau: float) -> dict[str, float]:
+    out: dict[str, float] = {}
+    for code, per in additives:
+        out[code] = per * kg_sau
     return out
 
-def cost_since_for_formula(db: Session, store_code: str, since: datetime, formula_code: str) -> float:
-    """
-    Tính tổng chi phí NVL/PG đã xuất cho công thức kể từ thời điểm since.
-    Nhận diện dựa trên reason trong ledger có chứa mã công thức.
-    """
-    rows = db.execute(
-        select(models.Ledger).where(
-            models.Ledger.store_code == store_code,
-            models.Ledger.date >= since,
-            models.Ledger.reason.ilike(f"%{formula_code}%")
-        )
-    ).scalars().all()
-    total = 0.0
-    for e in rows:
-        total += (e.qty_out or 0) * (e.avg_price or 0)
-    return total
+def preview_additives(formula: models.Formula, kg_sau: float) -> dict[str,float]:
+    """
+    Tính lượng phụ gia cần theo công thức.
+    """
+    return _scale(parse_additives(formula.additives_json), kg_sau)
+
+# ========================
+# Cache công thức (trong tiến trình)
+# ========================
+# code -> dict(code, name, kind, output_product_code, yield_factor, cups_per_kg, fruits, additives)
+# Mỗi worker giữ bản riêng; /congthuc/add gọi invalidate_formula_cache().
+_formula_cache: dict[str, dict] | None = None
+_formula_lock = threading.Lock()
+
+def _formula_def(f: models.Formula) -> dict:
+    return dict(
+        code=f.code,
+        name=f.name,
+        kind=f.kind,
+        output_product_code=f.output_product_code,
+        yield_factor=float(f.yield_factor or 1.0),
+        cups_per_kg=float(f.cups_per_kg or 0.0),
+        fruits=parse_fruits(f.fruits_csv),
+        additives=parse_additives(f.additives_json),
+    )
+
+def formula_defs(db: Session) -> dict[str, dict]:
+    """
+    Toàn bộ công thức đã parse sẵn; nạp 1 lần cho đến khi bị invalidate.
+    """
+    global _formula_cache
+    cache = _formula_cache
+    if cache is None:
+        with _formula_lock:
+            if _formula_cache is None:
+                rows = db.execute(select(models.Formula)).scalars().all()
+                _formula_cache = {f.code: _formula_def(f) for f in rows}
+            cache = _formula_cache
+    return cache
+
+def get_formula_def(db: Session, code: str) -> dict:
+    d = formula_defs(db).get(code)
+    if d is None:
+        raise ValueError(f"Công thức không tồn tại: {code}")
+    return d
+
+def invalidate_formula_cache() -> None:
+    global _formula_cache
+    with _formula_lock:
+        _formula_cache = None
+
+def preview_runs(db: Session, runs: list[tuple[str, float]]) -> list[dict]:
+    """
+    Preview nhiều (formula_code, kg_sau) trong 1 lần gọi: phụ gia cần + danh sách trái cây.
+    """
+    out = []
+    for code, kg_sau in runs:
+        d = get_formula_def(db, code)
+        out.append(dict(formula_code=code, kg_sau=kg_sau, fruits=d["fruits"], additives=_scale(d["additives"], kg_sau)))
+    return out
+
+def production_cost(db: Session, production_id: int) -> float:
+    """
+    Chi phí NVL/PG đã xuất cho 1 lô: SUM(qty_out * avg_price) trên ix_ledger_production.
+    """
+    v = db.execute(
+        select(func.sum(models.Ledger.qty_out * models.Ledger.avg_price))
+        .where(models.Ledger.production_id == production_id)
+    ).scalar()
+    return float(v or 0.0)
+
+def start_production(
+    db: Session,
+    store_code: str,
+    formula: models.Formula,
+    inputs: dict[str, float],
+    kg_sau: float,
+    created_by: str = "",
+    note: str = "",
+) -> models.ProductionLog:
+    """
+    Tạo lô sản xuất và xuất kho NVL (inputs) + phụ gia theo công thức.
+    - CỐT: lô HOÀN THÀNH ngay (TP nhập kho ở bước gọi).
+    - MỨT: lô WIP, có batch_id để hoàn thành sau (complete_jam).
+    Mọi dòng xuất mang production_id của lô. Không commit.
+    """
+    now = datetime.utcnow()
+    addons = preview_additives(formula, kg_sau)
+    begin_write(db, *(stock_key(store_code, c) for c in list(inputs) + list(addons)))
+    is_cot = formula.kind == "CỐT"
+    plog = models.ProductionLog(
+        date=now,
+        store_code=store_code,
+        kind=formula.kind,
+        formula_code=formula.code,
+        formula_name=formula.name,
+        fruits_json=json.dumps(inputs, ensure_ascii=False),
+        kg_sau=kg_sau,
+        additives_json=json.dumps(addons, ensure_ascii=False),
+        status="HOÀN THÀNH" if is_cot else "WIP",
+        created_by=created_by,
+        note=note,
+        batch_id=None if is_cot else f"{store_code}-{formula.code}-{now:%Y%m%d%H%M%S%f}",
+    )
+    db.add(plog)
+    db.flush()
+    label = plog.batch_id or formula.code
+    for code, qty in list(inputs.items()) + list(addons.items()):
+        if float(qty or 0.0) <= 0:
+            continue
+        xuat(db, store_code=store_code, product_code=code, qty=qty,
+             reason=models.Reason.SX_XUAT, note=label, created_by=created_by, when=now, production_id=plog.id)
+    return plog
+
+def complete_jam(
+    db: Session,
+    store_code: str,
+    batch_id: str,
+    kg_tp: float,
+    unit_cost: float,
+    cups_per_kg: float,
+    output_product_code: str,
+    created_by: str = "",
+) -> float:
+    """
+    Hoàn thành lô MỨT WIP: nhập TP với đơn giá unit_cost, cập nhật lô. Trả về số cốc.
+    """
+    begin_write(db, f"batch:{batch_id}")  # 2 request hoàn thành cùng lô: request sau thấy trạng thái mới
+    log = db.execute(
+        select(models.ProductionLog).where(models.ProductionLog.batch_id == batch_id)
+    ).scalar_one()
+    if log.status != "WIP":
+        raise ValueError(f"Lô {batch_id} đã hoàn thành")
+    cups = kg_tp * (cups_per_kg or 0.0)
+    nhap(db, store_code=store_code, product_code=output_product_code, qty=kg_tp, price=unit_cost,
+         reason=models.Reason.SX_NHAP, note=f"MỨT {batch_id}", created_by=created_by, cups=cups, production_id=log.id)
+    log.kg_tp = kg_tp
+    log.cups = cups
+    log.status = "HOÀN THÀNH"
+    db.flush()
+    return cups
@@ -0,0 +1,230 @@
+from __future__ import annotations
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from sqlalchemy import select, update, tuple_
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+from .. import models
+from ..db import SessionLocal, begin_write, engine
+from . import summary
+from .inventory import _apply_balance, _calc_in, _calc_out, bump_revision, ledger_keys, stock_key
+
+# ========================
+# Replay ledger: tính lại tồn/ BQ/ giá trị/ cốc theo thứ tự ngày
+# ========================
+# Giá trị chạy trên mỗi dòng ledger được tính lúc ghi từ dòng có id lớn nhất; dòng ghi lùi ngày
+# (when=...) hoặc sửa tay làm sai mọi dòng sau nó. Replay 1 (cửa hàng, sản phẩm):
+# - điểm xuất phát = dòng cuối cùng trước `since` (coi là đúng), không có since -> từ 0;
+# - duyệt theo (date, id), tính lại bằng _calc_in/_calc_out, chỉ UPDATE dòng bị lệch; dòng kiểm kê thừa
+#   (Reason.KIEMKE_TANG) nhập theo BQ đang chạy -> price_in được ghi lại;
+# - cập nhật stock_balance và daily_summary.value_in/ value_out (giá nhập kiểm kê, giá trị xuất theo BQ mới);
+# - có dòng/ snapshot bị ghi lại -> tăng ledger_revision của cửa hàng (mốc khoá cache báo cáo).
+# Số cốc nhập chỉ biết được với dòng TP có production_id (lấy production_logs.cups);
+# dòng nhập khác coi như không thêm cốc. Dòng tồn đầu kỳ (Reason.DAU_KY, sau khoá sổ) đặt lại trạng thái
+# bằng giá trị đã lưu của nó.
+State = tuple[float, float, float, float]  # (stock_after, avg_price, onhand_value, cups)
+EPS = 1e-6
+VERIFY_CHUNK = 64  # số (cửa hàng, sản phẩm) mỗi task của process pool
+
+@dataclass
+class Violation:
+    store_code: str
+    product_code: str
+    ledger_id: int
+    date: datetime
+    stock_before: float
+    qty_out: float
+
+@dataclass
+class ReplayResult:
+    store_code: str
+    product_code: str
+    rows: int = 0
+    changed: list[dict] = field(default_factory=list)  # {id, date, qty_in, qty_out, old_price, old_avg, price_in, stock_after, ...}
+    violations: list[Violation] = field(default_factory=list)
+    state: State = (0.0, 0.0, 0.0, 0.0)
+    last_id: int | None = None
+
+def _differs(a: float, b: float) -> bool:
+    return abs((a or 0.0) - b) > EPS * max(1.0, abs(b))
+
+def _rows_stmt(store_id: int, product_id: int, since: datetime | None):
+    L, PL = models.Ledger, models.ProductionLog
+    q = (
+        select(L.id, L.date, L.reason, L.qty_in, L.price_in, L.qty_out,
+               L.stock_after, L.avg_price, L.onhand_value, L.cups, PL.cups)
+        .outerjoin(PL, PL.id == L.production_id)
+        .where(L.store_id == store_id, L.product_id == product_id)
+        .order_by(L.date, L.id)
+    )
+    return q.where(L.date >= since) if since is not None else q
+
+def _checkpoint(db: Session, store_id: int, product_id: int, since: datetime | None) -> State:
+    if since is None:
+        return (0.0, 0.0, 0.0, 0.0)
+    L = models.Ledger
+    r = db.execute(
+        select(L.stock_after, L.avg_price, L.onhand_value, L.cups)
+        .where(L.store_id == store_id, L.product_id == product_id, L.date < since)
+        .order_by(L.date.desc(), L.id.desc()).limit(1)
+    ).first()
+    return tuple(float(v or 0.0) for v in r) if r else (0.0, 0.0, 0.0, 0.0)
+
+def replay_rows(res: ReplayResult, rows, state: State, strict: bool = False) -> ReplayResult:
+    """
+    Tính lại chuỗi dòng (đã sắp theo date, id) từ state. Không đụng DB.
+    strict: âm kho -> ValueError; ngược lại ghi vào res.violations và tính tiếp.
+    """
+    for lid, when, reason, qty_in, price_in, qty_out, s_after, s_avg, s_val, s_cups, prod_cups in rows:
+        qty_in, qty_out = qty_in or 0.0, qty_out or 0.0
+        if reason == models.Reason.DAU_KY:
+            state = tuple(float(v or 0.0) for v in (s_after, s_avg, s_val, s_cups))
+        old_price = price_in or 0.0
+        # Kiểm kê thừa nhập theo BQ đang chạy (như kiemke), không theo giá đã lưu lúc ghi
+        price = state[1] if reason == models.Reason.KIEMKE_TANG else old_price
+        if qty_in > 0:
+            state = _calc_in(state, qty_in, price, prod_cups or 0.0)
+        if qty_out > 0:
+            if qty_out > state[0] + 1e-9:
+                if strict:
+                    raise ValueError(f"Âm kho không được phép ({res.product_code}, {when:%Y-%m-%d %H:%M}): "
+                                     f"tồn {state[0]:g}, xuất {qty_out:g}")
+                res.violations.append(Violation(res.store_code, res.product_code, lid, when, state[0], qty_out))
+            state = _calc_out(state, qty_out, check=False)
+        if (_differs(s_after, state[0]) or _differs(s_avg, state[1]) or _differs(s_val, state[2])
+                or _differs(s_cups, state[3]) or (qty_in > 0 and _differs(old_price, price))):
+            res.changed.append(dict(id=lid, date=when, qty_in=qty_in, qty_out=qty_out, old_price=old_price,
+                                    old_avg=s_avg or 0.0, price_in=price if qty_in > 0 else old_price,
+                                    stock_after=state[0], avg_price=state[1], onhand_value=state[2], cups=state[3]))
+        res.rows += 1
+        res.last_id = lid if res.last_id is None else max(res.last_id, lid)
+    res.state = state
+    return res
+
+def replay_product(
+    db: Session,
+    store_code: str,
+    product_code: str,
+    since: datetime | None = None,
+    strict: bool = False,
+) -> ReplayResult:
+    """
+    Replay 1 (cửa hàng, sản phẩm) và ghi các dòng lệch (bulk UPDATE theo id). Không commit.
+    """
+    begin_write(db, stock_key(store_code, product_code))
+    res = ReplayResult(store_code, product_code)
+    sid, pid = ledger_keys(db, store_code, product_code)
+    state = _checkpoint(db, sid, pid, since)
+    replay_rows(res, db.execute(_rows_stmt(sid, pid, since)), state, strict)
+    if res.changed:
+        db.execute(update(models.Ledger), [
+            {k: c[k] for k in ("id", "price_in", "stock_after", "avg_price", "onhand_value", "cups")} for c in res.changed
+        ])
+        for c in res.changed:
+            # Dòng đang nằm trong session (vd. vừa ghi) phải đọc lại giá trị mới
+            obj = db.identity_map.get(identity_key(models.Ledger, c["id"]))
+            if obj is not None:
+                db.expire(obj)
+        value_in, value_out = defaultdict(float), defaultdict(float)
+        for c in res.changed:
+            if c["qty_in"]:
+                value_in[c["date"].date()] += c["qty_in"] * (c["price_in"] - c["old_price"])
+            if c["qty_out"]:
+                value_out[c["date"].date()] += c["qty_out"] * (c["avg_price"] - c["old_avg"])
+        for day in value_in.keys() | value_out.keys():
+            summary.add_daily(db, store_code, day, value_in=value_in.get(day, 0.0), value_out=value_out.get(day, 0.0))
+    stale = False
+    if res.rows:
+        b = db.get(models.StockBalance, (store_code, product_code))
+        stale = b is None or any(_differs(v, s) for v, s in zip(
+            (b.stock_after, b.avg_price, b.onhand_value, b.cups), res.state))
+        # Dòng cuối theo ngày có thể không phải id lớn nhất: last_ledger_id giữ id lớn nhất (mốc cache)
+        last_id = max(res.last_id, (b.last_ledger_id or 0) if b else 0)
+        _apply_balance(db, store_code, product_code, res.state, last_id)
+    if res.changed or stale:
+        # Ghi lại dòng cũ/ snapshot không đổi id lớn nhất -> tăng revision để cache mọi worker bỏ bảng cũ
+        bump_revision(db, store_code)
+    db.flush()
+    return res
+
+# --------- Kiểm tra toàn DB (song song) ---------
+@dataclass
+class VerifyReport:
+    pairs: int = 0
+    rows: int = 0
+    mismatched: list[tuple[str, str, int, int]] = field(default_factory=list)  # (store, product, số dòng lệch, id đầu tiên)
+    balance_mismatched: list[tuple[str, str]] = field(default_factory=list)
+    violations: list[Violation] = field(default_factory=list)
+
+def _pairs(db: Session) -> list[tuple[str, str, int, int]]:
+    # (store_code, product_code, store_id, product_id)
+    L, S, P = models.Ledger, models.Store, models.Product
+    ids = select(L.store_id, L.product_id).distinct().subquery()
+    return [tuple(r) for r in db.execute(
+        select(S.code, P.code, ids.c.store_id, ids.c.product_id)
+        .join(S, S.id == ids.c.store_id).join(P, P.id == ids.c.product_id)
+        .order_by(S.code, P.code)
+    )]
+
+def _worker_init() -> None:
+    # Tiến trình con (fork) không dùng lại connection của tiến trình cha
+    engine.dispose(close=False)
+
+def _verify_chunk(pairs: list[tuple[str, str, int, int]]) -> VerifyReport:
+    out = VerifyReport()
+    db = SessionLocal()
+    try:
+        B = models.StockBalance
+        balances = {(b.store_code, b.product_code): b for b in db.execute(
+            select(B).where(tuple_(B.store_code, B.product_code).in_([p[:2] for p in pairs]))
+        ).scalars()}
+        for sc, pc, sid, pid in pairs:
+            res = replay_rows(ReplayResult(sc, pc), db.execute(_rows_stmt(sid, pid, None)), (0.0, 0.0, 0.0, 0.0))
+            out.pairs += 1
+            out.rows += res.rows
+            out.violations += res.violations
+            if res.changed:
+                out.mismatched.append((sc, pc, len(res.changed), min(c["id"] for c in res.changed)))
+            b = balances.get((sc, pc))
+            if b is None or any(_differs(v, s) for v, s in zip(
+                    (b.stock_after, b.avg_price, b.onhand_value, b.cups), res.state)):
+                out.balance_mismatched.append((sc, pc))
+    finally:
+        db.close()
+    return out
+
+def verify_all(workers: int | None = None) -> VerifyReport:
+    """
+    Replay mọi (cửa hàng, sản phẩm) trong process pool, chỉ đọc.
+    Trả về các chuỗi bị lệch, snapshot lệch và các lần âm kho.
+    """
+    db = SessionLocal()
+    try:
+        pairs = _pairs(db)
+    finally:
+        db.close()
+    chunks = [pairs[i:i + VERIFY_CHUNK] for i in range(0, len(pairs), VERIFY_CHUNK)]
+    workers = workers or min(len(chunks), os.cpu_count() or 1)
+    if workers <= 1:
+        results = [_verify_chunk(c) for c in chunks]
+    else:
+        engine.dispose()  # không để connection mở trước khi fork
+        with ProcessPoolExecutor(max_workers=workers, initializer=_worker_init) as pool:
+            results = list(pool.map(_verify_chunk, chunks))
+    total = VerifyReport()
+    for r in results:
+        total.pairs += r.pairs
+        total.rows += r.rows
+        total.mismatched += r.mismatched
+        total.balance_mismatched += r.balance_mismatched
+        total.violations += r.violations
+    return total
+
+def repair(db: Session, pairs: list[tuple[str, str]]) -> int:
+    """
+    Replay từ đầu và ghi lại các (cửa hàng, sản phẩm) đã cho. Trả về số dòng đã sửa. Không commit.
+    """
+    return sum(len(replay_product(db, sc, pc).changed) for sc, pc in pairs)
@@ -0,0 +1,94 @@
+from __future__ import annotations
+import os
+import re
+import unicodedata
+from sqlalchemy import event, text, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from .. import models
+
+# ========================
+# Tìm sản phẩm không dấu (chỉ mục product_search)
+# ========================
+# body = mã + tên đã bỏ dấu, chữ thường ("Xoài" -> "xoai", "Đường" -> "duong").
+# - SQLite: bảng ảo FTS5, rowid = products.id, mỗi từ khoá khớp tiền tố ("xo" -> "xoai").
+# - PostgreSQL: bảng thường, so LIKE theo đầu từ (quét tuần tự, đủ nhanh cho vài chục nghìn mã).
+# Cập nhật cùng transaction qua mapper event của Product (mọi nơi thêm/ sửa sản phẩm qua ORM).
+SEARCH_LIMIT = int(os.getenv("PRODUCT_SEARCH_LIMIT", "50"))
+
+_TOKEN = re.compile(r"[^\W_]+")
+
+def fold(s: str) -> str:
+    s = unicodedata.normalize("NFD", s or "").replace("đ", "d").replace("Đ", "D")
+    return "".join(ch for ch in s if not unicodedata.combining(ch)).lower()
+
+def _body(code: str, name: str) -> str:
+    return " ".join(_TOKEN.findall(fold(f"{code} {name}")))
+
+def tokens(q: str) -> list[str]:
+    return _TOKEN.findall(fold(q))
+
+# --------- Schema + cập nhật ---------
+def create_index(conn: Connection) -> None:
+    """
+    Tạo bảng chỉ mục (nếu chưa có) và nạp lại từ products. Dùng trong migration.
+    """
+    if conn.dialect.name == "sqlite":
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(body, tokenize='unicode61')"))
+    else:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS product_search (product_id INTEGER PRIMARY KEY, body VARCHAR NOT NULL)"))
+    conn.execute(text("DELETE FROM product_search"))
+    rows = conn.execute(select(models.Product.id, models.Product.code, models.Product.name)).all()
+    if rows:
+        conn.execute(text(f"INSERT INTO product_search ({_id_col(conn)}, body) VALUES (:id, :body)"),
+                     [dict(id=i, body=_body(c, n)) for i, c, n in rows])
+
+def _id_col(conn: Connection) -> str:
+    return "rowid" if conn.dialect.name == "sqlite" else "product_id"
+
+def _index_product(conn: Connection, p: models.Product) -> None:
+    col = _id_col(conn)
+    conn.execute(text(f"DELETE FROM product_search WHERE {col} = :id"), dict(id=p.id))
+    conn.execute(text(f"INSERT INTO product_search ({col}, body) VALUES (:id, :body)"),
+                 dict(id=p.id, body=_body(p.code, p.name)))
+
+@event.listens_for(models.Product, "after_insert")
+@event.listens_for(models.Product, "after_update")
+def _on_product_saved(mapper, conn, target):
+    _index_product(conn, target)
+
+@event.listens_for(models.Product, "after_delete")
+def _on_product_deleted(mapper, conn, target):
+    conn.execute(text(f"DELETE FROM product_search WHERE {_id_col(conn)} = :id"), dict(id=target.id))
+
+# --------- Tìm ---------
+def _match_ids(db: Session, toks: list[str], limit: int):
+    if db.get_bind().dialect.name == "sqlite":
+        # Mỗi từ khoá thành "từ"* (tiền tố), các từ nối AND. Không ORDER BY rank: bm25 phải chấm mọi dòng khớp
+        # (từ khoá ngắn khớp hàng nghìn mã); LIMIT dừng sớm, sắp lại theo tên ở search_products
+        q = " ".join('"' + t.replace('"', '""') + '"*' for t in toks)
+        return db.execute(text("SELECT rowid FROM product_search WHERE product_search MATCH :q LIMIT :n"),
+                          dict(q=q, n=limit)).scalars().all()
+    conds = " AND ".join(f"(' ' || body) LIKE :t{i}" for i in range(len(toks)))
+    params = {f"t{i}": "% " + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+              for i, t in enumerate(toks)}
+    return db.execute(text(f"SELECT product_id FROM product_search WHERE {conds} LIMIT :n"),
+                      dict(params, n=limit)).scalars().all()
+
+def search_products(db: Session, q: str, limit: int = SEARCH_LIMIT) -> list[models.Product]:
+    """
+    Sản phẩm khớp mọi từ khoá (không dấu, theo tiền tố), tối đa `limit`; mã trùng hẳn từ khoá lên đầu, còn lại theo tên.
+    """
+    toks = tokens(q)
+    if not toks:
+        return []
+    ids = _match_ids(db, toks, limit)
+    # Không xếp hạng + LIMIT có thể cắt mất mã gõ đúng -> tra thẳng theo mã (index unique)
+    hit = db.execute(select(models.Product.id).where(models.Product.code == q.strip())).scalar()
+    if hit is not None and hit not in ids:
+        ids = [hit, *ids[:limit - 1]]
+    if not ids:
+        return []
+    rows = db.execute(select(models.Product).where(models.Product.id.in_(ids))).scalars().all()
+    exact = fold(q).strip()
+    return sorted(rows, key=lambda p: (fold(p.code) != exact, p.name))
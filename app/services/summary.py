@@ -0,0 +1,177 @@
+from __future__ import annotations
+from datetime import date, datetime
+from sqlalchemy import select, delete, insert, func, and_, true
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from .. import models
+from . import archive
+
+# ========================
+# Tổng hợp theo ngày (daily_summary)
+# ========================
+# Mỗi (cửa hàng, ngày UTC) 1 dòng. Cập nhật cộng dồn trong cùng transaction với
+# dòng revenue/ ledger gốc; rebuild_daily_summary() dựng lại từ lịch sử.
+FIELDS = ("cash", "bank", "value_in", "value_out", "prod_kg", "prod_cups")
+PERIODS = ("day", "month", "year")
+
+def add_daily(db: Session, store_code: str, day: date, **deltas: float) -> None:
+    """
+    Cộng deltas (các cột trong FIELDS) vào dòng (store_code, day). Không commit.
+    """
+    deltas = {k: float(v) for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    D = models.DailySummary
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        ins = (sqlite_insert if dialect == "sqlite" else pg_insert)(D).values(store_code=store_code, day=day, **deltas)
+        db.execute(ins.on_conflict_do_update(
+            index_elements=[D.store_code, D.day],
+            set_={k: getattr(D, k) + getattr(ins.excluded, k) for k in deltas},
+        ))
+        return
+    row = db.get(D, (store_code, day))
+    if row is None:
+        row = D(store_code=store_code, day=day, **{k: 0.0 for k in FIELDS})
+        db.add(row)
+    for k, v in deltas.items():
+        setattr(row, k, (getattr(row, k) or 0.0) + v)
+    db.flush()
+
+def add_ledger(
+    db: Session,
+    store_code: str,
+    when: datetime,
+    *,
+    qty_in: float,
+    price_in: float,
+    qty_out: float,
+    avg_price: float,
+    production_id: int | None = None,
+    cups_in: float = 0.0,
+) -> None:
+    """
+    Cập nhật theo 1 dòng ledger. TP sản xuất = dòng nhập có production_id.
+    """
+    is_prod = production_id is not None and qty_in > 0
+    add_daily(
+        db, store_code, when.date(),
+        value_in=qty_in * price_in,
+        value_out=qty_out * avg_price,
+        prod_kg=qty_in if is_prod else 0.0,
+        prod_cups=cups_in if is_prod else 0.0,
+    )
+
+# --------- Đọc ---------
+def _range(store_codes: list[str], d_from: date, d_to: date):
+    D = models.DailySummary
+    return and_(D.store_code.in_(store_codes), D.day >= d_from, D.day <= d_to)
+
+def revenue_total(db: Session, store_code: str, d_from: date, d_to: date) -> float:
+    """
+    Tổng TM + CK của cửa hàng từ d_from tới d_to (tính cả 2 đầu).
+    """
+    D = models.DailySummary
+    v = db.execute(select(func.sum(D.cash + D.bank)).where(_range([store_code], d_from, d_to))).scalar()
+    return float(v or 0.0)
+
+def revenue_totals(db: Session, store_code: str, d_from: date, d_to: date) -> tuple[float, float]:
+    D = models.DailySummary
+    cash, bank = db.execute(select(func.sum(D.cash), func.sum(D.bank)).where(_range([store_code], d_from, d_to))).first()
+    return float(cash or 0.0), float(bank or 0.0)
+
+def revenue_by_store(db: Session, store_codes: list[str], d_from: date, d_to: date) -> dict[str, float]:
+    D = models.DailySummary
+    rows = db.execute(
+        select(D.store_code, func.sum(D.cash + D.bank)).where(_range(store_codes, d_from, d_to)).group_by(D.store_code)
+    ).all()
+    return {sc: float(v or 0.0) for sc, v in rows}
+
+def _period_key(d: date, period: str) -> str:
+    if period == "year":
+        return f"{d.year}"
+    if period == "month":
+        return f"{d.year}-{d.month:02d}"
+    return d.isoformat()
+
+def period_report(db: Session, store_codes: list[str], d_from: date, d_to: date, period: str = "day") -> list[dict]:
+    """
+    Gộp daily_summary theo ngày/ tháng/ năm (cộng mọi cửa hàng đã chọn).
+    Đọc tối đa (số ngày x số cửa hàng) dòng; gộp tháng/ năm bằng Python (không phụ thuộc hàm ngày của DB).
+    """
+    D = models.DailySummary
+    rows = db.execute(
+        select(D.day, *(func.sum(getattr(D, k)) for k in FIELDS))
+        .where(_range(store_codes, d_from, d_to)).group_by(D.day).order_by(D.day)
+    ).all()
+    out: dict[str, dict] = {}
+    for day, *vals in rows:
+        g = out.setdefault(_period_key(day, period), dict(period=_period_key(day, period), **{k: 0.0 for k in FIELDS}))
+        for k, v in zip(FIELDS, vals):
+            g[k] += float(v or 0.0)
+    return list(out.values())
+
+# --------- Dựng lại từ lịch sử ---------
+def _as_date(v) -> date:
+    # func.date(): SQLite trả chuỗi 'YYYY-MM-DD', PostgreSQL trả date
+    return v if isinstance(v, date) else date.fromisoformat(str(v))
+
+def rebuild_daily_summary(db: Session) -> int:
+    """
+    Xoá và dựng lại toàn bộ daily_summary từ revenues + ledger (+ production_logs cho số cốc).
+    Dòng ledger TP cũ (trước khi có ledger.production_id) không tính được vào prod_kg/prod_cups.
+    Ngày trong kỳ đã khoá sổ: giữ phần giá trị kho/ sản xuất hiện có (ledger đã sang file lưu trữ).
+    Trả về số dòng đã ghi. Không commit.
+    """
+    R, L, PL, D = models.Revenue, models.Ledger, models.ProductionLog, models.DailySummary
+    acc: dict[tuple[str, date], dict[str, float]] = {}
+
+    def bucket(sc, d):
+        return acc.setdefault((sc, _as_date(d)), {k: 0.0 for k in FIELDS})
+
+    closed = archive.closed_before(db)
+    ledger_fields = ("value_in", "value_out", "prod_kg", "prod_cups")
+    if closed is not None:
+        for row in db.execute(select(D).where(D.day < closed.date())).scalars():
+            b = bucket(row.store_code, row.day)
+            for k in ledger_fields:
+                b[k] = getattr(row, k) or 0.0
+
+    rday = func.date(R.date)
+    for sc, d, cash, bank in db.execute(
+        select(R.store_code, rday, func.sum(R.cash), func.sum(R.bank)).group_by(R.store_code, rday)
+    ):
+        b = bucket(sc, d); b["cash"] += cash or 0.0; b["bank"] += bank or 0.0
+    lday = func.date(L.date)
+    store_codes = dict(db.execute(select(models.Store.id, models.Store.code)).all())
+    open_rows = L.date >= closed if closed is not None else true()
+    for sid, d, v_in, v_out in db.execute(
+        select(L.store_id, lday, func.sum(L.qty_in * L.price_in), func.sum(L.qty_out * L.avg_price))
+        .where(open_rows).group_by(L.store_id, lday)
+    ):
+        b = bucket(store_codes[sid], d); b["value_in"] += v_in or 0.0; b["value_out"] += v_out or 0.0
+    for sid, d, kg, cups in db.execute(
+        select(L.store_id, lday, func.sum(L.qty_in), func.sum(PL.cups))
+        .join(PL, PL.id == L.production_id).where(L.qty_in > 0, open_rows)
+        .group_by(L.store_id, lday)
+    ):
+        b = bucket(store_codes[sid], d); b["prod_kg"] += kg or 0.0; b["prod_cups"] += cups or 0.0
+
+    db.execute(delete(D))
+    if acc:
+        db.execute(insert(models.DailySummary), [dict(store_code=sc, day=d, **vals) for (sc, d), vals in acc.items()])
+    db.flush()
+    return len(acc)
+
+def ensure_daily_summary(db: Session) -> None:
+    """
+    DB cũ (có revenue/ ledger nhưng chưa có daily_summary) -> dựng một lần.
+    """
+    if db.execute(select(models.DailySummary.store_code).limit(1)).first():
+        return
+    has_data = (db.execute(select(models.Revenue.id).limit(1)).first()
+                or db.execute(select(models.Ledger.id).limit(1)).first())
+    if has_data:
+        rebuild_daily_summary(db)
+        db.commit()
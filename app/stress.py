@@ -0,0 +1,125 @@
+"""
+Kiểm tra ghi kho đồng thời: nhiều thread (mỗi thread 1 session/connection riêng)
+cùng xuất 1 sản phẩm cho tới khi hết tồn. Đạt khi:
+- không có dòng ledger âm kho, tổng xuất = tồn ban đầu (không mất cập nhật);
+- stock_after nối tiếp đúng theo thứ tự id;
+- không request nào lỗi "database is locked".
+Chạy: python -m app.cli stress-xuat [--threads 8] [--qty 200]
+Dữ liệu thử (cửa hàng/sản phẩm ZZSTRESS) được xoá sau khi chạy.
+"""
+from __future__ import annotations
+import threading
+from dataclasses import dataclass, field
+from sqlalchemy import select, delete
+from sqlalchemy.exc import OperationalError
+from . import models
+from .db import SessionLocal
+from .services import masterdata as md
+from .services.inventory import nhap, xuat
+
+STORE = "ZZSTRESS"
+PRODUCT = "ZZSTRESS"
+
+@dataclass
+class StressResult:
+    initial: float
+    ok: int = 0
+    rejected: int = 0          # "Âm kho không được phép" (đúng khi đã hết tồn)
+    locked: int = 0
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def passed(self) -> bool:
+        return not self.errors and self.locked == 0 and self.ok == int(self.initial)
+
+def _setup(qty: float) -> None:
+    db = SessionLocal()
+    try:
+        _cleanup(db)
+        db.add(models.Store(code=STORE, name="Stress test"))
+        db.add(models.Product(code=PRODUCT, name="Stress test", uom="cái", category_code="ZZSTRESS"))
+        db.commit()
+        md.invalidate()
+        nhap(db, store_code=STORE, product_code=PRODUCT, qty=qty, price=1000.0, note="Stress")
+        db.commit()
+    finally:
+        db.close()
+
+def _cleanup(db) -> None:
+    L, N = models.Ledger, models.LedgerNote
+    sid = select(models.Store.id).where(models.Store.code == STORE).scalar_subquery()
+    db.execute(delete(N).where(N.ledger_id.in_(select(L.id).where(L.store_id == sid))))
+    db.execute(delete(L).where(L.store_id == sid))
+    db.execute(delete(models.StockBalance).where(models.StockBalance.store_code == STORE))
+    db.execute(delete(models.DailySummary).where(models.DailySummary.store_code == STORE))
+    db.execute(delete(models.Product).where(models.Product.code == PRODUCT))
+    db.execute(delete(models.Store).where(models.Store.code == STORE))
+    md.touch(db, "stores", "products")  # delete Core không qua mapper event
+    db.commit()
+    md.invalidate()
+
+def _worker(res: StressResult, lock: threading.Lock) -> None:
+    while True:
+        db = SessionLocal()
+        try:
+            xuat(db, store_code=STORE, product_code=PRODUCT, qty=1.0, note="Stress")
+            db.commit()
+            with lock:
+                res.ok += 1
+        except ValueError:
+            db.rollback()
+            with lock:
+                res.rejected += 1
+            return
+        except OperationalError as e:
+            db.rollback()
+            with lock:
+                if "locked" in str(e):
+                    res.locked += 1
+                else:
+                    res.errors.append(str(e))
+            return
+        finally:
+            db.close()
+
+def _verify(res: StressResult) -> None:
+    db = SessionLocal()
+    try:
+        L, S, P = models.Ledger, models.Store, models.Product
+        rows = db.execute(
+            select(L.qty_in, L.qty_out, L.stock_after)
+            .join(S, S.id == L.store_id).join(P, P.id == L.product_id)
+            .where(S.code == STORE, P.code == PRODUCT).order_by(L.id)
+        ).all()
+        stock = 0.0
+        for i, (qin, qout, after) in enumerate(rows):
+            stock += (qin or 0.0) - (qout or 0.0)
+            if abs(stock - after) > 1e-6:
+                res.errors.append(f"Dòng {i}: stock_after={after}, kỳ vọng {stock}")
+                break
+            if after < -1e-9:
+                res.errors.append(f"Dòng {i}: âm kho ({after})")
+                break
+        b = db.get(models.StockBalance, (STORE, PRODUCT))
+        if b is None or abs(b.stock_after) > 1e-6:
+            res.errors.append(f"Tồn cuối = {b.stock_after if b else None}, kỳ vọng 0")
+    finally:
+        db.close()
+
+def stress_xuat(threads: int = 8, qty: float = 200.0, keep: bool = False) -> StressResult:
+    res = StressResult(initial=qty)
+    _setup(qty)
+    lock = threading.Lock()
+    pool = [threading.Thread(target=_worker, args=(res, lock)) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    _verify(res)
+    if not keep:
+        db = SessionLocal()
+        try:
+            _cleanup(db)
+        finally:
+            db.close()
+    return res
@@ -0,0 +1,32 @@
+"""
+Jinja Environment dùng chung.
+- TEMPLATE_RELOAD=1 (dev): tự đọc lại template khi file thay đổi. Mặc định tắt:
+  mỗi template compile 1 lần / tiến trình, get_template không stat file.
+- Bytecode cache (TEMPLATE_CACHE_DIR, mặc định thư mục tạm của user): worker mới
+  hoặc lần khởi động sau nạp bytecode thay vì parse lại template.
+"""
+from __future__ import annotations
+import os
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
+
+TEMPLATE_DIR = "app/templates"
+TEMPLATE_RELOAD = os.getenv("TEMPLATE_RELOAD", "0") == "1"
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR") or None
+
+def make_environment(bytecode_cache: bool = True, auto_reload: bool = TEMPLATE_RELOAD) -> Environment:
+    return Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR),
+        autoescape=select_autoescape(["html"]),
+        auto_reload=auto_reload,
+        cache_size=-1,  # giữ mọi template đã compile (vài chục file)
+        bytecode_cache=FileSystemBytecodeCache(TEMPLATE_CACHE_DIR) if bytecode_cache else None,
+    )
+
+def precompile(env: Environment) -> int:
+    """
+    Compile toàn bộ template lúc khởi động (request đầu không phải chờ). Trả về số template.
+    """
+    names = env.list_templates(extensions=["html"])
+    for name in names:
+        env.get_template(name)
+    return len(names)